@@ -0,0 +1,54 @@
+"""``ql.completions`` latency for each completion class.
+"""
+from harness import benchmark, measure
+from witchcraft import ql
+from witchcraft.ql.completion import CompletionIndex
+
+
+def then_chain(size, tail):
+    """A playlist script of about ``size`` bytes of ``then`` clauses with a
+    partial clause at the end.
+    """
+    clauses = []
+    while sum(map(len, clauses)) < size:
+        clauses.append('storm, rain on river by prime take 5 then ')
+    return ''.join(clauses) + tail
+
+
+partial_queries = {
+    'title': 'sto',
+    'title-list': 'storm,gh',
+    'album': '. on riv',
+    'artist': '. by pr',
+    'keyword': '. by prime sh',
+    # narrowed by the clause typed before
+    'album-by': '. by prime on ',
+    'artist-on': '. on river by ',
+    # completing the end of a long query is what a frontend does on each key
+    'then-1k': then_chain(1024, 'sto'),
+    'then-5k': then_chain(5 * 1024, 'sto'),
+    'then-5k-keyword': then_chain(5 * 1024, '. by prime sh'),
+}
+
+
+@benchmark('completion')
+def bench_completion(library, options):
+    results = {}
+    with library.engine.connect() as conn:
+        # ``witchcraft serve`` completes albums and artists with an index
+        completion_index = CompletionIndex(library.engine.connect())
+        for prefix, index in (('completion', None),
+                              ('completion-index', completion_index)):
+            for name, source in partial_queries.items():
+                completions = []
+
+                def complete():
+                    completions[:] = ql.completions(conn, source, index)
+
+                stats = results['%s[%s]' % (prefix, name)] = measure(
+                    complete,
+                    repeat=options.repeat * 10,
+                )
+                stats['candidates'] = len(completions)
+
+    return results
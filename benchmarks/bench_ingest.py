@@ -0,0 +1,106 @@
+"""Ingest throughput: ``schema.ensure_track`` into a fresh database,
+``ingest.ingest_file`` on generated audio files, planning and applying the
+same ingest with ``plan.plan_ingest`` and ``plan.apply_plan``, and walking the
+directory of generated files.
+"""
+import os
+from tempfile import TemporaryDirectory
+
+from harness import benchmark, measure
+import synthetic
+from witchcraft import schema
+from witchcraft.db import create_engine
+from witchcraft.ingest import ingest_file
+from witchcraft.plan import apply_plan, plan_ingest
+from witchcraft.walk import walk_audio_files
+
+
+@benchmark('ingest')
+def bench_ingest(library, options):
+    ntracks = min(library.ntracks, options.ingest_tracks)
+    tracks = list(synthetic.tracks(ntracks, seed=library.seed + 1))
+
+    def ensure_tracks():
+        with TemporaryDirectory() as tmpdir:
+            engine = create_engine(
+                os.path.join(tmpdir, '.metadata.db'),
+                library.profile,
+            )
+            schema.create_schema(engine)
+            with engine.connect() as conn:
+                for track in tracks:
+                    schema.ensure_track(conn, **track)
+            engine.dispose()
+
+    results = {
+        'ingest.ensure_track': measure(
+            ensure_tracks,
+            repeat=options.repeat,
+            items=ntracks,
+        ),
+    }
+
+    with TemporaryDirectory() as source:
+        nfiles = min(library.ntracks, options.ingest_files)
+        paths = synthetic.generate_files(source, nfiles, seed=library.seed)
+
+        def ingest_files():
+            with TemporaryDirectory() as music_home:
+                engine = create_engine(
+                    os.path.join(music_home, '.metadata.db'),
+                    library.profile,
+                )
+                schema.create_schema(engine)
+                with engine.connect() as conn:
+                    for path in paths:
+                        ingest_file(
+                            music_home,
+                            conn,
+                            path,
+                            verbose=False,
+                            ignore_failures=False,
+                        )
+                engine.dispose()
+
+        def plan_and_apply():
+            with TemporaryDirectory() as music_home:
+                engine = create_engine(
+                    os.path.join(music_home, '.metadata.db'),
+                    library.profile,
+                )
+                schema.create_schema(engine)
+                with engine.connect() as conn:
+                    plan = plan_ingest(
+                        music_home,
+                        conn,
+                        [source],
+                        ignore_failures=False,
+                    )
+                    apply_plan(
+                        music_home,
+                        conn,
+                        plan,
+                        verbose=False,
+                        ignore_failures=False,
+                    )
+                engine.dispose()
+
+        results['ingest.walk'] = measure(
+            lambda: list(walk_audio_files(source)),
+            repeat=options.repeat,
+            items=nfiles,
+        )
+
+        results['ingest.ingest_file'] = measure(
+            ingest_files,
+            repeat=options.repeat,
+            items=nfiles,
+        )
+
+        results['ingest.plan_apply'] = measure(
+            plan_and_apply,
+            repeat=options.repeat,
+            items=nfiles,
+        )
+
+    return results
@@ -0,0 +1,148 @@
+"""Benchmark ``witchcraft.utils.normalize`` against the original two-pass
+regex implementation.
+
+The corpus is modeled on an ingest: a small set of artists and albums which
+repeat for every track on an album, and mostly unique track titles.
+
+Usage: python benchmarks/bench_normalize.py [--tracks N] [--repeat N]
+
+This also runs as the ``normalize`` benchmark in ``benchmarks/run.py``.
+"""
+import argparse
+import random
+import re
+import timeit
+
+from harness import benchmark, measure
+from witchcraft.utils import allowed_charset, normalize
+
+
+def normalize_reference(name):
+    """The implementation of ``normalize`` before the translate table.
+    """
+    name = name.strip()
+    name = name.lower()
+    name = re.sub(r'[\s_]', '-', name)
+    for char in set(name) - allowed_charset:
+        name = name.replace(char, '')
+    name = re.sub(r'-+', '-', name)
+    return name
+
+
+_words = (
+    'the night dark shadow witchcraft tokyo flow drop bass drum dream '
+    'light sound city fire ghost machine signal echo system digital '
+    'future memory storm heart code ritual'
+).split()
+_decorations = (
+    '', '', '', ' (Original Mix)', ' (VIP)', ' feat. MC {}', ' - Remix',
+    "'s", ' & {}', ' [Live]', '_2',
+)
+
+
+def _phrase(rng, low, high):
+    words = [rng.choice(_words) for _ in range(rng.randint(low, high))]
+    words = [w.capitalize() if rng.random() < 0.7 else w for w in words]
+    return ' '.join(words) + rng.choice(_decorations).format(
+        rng.choice(_words).capitalize(),
+    )
+
+
+def corpus(ntracks, seed=0):
+    """Generate the names that would be normalized while ingesting
+    ``ntracks`` tracks.
+
+    Returns
+    -------
+    names : list[str]
+        The raw names in the order they would be normalized.
+    """
+    rng = random.Random(seed)
+    artists = [_phrase(rng, 1, 2) for _ in range(max(ntracks // 50, 1))]
+    albums = [_phrase(rng, 1, 4) for _ in range(max(ntracks // 10, 1))]
+
+    names = []
+    while len(names) < ntracks * 5:
+        artist = artists[int(rng.paretovariate(1.2)) % len(artists)]
+        album = rng.choice(albums)
+        for _ in range(rng.randint(4, 14)):
+            # title, album, artist, and the two path components
+            names.extend((_phrase(rng, 1, 5), album, artist, artist, album))
+    return names
+
+
+@benchmark('normalize')
+def bench_normalize(library, options):
+    names = corpus(min(library.ntracks, 20000))
+
+    def run_reference():
+        for name in names:
+            normalize_reference(name)
+
+    def run_normalize():
+        normalize.cache_clear()
+        for name in names:
+            normalize(name)
+
+    return {
+        'normalize.reference': measure(
+            run_reference,
+            repeat=options.repeat,
+            items=len(names),
+        ),
+        'normalize': measure(
+            run_normalize,
+            repeat=options.repeat,
+            items=len(names),
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    names = corpus(args.tracks)
+
+    mismatches = [
+        name for name in set(names)
+        if normalize(name) != normalize_reference(name)
+    ]
+    if mismatches:
+        raise SystemExit('output differs for: %r' % mismatches[:10])
+
+    # the extended latin names only need to be accepted, the reference drops
+    # the accented characters so they are not compared
+    unaccepted = [
+        name
+        for name in ('Beyoncé', 'Sigur Rós', 'Mötley Crüe', 'Røyksopp')
+        if not set(normalize(name)) <= allowed_charset
+    ]
+    if unaccepted:
+        raise SystemExit('not transliterated: %r' % unaccepted)
+
+    print('%d names, %d unique' % (len(names), len(set(names))))
+
+    def run_reference():
+        for name in names:
+            normalize_reference(name)
+
+    def run_normalize():
+        normalize.cache_clear()
+        for name in names:
+            normalize(name)
+
+    for label, f in (('reference', run_reference),
+                     ('normalize', run_normalize)):
+        best = min(timeit.repeat(f, number=1, repeat=args.repeat))
+        print('%-10s %8.2f ms  %6.3f us/name' % (
+            label,
+            best * 1e3,
+            best * 1e6 / len(names),
+        ))
+
+
+if __name__ == '__main__':
+    main()
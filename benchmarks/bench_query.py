@@ -0,0 +1,72 @@
+"""``ql.compile`` and execution latency for representative WQL queries, with
+sqlite and with the in-memory columnar catalog.
+"""
+from harness import benchmark, measure
+from witchcraft import ql
+from witchcraft.ql.columnar import Catalog, supported
+
+
+queries = {
+    'all': '.',
+    'title': 'storm',
+    'titles': 'storm,fire,ghost',
+    'titles-many': 'storm,fire,ghost,wave,pulse,glass,steel,neon',
+    'anchored': ':^night',
+    'approximate': '~strom',
+    'approximate-by': '. by ~prme',
+    'by': '. by prime',
+    'on': '. on river',
+    'on-by': 'sig on code by the',
+    # matches most artists, so every collaboration matches more than once
+    'artists': '. by e, a',
+    'shuffle': '. by dark shuffle',
+    'sample': '. shuffle take 20',
+    'take': 'storm take 20',
+    'except': '. by prime except . on river',
+    'then': 'storm then fire by the',
+    'genre': '. genre techno',
+    'crate': '. genre dnb bpm 170..175 from 2015..',
+}
+
+
+@benchmark('query')
+def bench_query(library, options):
+    results = {}
+    with library.engine.connect() as conn:
+        for name, query in queries.items():
+            results['query.compile[%s]' % name] = measure(
+                lambda: list(ql.compile(query)),
+                repeat=options.repeat * 10,
+            )
+
+            selects = list(ql.compile(query))
+            rows = 0
+
+            def execute():
+                nonlocal rows
+                rows = 0
+                for select in selects:
+                    rows += len(conn.execute(select).fetchall())
+
+            stats = results['query.execute[%s]' % name] = measure(
+                execute,
+                repeat=options.repeat,
+            )
+            stats['rows'] = rows
+
+        results['catalog.load'] = measure(
+            lambda: Catalog(conn),
+            repeat=options.repeat,
+            items=library.ntracks,
+        )
+        catalog = Catalog(conn)
+        for name, query in queries.items():
+            parsed = ql.parse(query)
+            if not supported(parsed):
+                continue
+            results['query.columnar[%s]' % name] = measure(
+                lambda: list(catalog.evaluate(parsed)),
+                repeat=options.repeat,
+            )
+
+    return results
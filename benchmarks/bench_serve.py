@@ -0,0 +1,102 @@
+"""Round trip time through the ``witchcraft serve`` socket, and the cost of
+the metrics the server records for each request.
+"""
+import sys
+
+from harness import ServeClient, benchmark, measure
+from witchcraft.metrics import Registry
+
+# the phases timed while serving a ``select`` from sqlite
+select_phases = (
+    'query.lex',
+    'query.parse',
+    'query.compile',
+    'query.sql',
+    'query.format',
+)
+
+
+def record_select_metrics(registry):
+    """Record the metrics that the server records for one ``select``.
+    """
+    for phase in select_phases:
+        with registry.timer(phase):
+            pass
+    registry.histogram(
+        'witchcraft_command_seconds',
+        'Time to run each command in the server.',
+        command='select',
+    ).observe(0.0)
+    registry.counter(
+        'witchcraft_requests_total',
+        'Commands run by the server.',
+        command='select',
+    ).inc()
+
+
+commands = {
+    'version': ('version',),
+    'select-title': ('select', 'storm'),
+    'select-by': ('select', '.', 'by', 'prime'),
+    'completions': ('completions', 'select', '.', 'by', 'pr'),
+}
+
+
+@benchmark('serve')
+def bench_serve(library, options):
+    with library.engine.connect() as conn:
+        ntracks = conn.execute('select count(*) from tracks').scalar()
+
+    results = {}
+    with ServeClient(library.music_home) as client:
+        # make sure the server is reading the library before timing it
+        code, out, err = client.run('select', '.')
+        if code:
+            raise RuntimeError('select failed: %s' % err.decode('utf-8'))
+        served = len(out.splitlines())
+        if served != ntracks:
+            raise RuntimeError(
+                'the server returned %d tracks for a library of %d' % (
+                    served,
+                    ntracks,
+                ),
+            )
+
+        for name, args in commands.items():
+            def round_trip():
+                code, out, err = client.run(*args)
+                if code:
+                    raise RuntimeError(
+                        '%r failed: %s' % (args, err.decode('utf-8')),
+                    )
+
+            results['serve[%s]' % name] = measure(
+                round_trip,
+                repeat=options.repeat * 10,
+            )
+
+    # The requests above are timed with the metrics enabled. Recording the
+    # same metrics on their own gives the time the requests would save
+    # without them.
+    registry = Registry()
+    nrequests = 1000
+
+    def record_metrics():
+        for _ in range(nrequests):
+            record_select_metrics(registry)
+
+    results['serve.metrics[select]'] = metrics = measure(
+        record_metrics,
+        repeat=options.repeat,
+        items=nrequests,
+    )
+    per_request = metrics['median'] / nrequests
+    print(
+        'metrics: %.1f us per select, %.2f%% of serve[select-title]' % (
+            per_request * 1e6,
+            100 * per_request / results['serve[select-title]']['median'],
+        ),
+        file=sys.stderr,
+    )
+
+    return results
@@ -0,0 +1,126 @@
+"""Tag decoding: ``tags.parse_date`` against ``dateutil``, ``tags.decode_tags``
+on the raw tags of generated tracks, and each tag reader on generated flac and
+mp3 files.
+"""
+import datetime
+import os
+import random
+from tempfile import TemporaryDirectory
+
+import dateutil.parser
+
+from harness import benchmark, measure
+import synthetic
+from witchcraft.tags import decode_tags, parse_date, tag_readers
+
+
+def dates(n, seed=0):
+    """Generate ``DATE`` tags in the formats seen in real libraries.
+
+    Most tracks share their album's date, so the values repeat.
+    """
+    rng = random.Random(seed)
+    formats = ('%Y', '%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m')
+    albums = []
+    for _ in range(max(n // 10, 1)):
+        date = datetime.datetime(
+            rng.randint(1990, 2020),
+            rng.randint(1, 12),
+            rng.randint(1, 28),
+        )
+        albums.append(date.strftime(rng.choice(formats)))
+    return [rng.choice(albums) for _ in range(n)]
+
+
+@benchmark('tags')
+def bench_tags(library, options):
+    ntracks = min(library.ntracks, options.ingest_tracks)
+    values = dates(ntracks, seed=library.seed)
+
+    def run_dateutil():
+        for value in values:
+            dateutil.parser.parse(value)
+
+    def run_parse_date():
+        parse_date.cache_clear()
+        for value in values:
+            parse_date(value)
+
+    raw_tags = [
+        synthetic.file_tags(track)
+        for track in synthetic.tracks(ntracks, seed=library.seed)
+    ]
+
+    def run_decode_tags():
+        for tags in raw_tags:
+            decode_tags(tags)
+
+    results = {
+        'tags.parse_date[dateutil]': measure(
+            run_dateutil,
+            repeat=options.repeat,
+            items=ntracks,
+        ),
+        'tags.parse_date': measure(
+            run_parse_date,
+            repeat=options.repeat,
+            items=ntracks,
+        ),
+        'tags.decode_tags': measure(
+            run_decode_tags,
+            repeat=options.repeat,
+            items=ntracks,
+        ),
+    }
+
+    with TemporaryDirectory() as source:
+        nfiles = min(library.ntracks, options.ingest_files)
+        paths = synthetic.generate_files(source, nfiles, seed=library.seed)
+
+        # a utf-16 tag with several values in a frame, where each value has
+        # its own byte order mark
+        track = next(synthetic.tracks(1, seed=library.seed))
+        tags = synthetic.file_tags(track)
+        tags['ARTIST'] = track['artists'] + ['Ω']
+        tags['GENRE'] = track['genres'] + ['liquid']
+        utf16_path = os.path.join(source, 'utf-16.mp3')
+        synthetic.write_mp3(utf16_path, tags, encoding='utf-16')
+
+        # the readers are only comparable if they read the same tags
+        for path in paths + [utf16_path]:
+            expected = tag_readers['taglib'](path)
+            for name, read in tag_readers.items():
+                if read(path) != expected:
+                    raise ValueError(
+                        'tag reader %r disagrees with taglib on %r' % (
+                            name,
+                            path,
+                        ),
+                    )
+
+        # taglib reports both the TDRC and TYER frames as dates, the header
+        # reader only uses TYER when there is no TDRC
+        tags['YEAR'] = [str(track['date'].year - 1)]
+        year_path = os.path.join(source, 'tdrc-tyer.mp3')
+        synthetic.write_mp3(year_path, tags)
+        read_dates = tag_readers['header'](year_path).get('DATE')
+        if read_dates != tags['DATE']:
+            raise ValueError(
+                'header tag reader read DATE %r, expected %r' % (
+                    read_dates,
+                    tags['DATE'],
+                ),
+            )
+
+        for name, read in tag_readers.items():
+            def run_reader():
+                for path in paths:
+                    read(path)
+
+            results['tags.read[%s]' % name] = measure(
+                run_reader,
+                repeat=options.repeat,
+                items=nfiles,
+            )
+
+    return results
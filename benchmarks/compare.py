@@ -0,0 +1,64 @@
+"""Compare two benchmark result files written by ``benchmarks/run.py``.
+
+Usage: python benchmarks/compare.py base.json new.json [--threshold 0.1]
+
+Exits with status 1 if any shared result got slower by more than the
+threshold.
+"""
+import argparse
+import json
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.1,
+        help='The relative slowdown in the median that counts as a'
+        ' regression.',
+    )
+    options = parser.parse_args()
+
+    with open(options.base) as f:
+        base = json.load(f)
+    with open(options.new) as f:
+        new = json.load(f)
+
+    print('base: %s (%s)' % (base['meta']['commit'], base['meta']['size']))
+    print('new:  %s (%s)' % (new['meta']['commit'], new['meta']['size']))
+    if base['meta']['size'] != new['meta']['size']:
+        print('warning: the results are for different library sizes')
+
+    regressions = []
+    for name in sorted(base['results'].keys() & new['results'].keys()):
+        before = base['results'][name]['median']
+        after = new['results'][name]['median']
+        ratio = after / before if before else float('inf')
+        flag = ''
+        if ratio > 1 + options.threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-40s %10.3f ms %10.3f ms %7.2fx%s' % (
+            name,
+            before * 1e3,
+            after * 1e3,
+            ratio,
+            flag,
+        ))
+
+    for name in sorted(base['results'].keys() ^ new['results'].keys()):
+        print('%-40s only in %s' % (
+            name,
+            'base' if name in base['results'] else 'new',
+        ))
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
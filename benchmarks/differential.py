@@ -0,0 +1,174 @@
+"""Check that the columnar engine returns exactly what the sql does.
+
+Usage: python benchmarks/differential.py [--tracks N] [--queries N]
+                                         [--seed N]
+
+Random queries are run through both ``ql.compile`` and sqlite and
+``ql.columnar.Catalog``. Half of the library is loaded before the catalog is
+built and the rest is written afterwards so that incremental refreshes are
+checked as well. Exits with status 1 if any query disagrees.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+import synthetic
+from witchcraft import schema
+from witchcraft.db import create_engine
+from witchcraft.ql import compile, parse
+from witchcraft.ql.columnar import Catalog
+from witchcraft.ql.lexer import Keyword
+
+
+def _names(rng, vocabulary):
+    names = []
+    for _ in range(rng.choice((1, 1, 1, 2, 3))):
+        r = rng.random()
+        if r < 0.05:
+            names.append('.')
+            continue
+
+        name = rng.choice(vocabulary)
+        if r < 0.5:
+            # a fragment of a word
+            start = rng.randrange(len(name))
+            name = name[start:start + rng.randint(1, 4)]
+        elif r < 0.6:
+            # ``.`` matches anything inside of a name
+            name = '.'.join(name.split('-')[:2])
+        name = name.strip('-')
+        if not name or name in Keyword.keywords:
+            name = 'e'
+        if rng.random() < 0.15:
+            name = ':^' + name
+        if rng.random() < 0.15:
+            name += '$'
+        names.append(name)
+    return ', '.join(names)
+
+
+def random_query(rng, words, albums, artists, depth=0, excepted=False):
+    """Generate a random witchcraft ql query.
+    """
+    parts = [_names(rng, words)]
+    if rng.random() < 0.3:
+        parts.extend(('on', _names(rng, albums + words)))
+    if rng.random() < 0.4:
+        parts.extend(('by', _names(rng, artists + words)))
+    shuffle = rng.random() < 0.1
+    if shuffle:
+        parts.append('shuffle')
+    # a random sample in an ``except`` would make the other results random
+    if rng.random() < 0.15 and not (shuffle and excepted):
+        parts.extend(('take', str(rng.choice((0, 1, 5, 50, 1000)))))
+    if depth < 3:
+        r = rng.random()
+        if r < 0.2:
+            parts.extend((
+                'except',
+                random_query(rng, words, albums, artists, depth + 1, True),
+            ))
+        elif r < 0.35:
+            parts.extend((
+                'then',
+                random_query(
+                    rng,
+                    words,
+                    albums,
+                    artists,
+                    depth + 1,
+                    excepted,
+                ),
+            ))
+    return ' '.join(parts)
+
+
+def sql_segments(conn, source):
+    return [
+        [row[0] for row in conn.execute(select).fetchall()]
+        for select in compile(source)
+    ]
+
+
+def check(conn, catalog, sources):
+    """Run each query through both engines.
+
+    Returns
+    -------
+    failures : int
+        The number of queries that disagreed.
+    """
+    failures = 0
+    for source in sources:
+        expected = sql_segments(conn, source)
+        actual = list(catalog.evaluate(parse(source)))
+        sizes = (
+            [len(segment) for segment in expected],
+            [len(segment) for segment in actual],
+        )
+        if 'shuffle' in source and 'take' in source:
+            # random samples can only be compared by size
+            expected = [len(segment) for segment in expected]
+            actual = [len(segment) for segment in actual]
+        elif 'shuffle' in source:
+            # shuffled statements can only be compared as multisets
+            expected = [sorted(segment) for segment in expected]
+            actual = [sorted(segment) for segment in actual]
+
+        if expected != actual:
+            failures += 1
+            print('mismatch: %s' % source, file=sys.stderr)
+            print('  sql:      %s' % sizes[0], file=sys.stderr)
+            print('  columnar: %s' % sizes[1], file=sys.stderr)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=3000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+
+    rng = random.Random(options.seed)
+    generated = list(synthetic.tracks(options.tracks, options.seed))
+    albums = sorted({track['album'] for track in generated})
+    artists = sorted({
+        artist for track in generated for artist in track['artists']
+    })
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(os.path.join(tmp, 'metadata.db'))
+        schema.create_schema(engine)
+
+        half = len(generated) // 2
+        with engine.connect() as conn:
+            with conn.begin():
+                for track in generated[:half]:
+                    schema.ensure_track(conn, **track)
+
+            catalog = Catalog(engine.connect())
+
+            with conn.begin():
+                for track in generated[half:]:
+                    schema.ensure_track(conn, **track)
+            if not catalog.refresh():
+                print('the catalog did not notice the write', file=sys.stderr)
+                return 1
+
+            sources = [
+                random_query(rng, synthetic.words, albums, artists)
+                for _ in range(options.queries)
+            ]
+            failures = check(conn, catalog, sources)
+
+        engine.dispose()
+
+    print('%d/%d queries agree' % (len(sources) - failures, len(sources)))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,204 @@
+"""Shared machinery for the benchmark suite.
+
+Benchmarks are registered with :func:`benchmark` and receive a
+:class:`Library` and the parsed command line options. They return a mapping
+from result name to the statistics produced by :func:`measure`.
+"""
+from collections import OrderedDict
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import synthetic
+from witchcraft.db import create_engine
+from witchcraft.schema import create_schema
+
+
+benchmarks = OrderedDict()
+
+
+def benchmark(name):
+    """Register a benchmark.
+
+    Parameters
+    ----------
+    name : str
+        The name used to select the benchmark with ``--only``.
+    """
+    def dec(f):
+        benchmarks[name] = f
+        return f
+    return dec
+
+
+def measure(f, *, repeat, items=None):
+    """Time repeated calls to ``f``.
+
+    Parameters
+    ----------
+    f : callable[[], any]
+        The function to time.
+    repeat : int
+        The number of times to call ``f``.
+    items : int, optional
+        The number of items processed by one call to ``f``. When given, the
+        throughput is recorded as well.
+
+    Returns
+    -------
+    stats : dict
+        The timing statistics, in seconds.
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        samples.append(time.perf_counter() - start)
+
+    stats = OrderedDict([
+        ('unit', 's'),
+        ('min', min(samples)),
+        ('median', statistics.median(samples)),
+        ('mean', statistics.mean(samples)),
+        ('stdev', statistics.stdev(samples) if len(samples) > 1 else 0.0),
+        ('samples', samples),
+    ])
+    if items is not None:
+        stats['items'] = items
+        stats['items_per_second'] = items / stats['median']
+    return stats
+
+
+class Library:
+    """A synthetic music home on disk.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The directory to store generated libraries in. Libraries are reused
+        between runs because the large ones take a long time to build.
+    ntracks : int
+        The number of tracks in the library.
+    seed : int
+        The random seed for the library.
+    profile : str
+        The db profile to connect with.
+    """
+    def __init__(self, cache_dir, ntracks, seed, profile):
+        self.ntracks = ntracks
+        self.seed = seed
+        self.profile = profile
+        self.music_home = os.path.join(
+            cache_dir,
+            'library-%d-%d' % (ntracks, seed),
+        )
+        self.db_path = os.path.join(self.music_home, '.metadata.db')
+        self.engine = self.build()
+
+    def build(self):
+        ready = os.path.join(self.music_home, '.ready')
+        if not os.path.exists(ready):
+            os.makedirs(self.music_home, exist_ok=True)
+            if os.path.exists(self.db_path):
+                os.remove(self.db_path)
+
+            print('generating %d track library in %s' % (
+                self.ntracks,
+                self.music_home,
+            ), file=sys.stderr)
+            engine = create_engine(self.db_path, 'bulk-load')
+            create_schema(engine)
+            with engine.connect() as conn:
+                synthetic.generate_library(conn, self.ntracks, self.seed)
+            engine.dispose()
+            open(ready, 'w').close()
+
+        return create_engine(self.db_path, self.profile)
+
+
+class ServeClient:
+    """Run ``witchcraft serve`` in a subprocess and talk to it over its
+    socket with the same protocol as ``client/witchcraft_cli.c``.
+
+    Parameters
+    ----------
+    music_home : str
+        The music home to serve.
+    """
+    def __init__(self, music_home, *serve_args):
+        self.path = os.path.join(music_home, '.cli-server.sock')
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        # the server runs each request with the client's arguments, which
+        # do not include ``--music-home``, so the music home has to come from
+        # the environment
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'witchcraft', 'serve'] + list(serve_args),
+            env=dict(os.environ, WITCHCRAFT_MUSIC_HOME=music_home),
+        )
+        deadline = time.monotonic() + 30
+        while not os.path.exists(self.path):
+            if time.monotonic() > deadline or self.process.poll() is not None:
+                self.close()
+                raise RuntimeError('witchcraft serve did not start')
+            time.sleep(0.05)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+    @staticmethod
+    def _recv_exactly(sock, n):
+        data = b''
+        while len(data) < n:
+            chunk = sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError('server closed the connection')
+            data += chunk
+        return data
+
+    def run(self, *args):
+        """Run a witchcraft command in the server.
+
+        Returns
+        -------
+        code : int
+            The exit code.
+        out : bytes
+            The command's stdout.
+        err : bytes
+            The command's stderr.
+        """
+        env = b'CWD\0' + os.getcwd().encode('utf-8')
+        data = '\0'.join(args).encode('utf-8')
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.path)
+            sock.sendall(
+                len(env).to_bytes(4, 'little') + env +
+                len(data).to_bytes(4, 'little') + data,
+            )
+            code = self._recv_exactly(sock, 1)[0]
+            out = self._recv_exactly(
+                sock,
+                int.from_bytes(self._recv_exactly(sock, 4), 'little'),
+            )
+            err = self._recv_exactly(
+                sock,
+                int.from_bytes(self._recv_exactly(sock, 4), 'little'),
+            )
+            # wait for the server to hang up; it still sends an empty stderr
+            # and would get a broken pipe if we closed first
+            while sock.recv(4096):
+                pass
+        return code, out, err
@@ -0,0 +1,118 @@
+"""Run the witchcraft benchmark suite and write the results as json.
+
+Usage: python benchmarks/run.py [--size {10k,100k,1m}] [--only NAME ...]
+                                [--output results.json]
+
+Compare two result files with ``benchmarks/compare.py``.
+"""
+import argparse
+from collections import OrderedDict
+import datetime
+import glob
+import importlib
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+
+from harness import Library, benchmarks
+import witchcraft
+
+
+sizes = {
+    '10k': 10000,
+    '100k': 100000,
+    '1m': 1000000,
+}
+
+
+def _load_benchmarks():
+    here = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(os.path.join(here, 'bench_*.py'))):
+        importlib.import_module(os.path.splitext(os.path.basename(path))[0])
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    _load_benchmarks()
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', choices=sorted(sizes), default='10k')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--cache-dir',
+        default=os.path.expanduser('~/.cache/witchcraft-benchmarks'),
+        help='Where to keep the generated libraries between runs.',
+    )
+    parser.add_argument(
+        '--profile',
+        default='safe',
+        help='The db profile to connect to the libraries with.',
+    )
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--only',
+        nargs='+',
+        choices=list(benchmarks),
+        default=list(benchmarks),
+    )
+    parser.add_argument('--ingest-tracks', type=int, default=5000)
+    parser.add_argument('--ingest-files', type=int, default=500)
+    parser.add_argument('--output', help='Write the results here.')
+    options = parser.parse_args()
+
+    library = Library(
+        options.cache_dir,
+        sizes[options.size],
+        options.seed,
+        options.profile,
+    )
+
+    results = OrderedDict()
+    for name in options.only:
+        print('running %s' % name, file=sys.stderr)
+        results.update(sorted(benchmarks[name](library, options).items()))
+
+    output = OrderedDict([
+        ('meta', OrderedDict([
+            ('commit', _git_commit()),
+            ('witchcraft', witchcraft.__version__),
+            ('python', platform.python_version()),
+            ('sqlite', sqlite3.sqlite_version),
+            ('platform', platform.platform()),
+            ('date', datetime.datetime.now().isoformat()),
+            ('size', options.size),
+            ('seed', options.seed),
+            ('profile', options.profile),
+        ])),
+        ('results', results),
+    ])
+
+    if options.output is None:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    else:
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    for name, stats in results.items():
+        print(
+            '%-40s %10.3f ms' % (name, stats['median'] * 1e3),
+            file=sys.stderr,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+"""Synthetic libraries and tagged audio files for the benchmarks.
+
+The libraries are generated through ``schema.ensure_track`` so that they look
+exactly like a library built by ``witchcraft ingest``. Popularity follows a
+power law: a few artists have many albums and most have one or two, a few
+genres cover most tracks, and about one track in six is a collaboration.
+"""
+import datetime
+import os
+import random
+import struct
+
+from witchcraft import schema
+from witchcraft.utils import normalize
+
+
+words = (
+    'the night dark shadow witchcraft tokyo flow drop bass drum dream light '
+    'sound city fire ghost machine signal echo system digital future memory '
+    'storm heart code ritual black white cold gold river ocean wave pulse '
+    'static neon glass steel velvet silent broken hidden lost found north '
+    'south zero prime orbit vector spiral fractal'
+).split()
+
+genres = (
+    'dnb', 'neurofunk', 'liquid', 'jungle', 'techno', 'house', 'dubstep',
+    'ambient', 'breaks', 'halftime', 'garage', 'electro', 'idm', 'trance',
+    'hip-hop', 'jazz', 'rock', 'metal', 'pop', 'classical',
+)
+
+labels = tuple(
+    '%s-recordings' % word for word in words[:24]
+) + tuple('%s-audio' % word for word in words[24:40])
+
+
+def _zipf_index(rng, n, s=1.1):
+    """Draw an index in ``[0, n)`` where small indices are much more likely.
+    """
+    return min(int(rng.paretovariate(s)) - 1, n - 1)
+
+
+def _name(rng, low, high):
+    return normalize(' '.join(
+        rng.choice(words) for _ in range(rng.randint(low, high))
+    ))
+
+
+def tracks(ntracks, seed=0):
+    """Generate the metadata for a synthetic library.
+
+    Parameters
+    ----------
+    ntracks : int
+        The number of tracks to generate.
+    seed : int, optional
+        The random seed.
+
+    Yields
+    ------
+    track : dict
+        The keyword arguments to ``schema.ensure_track`` without ``conn``.
+    """
+    rng = random.Random(seed)
+    nartists = max(ntracks // 40, 3)
+    artists = sorted({
+        '%s-%d' % (_name(rng, 1, 2), n) for n in range(nartists)
+    })
+    rng.shuffle(artists)
+
+    # ``ensure_track`` treats a track with the same title as one of the
+    # artists' existing tracks as a duplicate
+    artist_titles = set()
+
+    produced = 0
+    album_number = 0
+    while produced < ntracks:
+        primary = artists[_zipf_index(rng, len(artists))]
+        album = '%s-%d' % (_name(rng, 1, 3), album_number)
+        album_number += 1
+        genre = genres[_zipf_index(rng, len(genres), 0.8)]
+        label = rng.choice(labels) if rng.random() < 0.8 else None
+        date = datetime.datetime(
+            rng.randint(1990, 2020),
+            rng.randint(1, 12),
+            1,
+        )
+
+        for track_number in range(1, rng.randint(1, 14) + 1):
+            if produced == ntracks:
+                break
+
+            track_artists = [primary]
+            if rng.random() < 1 / 6:
+                track_artists.extend(rng.sample(artists, rng.randint(1, 2)))
+            title = base_title = _name(rng, 1, 4)
+            version = 1
+            while any((a, title) in artist_titles for a in track_artists):
+                version += 1
+                title = '%s-%d' % (base_title, version)
+            artist_titles.update((a, title) for a in track_artists)
+            track_genres = [genre]
+            if rng.random() < 0.2:
+                track_genres.append(rng.choice(genres))
+
+            yield {
+                'path': os.path.join(
+                    primary,
+                    album,
+                    '%.2d-%s.flac' % (track_number, title),
+                ),
+                'album': album,
+                'artists': list(dict.fromkeys(track_artists)),
+                'bpm': rng.randint(80, 180),
+                'date': date,
+                'filetype': 'flac',
+                'genres': list(dict.fromkeys(track_genres)),
+                'isrc': 'XX%.10d' % produced,
+                'label': label,
+                'title': title,
+                'track_number': track_number,
+            }
+            produced += 1
+
+
+def generate_library(conn, ntracks, seed=0):
+    """Fill a database with a synthetic library.
+
+    Parameters
+    ----------
+    conn : sa.Connection
+        The connection to a database created with ``schema.create_schema``.
+    ntracks : int
+        The number of tracks to generate.
+    seed : int, optional
+        The random seed.
+    """
+    schema.preload_entity_cache(conn)
+    with conn.begin():
+        for track in tracks(ntracks, seed):
+            schema.ensure_track(conn, **track)
+
+
+def _flac_block(type_, body, last):
+    return struct.pack('>I', (last << 31) | (type_ << 24) | len(body)) + body
+
+
+def _vorbis_comments(tags):
+    comments = [
+        ('%s=%s' % (key, value)).encode('utf-8')
+        for key, values in tags.items()
+        for value in values
+    ]
+    vendor = b'witchcraft benchmarks'
+    return b''.join(
+        [struct.pack('<I', len(vendor)), vendor,
+         struct.pack('<I', len(comments))] +
+        [struct.pack('<I', len(c)) + c for c in comments]
+    )
+
+
+def write_flac(path, tags):
+    """Write a flac file with no audio frames and the given vorbis comments.
+
+    Parameters
+    ----------
+    path : str
+        The path to write to.
+    tags : dict[str, list[str]]
+        The tags to write.
+    """
+    # 44.1kHz, 2 channels, 16 bits per sample, no samples
+    streaminfo = struct.pack(
+        '>HH3s3sQ16s',
+        4096,
+        4096,
+        b'\0\0\0',
+        b'\0\0\0',
+        (44100 << 44) | (1 << 41) | (15 << 36),
+        b'\0' * 16,
+    )
+    with open(path, 'wb') as f:
+        f.write(b'fLaC')
+        f.write(_flac_block(0, streaminfo, last=False))
+        f.write(_flac_block(4, _vorbis_comments(tags), last=True))
+
+
+_id3_frames = {
+    'ALBUM': 'TALB',
+    'ARTIST': 'TPE1',
+    'BPM': 'TBPM',
+    'DATE': 'TDRC',
+    'GENRE': 'TCON',
+    'ISRC': 'TSRC',
+    'LABEL': 'TPUB',
+    'TITLE': 'TIT2',
+    'TRACKNUMBER': 'TRCK',
+    # the id3v2.3 year frame, which some writers keep next to TDRC
+    'YEAR': 'TYER',
+}
+
+# id3v2 text encoding byte -> how each value is encoded
+_id3_encodings = {
+    'utf-8': (b'\3', lambda value: value.encode('utf-8'), b'\0'),
+    # every utf-16 value has its own byte order mark
+    'utf-16': (b'\1', lambda value: value.encode('utf-16'), b'\0\0'),
+}
+
+
+def _syncsafe(n):
+    return bytes((n >> shift) & 0x7f for shift in (21, 14, 7, 0))
+
+
+def write_mp3(path, tags, frames=8, encoding='utf-8'):
+    """Write an mp3 file with silent MPEG frames and an ID3v2.4 tag.
+
+    Parameters
+    ----------
+    path : str
+        The path to write to.
+    tags : dict[str, list[str]]
+        The tags to write. Keys without an ID3 frame are dropped.
+    frames : int, optional
+        The number of silent audio frames to write.
+    encoding : {'utf-8', 'utf-16'}, optional
+        The text encoding of the frames.
+    """
+    encoding_byte, encode, null = _id3_encodings[encoding]
+    body = b''
+    for key, values in tags.items():
+        try:
+            frame_id = _id3_frames[key]
+        except KeyError:
+            continue
+        # v2.4 separates multiple values with NUL
+        data = encoding_byte + null.join(encode(value) for value in values)
+        body += frame_id.encode('ascii') + _syncsafe(len(data)) + b'\0\0'
+        body += data
+
+    # MPEG-1 layer III, 128kbps, 44.1kHz, no padding: 417 byte frames
+    frame = b'\xff\xfb\x90\x00' + b'\0' * 413
+    with open(path, 'wb') as f:
+        f.write(b'ID3\4\0\0' + _syncsafe(len(body)))
+        f.write(body)
+        f.write(frame * frames)
+
+
+def file_tags(track):
+    """Convert a generated track into the tags that would be in the file.
+    """
+    tags = {
+        'ALBUM': [track['album']],
+        'ARTIST': [', '.join(track['artists'])],
+        'BPM': [str(track['bpm'])],
+        'DATE': [track['date'].strftime('%Y-%m-%d')],
+        'GENRE': track['genres'],
+        'ISRC': [track['isrc']],
+        'TITLE': [track['title']],
+        'TRACKNUMBER': ['%d/14' % track['track_number']],
+    }
+    if track['label'] is not None:
+        tags['LABEL'] = [track['label']]
+    return tags
+
+
+def generate_files(directory, nfiles, seed=0, formats=('flac', 'mp3')):
+    """Write a directory of small tagged audio files.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to write into. Files are grouped into one directory per
+        album.
+    nfiles : int
+        The number of files to write.
+    seed : int, optional
+        The random seed.
+    formats : iterable[{'flac', 'mp3'}], optional
+        The formats to cycle through.
+
+    Returns
+    -------
+    paths : list[str]
+        The paths to the files written.
+    """
+    writers = [(fmt, {'flac': write_flac, 'mp3': write_mp3}[fmt])
+               for fmt in formats]
+    paths = []
+    for n, track in enumerate(tracks(nfiles, seed)):
+        ext, write = writers[n % len(writers)]
+        album_dir = os.path.join(directory, track['album'])
+        os.makedirs(album_dir, exist_ok=True)
+        path = os.path.join(
+            album_dir,
+            '%.2d %s.%s' % (track['track_number'], track['title'], ext),
+        )
+        write(path, file_tags(track))
+        paths.append(path)
+    return paths
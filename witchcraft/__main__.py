@@ -2,7 +2,17 @@ import os
 
 import click
 
+from witchcraft.profiles import default_profile, profiles
+
 _server = False
+# the in-memory catalog used by ``serve --engine columnar``
+_catalog = None
+# the query results kept by ``serve``
+_result_cache = None
+# the in-memory copy of the database used by ``serve --engine replica``
+_replica = None
+# the albums and artists held in memory by ``serve`` for completion
+_completion_index = None
 
 _version_msg = """\
 witchcraft {version}
@@ -25,29 +35,42 @@ There is NO WARRANTY, to the extent permitted by law."""
     default=True,
     help='Print additional information while running?',
 )
+@click.option(
+    '--db-profile',
+    default=default_profile,
+    envvar='WITCHCRAFT_DB_PROFILE',
+    type=click.Choice(sorted(profiles)),
+    help='The sqlite tuning profile. bulk-load relaxes durability while'
+    ' ingesting and restores it afterwards.',
+)
 @click.pass_context
-def main(ctx, music_home, verbose):
+def main(ctx, music_home, verbose, db_profile):
     """Utilities for managing the storage of songs and albums.
     """
     os.makedirs(music_home, exist_ok=True)
     ctx.obj = {
         'music_home': music_home,
         'verbose': verbose,
+        'db_profile': db_profile,
     }
 
 
 def _connect_db(ctx):
-    import sqlalchemy as sa
-
+    from witchcraft.db import create_engine
     from witchcraft.schema import check_version, db_version, create_schema
 
     path = os.path.join(ctx.obj['music_home'], '.metadata.db')
-    eng = sa.create_engine('sqlite:///' + path)
+    eng = create_engine(path, ctx.obj['db_profile'])
     if not os.path.exists(path):
         create_schema(eng)
 
     version = check_version(eng)
     if version is not None:
+        if version < db_version:
+            ctx.fail(
+                'the database is at version %s, run `witchcraft migrate` to'
+                ' upgrade it to version %s' % (version, db_version),
+            )
         ctx.fail(
             'invalid version, witchraft=%s, db=%s' % (
                 db_version,
@@ -57,6 +80,17 @@ def _connect_db(ctx):
     return eng.connect()
 
 
+def _read_db(ctx):
+    # commands which only read are served from the replica when there is one
+    if _replica is None:
+        return _connect_db(ctx)
+
+    if _replica.swap() and _result_cache is not None:
+        # the cached results were read from the old copy
+        _result_cache.clear()
+    return _replica.connect()
+
+
 def _set_env(env):
     os.environ.update(env)
     if 'CWD' in env:
@@ -70,17 +104,107 @@ def _set_env(env):
     help='The permissions to set on the socket.',
     default=None,
 )
+@click.option(
+    '--metrics-file',
+    type=click.Path(dir_okay=False, writable=True, resolve_path=True),
+    help='Periodically write the server metrics to this file in the'
+    ' prometheus text format.',
+    default=None,
+)
+@click.option(
+    '--metrics-interval',
+    type=float,
+    help='The number of seconds between writes to --metrics-file.',
+    default=15.0,
+)
+@click.option(
+    '--engine',
+    type=click.Choice(['sql', 'columnar', 'replica']),
+    help='How to evaluate queries. columnar keeps the catalog in memory and'
+    ' refreshes it after writes instead of querying sqlite. replica runs the'
+    ' sql against an in-memory copy of the database which is copied again in'
+    ' the background after writes.',
+    default='sql',
+)
+@click.option(
+    '--replica-interval',
+    type=float,
+    help='The number of seconds between checks for writes to the database'
+    ' with --engine replica.',
+    default=1.0,
+)
+@click.option(
+    '--result-cache-size',
+    type=click.IntRange(min=0),
+    help='The number of bytes of query results to keep in memory. The cache'
+    ' is cleared whenever the database is written to. 0 disables the cache.',
+    default=2 ** 26,
+)
 @click.pass_context
-def serve(ctx, socket_permissions):
+def serve(ctx,
+          socket_permissions,
+          metrics_file,
+          metrics_interval,
+          engine,
+          replica_interval,
+          result_cache_size):
     global _server
+    global _catalog
+    global _result_cache
+    global _replica
+    global _completion_index
     _server = True
 
     import os
+    import queue
     import socket
+    import threading
+    import time
+
+    from witchcraft.metrics import registry
+
+    if engine == 'columnar':
+        from witchcraft.ql.columnar import Catalog
+
+        _catalog = Catalog(_connect_db(ctx))
+    elif engine == 'replica':
+        import sqlite3
+
+        import sqlalchemy as sa
+
+        from witchcraft.db import Replica, create_engine
+
+        # check the version before copying the database
+        _connect_db(ctx).close()
+        _replica = Replica(
+            create_engine(
+                os.path.join(ctx.obj['music_home'], '.metadata.db'),
+                ctx.obj['db_profile'],
+            ),
+            replica_interval,
+        )
+        try:
+            _replica.start()
+        except (sa.exc.DBAPIError, sqlite3.Error) as e:
+            ctx.fail('failed to copy the database into memory: %s' % e)
+
+    from witchcraft.ql.completion import CompletionIndex
+
+    _completion_index = CompletionIndex(_connect_db(ctx))
+
+    if result_cache_size:
+        from witchcraft.ql.cache import ResultCache
+
+        _result_cache = ResultCache(
+            # the replica clears the cache when it swaps in a new copy
+            _connect_db(ctx) if _replica is None else None,
+            result_cache_size,
+        )
 
     def _run(args):
         import contextlib
         import io
+        import traceback
 
         out = io.StringIO()
         err = io.StringIO()
@@ -91,9 +215,54 @@ def serve(ctx, socket_permissions):
                 main(args)
             except SystemExit as e:
                 code = e.code
+            except Exception:
+                # send the error to the client instead of stopping the server
+                traceback.print_exc()
+                code = 1
 
         return code, out.getvalue().encode(), err.getvalue().encode()
 
+    def _command_name(args):
+        return next((arg for arg in args if arg in main.commands), 'none')
+
+    def _serve_connection(conn):
+        size = int.from_bytes(conn.recv(4), 'little')
+        env_items = conn.recv(size).decode('utf-8').split('\0')
+        _set_env(dict(zip(env_items[::2], env_items[1::2])))
+
+        size = int.from_bytes(conn.recv(4), 'little')
+        data = conn.recv(size).decode('utf-8')
+        if not data:
+            args = []
+        else:
+            args = data.split('\0')
+
+        command = _command_name(args)
+        start = time.perf_counter()
+        code, out, err = _run(args)
+        registry.histogram(
+            'witchcraft_command_seconds',
+            'Time to run each command in the server.',
+            command=command,
+        ).observe(time.perf_counter() - start)
+        registry.counter(
+            'witchcraft_requests_total',
+            'Commands run by the server.',
+            command=command,
+        ).inc()
+        if code:
+            registry.counter(
+                'witchcraft_errors_total',
+                'Commands which exited with a non-zero status.',
+                command=command,
+            ).inc()
+
+        conn.send(code.to_bytes(1, 'little'))
+        conn.send(len(out).to_bytes(4, 'little'))
+        conn.send(out)
+        conn.send(len(err).to_bytes(4, 'little'))
+        conn.send(err)
+
     path = os.path.join(ctx.obj['music_home'], '.cli-server.sock')
     if os.path.exists(path):
         os.remove(path)
@@ -104,30 +273,120 @@ def serve(ctx, socket_permissions):
     if socket_permissions is not None:
         os.chmod(path, int(socket_permissions, base=8))
 
+    # Connections are accepted on a background thread so that the depth of
+    # the queue of waiting clients can be measured. Commands still run one at
+    # a time on this thread because they redirect stdout and stderr.
+    connections = queue.Queue()
+    queue_depth = registry.gauge(
+        'witchcraft_queue_depth',
+        'Connections accepted but not yet served.',
+    )
+    socket_errors = registry.counter(
+        'witchcraft_socket_errors_total',
+        'Connections which failed while reading the request or writing the'
+        ' response.',
+    )
+
+    def accept():
+        server.listen(16)
+        while True:
+            conn, addr = server.accept()
+            connections.put(conn)
+            queue_depth.set(connections.qsize())
+
+    threading.Thread(target=accept, daemon=True).start()
+
+    last_metrics_write = float('-inf')
     while True:
-        server.listen(1)
-        conn, addr = server.accept()
         try:
-            size = int.from_bytes(conn.recv(4), 'little')
-            env_items = conn.recv(size).decode('utf-8').split('\0')
-            _set_env(dict(zip(env_items[::2], env_items[1::2])))
+            conn = connections.get(timeout=metrics_interval)
+        except queue.Empty:
+            pass
+        else:
+            queue_depth.set(connections.qsize())
+            try:
+                _serve_connection(conn)
+            except OSError:
+                # the client went away, this should not take down the server
+                socket_errors.inc()
+            except Exception:
+                # a malformed request, this should not take down the server
+                import traceback
+
+                traceback.print_exc()
+                socket_errors.inc()
+            finally:
+                conn.close()
+
+        now = time.monotonic()
+        if (metrics_file is not None and
+                now - last_metrics_write >= metrics_interval):
+            registry.write_prometheus(metrics_file)
+            last_metrics_write = now
 
-            size = int.from_bytes(conn.recv(4), 'little')
-            data = conn.recv(size).decode('utf-8')
-            if not data:
-                args = []
-            else:
-                args = data.split('\0')
 
-            code, out, err = _run(args)
+@main.command()
+@click.option(
+    '--prometheus',
+    is_flag=True,
+    help='Print the metrics in the prometheus text format.',
+)
+@click.pass_context
+def stats(ctx, prometheus):
+    """Print the request counts, latencies, and cache statistics collected by
+    the server.
+    """
+    if not _server:
+        ctx.fail('stats are only collected by witchcraft serve')
+
+    from witchcraft.metrics import registry
+
+    if prometheus:
+        print(registry.format_prometheus(), end='')
+    else:
+        print(registry.format_summary())
+
+
+@main.command()
+@click.pass_context
+def migrate(ctx):
+    """Upgrade the metadata database to the current schema version.
+    """
+    from witchcraft.db import create_engine
+    from witchcraft.schema import db_version, migrate
+
+    path = os.path.join(ctx.obj['music_home'], '.metadata.db')
+    if not os.path.exists(path):
+        ctx.fail('no database at %s' % path)
+
+    with create_engine(path, ctx.obj['db_profile']).connect() as conn:
+        try:
+            old_version = migrate(conn)
+        except ValueError as e:
+            ctx.fail(str(e))
+
+    if old_version == db_version:
+        click.echo('the database is already at version %d' % db_version)
+    else:
+        click.echo('migrated the database from version %d to %d' % (
+            old_version,
+            db_version,
+        ))
 
-            conn.send(code.to_bytes(1, 'little'))
-            conn.send(len(out).to_bytes(4, 'little'))
-            conn.send(out)
-            conn.send(len(err).to_bytes(4, 'little'))
-            conn.send(err)
-        finally:
-            conn.close()
+
+@main.command('rebuild-search')
+@click.pass_context
+def rebuild_search(ctx):
+    """Rebuild the tables that queries search from the rest of the metadata.
+
+    This is kept up to date by ``ingest``; it only needs to be rebuilt after
+    the database is edited by another tool.
+    """
+    from witchcraft.schema import rebuild_track_search, rebuild_word_index
+
+    with _connect_db(ctx) as conn:
+        click.echo('rebuilt %d tracks' % rebuild_track_search(conn))
+        click.echo('rebuilt %d words' % rebuild_word_index(conn))
 
 
 @main.command()
@@ -145,8 +404,10 @@ def _select(ctx, query):
     try:
         paths = select(
             ctx.obj['music_home'],
-            _connect_db(ctx),
+            _read_db(ctx),
             ' '.join(query),
+            _catalog,
+            _result_cache,
         )
     except ValueError as e:
         ctx.fail(str(e))
@@ -176,21 +437,84 @@ def play(ctx, query):
         ctx.fail(str(e))
 
 
+def _select_page(ctx, query, page_size, cursor):
+    import sys
+
+    from witchcraft.play import select_page
+
+    try:
+        paths, cursor = select_page(
+            ctx.obj['music_home'],
+            _read_db(ctx),
+            ' '.join(query),
+            page_size,
+            cursor,
+        )
+    except ValueError as e:
+        ctx.fail(str(e))
+
+    for path in paths:
+        print(path)
+
+    if cursor is not None:
+        print(cursor, file=sys.stderr)
+
+
 @main.command()
+@click.option(
+    '--page-size',
+    type=click.IntRange(min=1),
+    help='Print at most this many paths and print a cursor for the next page'
+    ' to stderr.',
+    default=None,
+)
+@click.option(
+    '--cursor',
+    help='Print the page after the one which printed this cursor.',
+    default=None,
+)
 @click.argument('query', nargs=-1)
 @click.pass_context
-def select(ctx, query):
+def select(ctx, page_size, cursor, query):
     """Execute a witchcraft query and print the paths to all tracks that match
     the query.
     """
-    _select(ctx, query)
+    if page_size is not None:
+        _select_page(ctx, query, page_size, cursor)
+    elif cursor is not None:
+        ctx.fail('--cursor requires --page-size')
+    else:
+        _select(ctx, query)
+
+
+@main.command()
+@click.argument('query', nargs=-1)
+@click.pass_context
+def explain(ctx, query):
+    """Show how a witchcraft query is compiled and executed.
+
+    This prints the parsed query, the sql and sqlite query plan for each
+    statement, and the time spent in each phase.
+    """
+    from witchcraft.ql import explain
+
+    try:
+        explanation = explain(_read_db(ctx), ' '.join(query))
+    except ValueError as e:
+        ctx.fail(str(e))
+
+    print(explanation)
 
 
 def _complete_query(ctx, query):
     from witchcraft.ql import completions as get_completions
 
     try:
-        return get_completions(_connect_db(ctx), ' '.join(query[1:]))
+        return get_completions(
+            _read_db(ctx),
+            ' '.join(query[1:]),
+            _completion_index,
+        )
     except ValueError as e:
         ctx.fail(str(e))
 
@@ -235,7 +559,7 @@ def completions(ctx, query):
     """
     if not query:
         completions = main.commands.keys()
-    elif query[0] in ('play', 'select'):
+    elif query[0] in ('play', 'select', 'explain'):
         completions = _complete_query(ctx, query)
     elif len(query) == 1:
         completions = _complete_single(ctx, query)
@@ -341,6 +665,55 @@ def unpack_album(ctx, paths, source, album, artist):
     default=True,
     help='Ignore files that fail to parse.',
 )
+@click.option(
+    '--extension',
+    multiple=True,
+    help='A file extension to ingest from a directory, like .flac. May be'
+    ' passed more than once. Defaults to the audio formats taglib reads.',
+)
+@click.option(
+    '--exclude',
+    multiple=True,
+    help='A glob pattern for the names of files and directories to skip when'
+    " ingesting a directory, like '.*'. May be passed more than once.",
+)
+@click.option(
+    '--tag-reader',
+    default='taglib',
+    type=click.Choice(['taglib', 'header']),
+    help='How to read the tags of each file. header reads flac and mp3 tags'
+    ' from the start of the file in Python and uses taglib for anything'
+    ' else.',
+)
+@click.option(
+    '--resume',
+    is_flag=True,
+    help='Continue an ingest which was interrupted, skipping the files it'
+    ' already finished without reading them again.',
+)
+@click.option(
+    '--plan',
+    'plan_path',
+    default=None,
+    type=click.Path(dir_okay=False, writable=True),
+    help='Write what the ingest would do to this file instead of ingesting.'
+    ' The tags are read in parallel and nothing is copied or written to the'
+    ' database.',
+)
+@click.option(
+    '--apply',
+    'apply_path',
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help='Carry out a plan written by --plan. No paths may be passed.',
+)
+@click.option(
+    '--jobs',
+    default=None,
+    type=click.IntRange(min=1),
+    help='The number of processes reading tags for --plan, or files copied'
+    ' at once for --apply. Defaults to the number of cpus.',
+)
 @click.pass_context
 def ingest(ctx,
            path,
@@ -349,13 +722,109 @@ def ingest(ctx,
            title,
            track_number,
            pattern,
-           ignore_failures):
+           ignore_failures,
+           extension,
+           exclude,
+           tag_reader,
+           resume,
+           plan_path,
+           apply_path,
+           jobs):
     """Ingest a file or director into the witchcraft database.
     """
+    from witchcraft.db import bulk_load
+    from witchcraft.ingest import clear_journal
+
+    if plan_path is not None and apply_path is not None:
+        ctx.fail('cannot pass both --plan and --apply')
+
+    if plan_path is not None:
+        from witchcraft.plan import plan_ingest
+        from witchcraft.walk import audio_extensions
+
+        if any(map(os.path.isdir, path)):
+            if title is not None:
+                ctx.fail('cannot pass --title when ingesting a directory')
+
+            if track_number is not None:
+                ctx.fail(
+                    'cannot pass --track-number when ingesting a directory',
+                )
+
+        try:
+            with _connect_db(ctx) as conn:
+                plan = plan_ingest(
+                    music_home=ctx.obj['music_home'],
+                    conn=conn,
+                    paths=path,
+                    artists=artist if artist is None else artist.split(','),
+                    album=album,
+                    title=title,
+                    track_number=track_number,
+                    pattern=pattern,
+                    ignore_failures=ignore_failures,
+                    extensions=extension or audio_extensions,
+                    deny=exclude,
+                    tag_reader=tag_reader,
+                    jobs=jobs,
+                )
+        except ValueError as e:
+            ctx.fail(str(e))
+
+        plan.write(plan_path)
+        click.echo(plan.summary())
+        return
+
+    if apply_path is not None:
+        from witchcraft.plan import Plan, apply_plan
+        from witchcraft.schema import preload_entity_cache
+
+        if path:
+            ctx.fail('cannot pass paths with --apply')
+
+        try:
+            plan = Plan.read(apply_path)
+        except ValueError as e:
+            ctx.fail(str(e))
+
+        if plan.music_home != ctx.obj['music_home']:
+            ctx.fail(
+                'the plan was made for the music home %r, not %r' % (
+                    plan.music_home,
+                    ctx.obj['music_home'],
+                ),
+            )
+
+        try:
+            with _connect_db(ctx) as conn:
+                if not resume:
+                    clear_journal(conn)
+
+                with bulk_load(conn, ctx.obj['db_profile']):
+                    preload_entity_cache(conn)
+                    added = apply_plan(
+                        ctx.obj['music_home'],
+                        conn,
+                        plan,
+                        verbose=ctx.obj['verbose'],
+                        ignore_failures=ignore_failures,
+                        jobs=jobs or os.cpu_count(),
+                        resume=resume,
+                    )
+        except ValueError as e:
+            ctx.fail(str(e))
+        click.echo('added %d tracks' % added)
+        return
+
+    if not resume:
+        with _connect_db(ctx) as conn:
+            clear_journal(conn)
+
     paths = path
     for path in paths:
         if os.path.isdir(path):
             from witchcraft.ingest import ingest_recursive
+            from witchcraft.walk import audio_extensions
 
             if title is not None:
                 ctx.fail('cannot pass --title when ingesting a directory')
@@ -366,15 +835,23 @@ def ingest(ctx,
                 )
 
             def ingest(**kwargs):
+                from witchcraft.schema import preload_entity_cache
+
                 del kwargs['title']
                 del kwargs['track_number']
-                ingest_recursive(**kwargs)
+                preload_entity_cache(kwargs['conn'])
+                ingest_recursive(
+                    extensions=extension or audio_extensions,
+                    deny=exclude,
+                    **kwargs
+                )
 
         else:
             from witchcraft.ingest import ingest_file as ingest
 
         try:
-            with _connect_db(ctx) as conn:
+            with _connect_db(ctx) as conn, \
+                    bulk_load(conn, ctx.obj['db_profile']):
                 ingest(
                     music_home=ctx.obj['music_home'],
                     conn=conn,
@@ -386,6 +863,8 @@ def ingest(ctx,
                     pattern=pattern,
                     verbose=ctx.obj['verbose'],
                     ignore_failures=ignore_failures,
+                    tag_reader=tag_reader,
+                    resume=resume,
                 )
         except ValueError as e:
             ctx.fail(str(e))
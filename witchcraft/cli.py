@@ -1,9 +1,9 @@
 import os
 
 import click
-import sqlalchemy as sa
 
 from witchcraft import __version__
+from witchcraft.db import bulk_load, create_engine, default_profile, profiles
 from witchcraft.schema import check_version, db_version, create_schema
 
 
@@ -28,8 +28,16 @@ There is NO WARRANTY, to the extent permitted by law."""
     default=True,
     help='Print additional information while running?',
 )
+@click.option(
+    '--db-profile',
+    default=default_profile,
+    envvar='WITCHCRAFT_DB_PROFILE',
+    type=click.Choice(sorted(profiles)),
+    help='The sqlite tuning profile. bulk-load relaxes durability while'
+    ' ingesting and restores it afterwards.',
+)
 @click.pass_context
-def main(ctx, music_home, db_name, verbose):
+def main(ctx, music_home, db_name, verbose, db_profile):
     """Utilities for managing the storage of songs and albums.
     """
     os.makedirs(music_home, exist_ok=True)
@@ -37,12 +45,13 @@ def main(ctx, music_home, db_name, verbose):
         'music_home': music_home,
         'db_name': db_name,
         'verbose': verbose,
+        'db_profile': db_profile,
     }
 
 
 def _connect_db(ctx):
     path = os.path.join(ctx.obj['music_home'], '.witchcraft.db')
-    eng = sa.create_engine('sqlite:///' + path)
+    eng = create_engine(path, ctx.obj['db_profile'])
     if not os.path.exists(path):
         create_schema(eng)
 
@@ -262,7 +271,8 @@ def ingest(ctx, path, album, artist, title, track_number, ignore_failures):
             from witchcraft.ingest import ingest_file as ingest
 
         try:
-            with _connect_db(ctx) as conn:
+            with _connect_db(ctx) as conn, \
+                    bulk_load(conn, ctx.obj['db_profile']):
                 ingest(
                     music_home=ctx.obj['music_home'],
                     conn=conn,
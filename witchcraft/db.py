@@ -0,0 +1,243 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import sqlite3
+import threading
+import time
+
+import sqlalchemy as sa
+
+from .profiles import default_profile, profiles
+from .utils import edit_distance
+
+
+# The pragmas to apply on top of the profile while bulk loading.
+_bulk_load_pragmas = {
+    'bulk-load': OrderedDict([
+        ('synchronous', 'OFF'),
+        ('cache_size', -256 * 1024),
+    ]),
+}
+
+
+def apply_pragmas(dbapi_conn, pragmas):
+    """Apply pragmas to a raw sqlite3 connection.
+
+    Parameters
+    ----------
+    dbapi_conn : sqlite3.Connection
+        The connection to configure.
+    pragmas : mapping[str, any]
+        The pragmas to set, in order.
+    """
+    cursor = dbapi_conn.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+    finally:
+        cursor.close()
+
+
+def register_functions(dbapi_conn):
+    """Register the sql functions which compiled queries call.
+
+    Parameters
+    ----------
+    dbapi_conn : sqlite3.Connection
+        The connection to register the functions with.
+    """
+    dbapi_conn.create_function(
+        'edit_distance',
+        2,
+        edit_distance,
+        deterministic=True,
+    )
+
+
+def create_engine(path, profile=default_profile):
+    """Create an engine for the metadata db which applies a pragma profile to
+    every connection.
+
+    Parameters
+    ----------
+    path : str
+        The path to the sqlite database.
+    profile : {'safe', 'fast', 'bulk-load'}, optional
+        The name of the pragma profile to use.
+
+    Returns
+    -------
+    engine : sa.engine.Engine
+        The configured engine.
+
+    Raises
+    ------
+    ValueError
+        Raised when ``profile`` is not a known profile.
+    """
+    try:
+        pragmas = profiles[profile]
+    except KeyError:
+        raise ValueError('unknown db profile: %r' % profile)
+
+    engine = sa.create_engine('sqlite:///' + path)
+
+    @sa.event.listens_for(engine, 'connect')
+    def on_connect(dbapi_conn, connection_record):
+        apply_pragmas(dbapi_conn, pragmas)
+        register_functions(dbapi_conn)
+
+    return engine
+
+
+@contextmanager
+def bulk_load(conn, profile):
+    """Relax the durability of a connection for the duration of a large
+    ingest.
+
+    Parameters
+    ----------
+    conn : sa.Connection
+        The connection doing the ingest.
+    profile : str
+        The profile the connection was created with. This is a no-op unless
+        the profile is ``'bulk-load'``.
+
+    Notes
+    -----
+    When the block exits, the profile's pragmas are restored and the write
+    ahead log is checkpointed so that the bulk of the data is in the main
+    database file.
+    """
+    pragmas = _bulk_load_pragmas.get(profile)
+    if pragmas is None:
+        yield
+        return
+
+    dbapi_conn = conn.connection
+    apply_pragmas(dbapi_conn, pragmas)
+    try:
+        yield
+    finally:
+        apply_pragmas(dbapi_conn, profiles[profile])
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+def _memory_engine():
+    # the copy is made on the refresh thread and read on the serving thread
+    dbapi_conn = sqlite3.connect(':memory:', check_same_thread=False)
+    register_functions(dbapi_conn)
+    return dbapi_conn, sa.create_engine(
+        'sqlite://',
+        creator=lambda: dbapi_conn,
+        poolclass=sa.pool.StaticPool,
+    )
+
+
+class Replica:
+    """An in-memory copy of the metadata db which is refreshed in the
+    background.
+
+    Parameters
+    ----------
+    engine : sa.engine.Engine
+        The engine for the database on disk.
+    interval : float, optional
+        The number of seconds between checks for writes to the database.
+
+    Notes
+    -----
+    A background thread polls ``PRAGMA data_version`` on its own connection
+    to the database on disk. When the version changes, the whole database is
+    copied into a new ``:memory:`` database with the sqlite online backup
+    api. The new copy is only put in place by :meth:`swap`, which is called
+    by the thread that reads from the replica, so a reader never sees a copy
+    change underneath it.
+    """
+    def __init__(self, engine, interval=1.0):
+        self._source = engine
+        self.interval = interval
+        self._engine = None
+        self._pending = None
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        # the error from the first copy, raised by ``start``
+        self._error = None
+
+    def _copy(self, source):
+        dbapi_conn, engine = _memory_engine()
+        # ``backup`` copies every page in one step so the copy is a
+        # consistent snapshot even while an ingest is writing
+        source.connection.connection.backup(dbapi_conn)
+        return engine
+
+    def _run(self):
+        data_version = None
+        try:
+            source = self._source.connect()
+        except Exception as e:
+            self._error = e
+            self._loaded.set()
+            return
+
+        with source:
+            while True:
+                try:
+                    new_data_version = source.scalar('PRAGMA data_version')
+                    if new_data_version != data_version:
+                        engine = self._copy(source)
+                        with self._lock:
+                            self._pending = engine
+                        data_version = new_data_version
+                        self._loaded.set()
+                except (sa.exc.DBAPIError, sqlite3.Error) as e:
+                    if not self._loaded.is_set():
+                        # there is no copy to serve, let ``start`` raise
+                        self._error = e
+                        self._loaded.set()
+                        return
+                    # the database may be locked by a long write, try again
+                    # on the next check
+                time.sleep(self.interval)
+
+    def start(self):
+        """Load the first copy and start refreshing it in the background.
+
+        Raises
+        ------
+        sa.exc.DBAPIError, sqlite3.Error
+            Raised when the first copy cannot be made. Later copies which fail
+            are retried on the next check.
+        """
+        threading.Thread(target=self._run, daemon=True).start()
+        self._loaded.wait()
+        if self._error is not None:
+            raise self._error
+        self.swap()
+
+    def swap(self):
+        """Put the latest copy of the database in place.
+
+        Returns
+        -------
+        swapped : bool
+            Whether there was a new copy to put in place.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, None
+        if pending is None:
+            return False
+
+        # the old copy is closed when the last connection to it is garbage
+        # collected
+        self._engine = pending
+        return True
+
+    def connect(self):
+        """Connect to the current copy of the database.
+
+        Returns
+        -------
+        conn : sa.engine.Connection
+            A connection to the in-memory copy.
+        """
+        return self._engine.connect()
@@ -0,0 +1,255 @@
+"""A pure Python reader for the tags at the start of flac and mp3 files.
+
+Ingest only needs a handful of text tags, and in flac and mp3 files those are
+stored in the first few kilobytes: the vorbis comment block of a flac file
+and the id3v2 tag at the front of an mp3. :func:`read_header_tags` reads a
+bounded prefix of the file and decodes the tags out of a ``memoryview``
+without copying the rest of the file or parsing the audio stream.
+
+Only the text tags are read; id3 frames which are not text, like comments
+and cover art, are skipped. Anything this does not handle, like compressed id3
+frames or other formats, returns None so that the caller can fall back to
+taglib.
+"""
+import os
+import struct
+
+# the number of bytes read from the start of the file; tags which extend past
+# this are read with one more bounded read
+_prefix_size = 2 ** 16
+
+# the upper bound on a block or tag that will be read, larger sizes are
+# treated as a corrupt file
+_max_tag_size = 2 ** 24
+
+_flac_vorbis_comment = 4
+
+# id3v2 frame ids to the keys taglib uses for them
+_id3_keys = {
+    'TALB': 'ALBUM',
+    'TBPM': 'BPM',
+    'TCON': 'GENRE',
+    'TDRC': 'DATE',
+    'TIT2': 'TITLE',
+    'TPE1': 'ARTIST',
+    'TPE2': 'ALBUMARTIST',
+    'TPOS': 'DISCNUMBER',
+    'TPUB': 'LABEL',
+    'TRCK': 'TRACKNUMBER',
+    'TSRC': 'ISRC',
+}
+
+# id3v2 text encodings
+_id3_encodings = {
+    0: 'latin-1',
+    1: 'utf-16',
+    2: 'utf-16-be',
+    3: 'utf-8',
+}
+
+
+class _Reader:
+    """Read byte ranges of a file through a prefix which was read up front.
+    """
+    def __init__(self, f):
+        self._f = f
+        self._prefix = memoryview(f.read(_prefix_size))
+
+    def read(self, offset, size):
+        end = offset + size
+        if end <= len(self._prefix):
+            return self._prefix[offset:end]
+        if size > _max_tag_size:
+            raise ValueError('tag too large: %d bytes' % size)
+        self._f.seek(offset)
+        data = memoryview(self._f.read(size))
+        if len(data) != size:
+            raise ValueError('file truncated')
+        return data
+
+
+def _add(tags, key, value):
+    tags.setdefault(key, []).append(value)
+
+
+def _read_flac(reader):
+    offset = 4
+    while True:
+        header = reader.read(offset, 4)
+        last = header[0] & 0x80
+        type_ = header[0] & 0x7f
+        size = int.from_bytes(header[1:], 'big')
+        offset += 4
+        if type_ == _flac_vorbis_comment:
+            return _vorbis_comments(reader.read(offset, size))
+        if last:
+            return {}
+        offset += size
+
+
+def _vorbis_comments(view):
+    vendor_size, = struct.unpack_from('<I', view, 0)
+    offset = 4 + vendor_size
+    count, = struct.unpack_from('<I', view, offset)
+    offset += 4
+
+    tags = {}
+    for _ in range(count):
+        size, = struct.unpack_from('<I', view, offset)
+        offset += 4
+        comment = bytes(view[offset:offset + size]).decode('utf-8')
+        offset += size
+        key, sep, value = comment.partition('=')
+        if sep:
+            _add(tags, key.upper(), value)
+    return tags
+
+
+def _syncsafe(view):
+    return (
+        (view[0] << 21) |
+        (view[1] << 14) |
+        (view[2] << 7) |
+        view[3]
+    )
+
+
+def _decode_text(view):
+    encoding = _id3_encodings.get(view[0])
+    if encoding is None:
+        raise ValueError('unknown id3 text encoding: %d' % view[0])
+    data = bytes(view[1:])
+    if view[0] != 1:
+        # id3v2.4 separates multiple values with a null, and some writers end
+        # the text with one
+        return data.decode(encoding).split('\0')
+
+    # each utf-16 value starts with its own byte order mark, so the values
+    # are split on a null code unit and decoded separately
+    values = []
+    start = 0
+    end = data.find(b'\0\0')
+    while end != -1:
+        if (end - start) % 2:
+            # the second byte of a code unit and the first byte of the next
+            end = data.find(b'\0\0', end + 1)
+            continue
+        values.append(data[start:end].decode(encoding))
+        start = end + 2
+        end = data.find(b'\0\0', start)
+    values.append(data[start:].decode(encoding))
+    return values
+
+
+def _read_id3v2(reader):
+    header = reader.read(0, 10)
+    version = header[3]
+    flags = header[5]
+    if version not in (3, 4) or flags & 0x80:
+        # id3v2.2 frames and unsynchronized tags are left to taglib
+        return None
+    end = 10 + _syncsafe(header[6:10])
+    tag = reader.read(0, end)
+
+    offset = 10
+    if flags & 0x40:
+        # skip the extended header; v2.4 includes the size field in the size
+        size = _syncsafe(tag[offset:offset + 4])
+        offset += size if version == 4 else size + 4
+
+    tags = {}
+    years = []
+    while offset + 10 <= end:
+        frame_id = bytes(tag[offset:offset + 4])
+        if frame_id[0] == 0:
+            # padding
+            break
+        frame_id = frame_id.decode('ascii')
+        if version == 4:
+            size = _syncsafe(tag[offset + 4:offset + 8])
+        else:
+            size, = struct.unpack_from('>I', tag, offset + 4)
+        format_flags = tag[offset + 9]
+        data = tag[offset + 10:offset + 10 + size]
+        offset += 10 + size
+
+        if frame_id[0] != 'T':
+            continue
+
+        if version == 4:
+            if format_flags & 0x0e:
+                # compressed, encrypted, or unsynchronized
+                return None
+            if format_flags & 0x01:
+                # the data length indicator
+                data = data[4:]
+        elif format_flags & 0xc0:
+            # compressed or encrypted
+            return None
+
+        values = _decode_text(data)
+        if frame_id == 'TXXX':
+            key, *values = values
+            key = key.upper()
+        elif frame_id == 'TYER':
+            # id3v2.3 stores the year in its own frame, which some writers
+            # keep next to TDRC
+            years.extend(values)
+            continue
+        else:
+            key = _id3_keys.get(frame_id)
+            if key is None:
+                continue
+
+        for value in values:
+            if value:
+                _add(tags, key, value)
+
+    if 'DATE' not in tags:
+        for year in years:
+            if year:
+                _add(tags, 'DATE', year)
+    return tags
+
+
+# extension -> (magic, reader)
+_formats = {
+    '.flac': (b'fLaC', _read_flac),
+    '.mp3': (b'ID3', _read_id3v2),
+}
+
+
+def read_header_tags(path):
+    """Read the tags of a flac or mp3 file from the start of the file.
+
+    Parameters
+    ----------
+    path : str
+        The path to the file.
+
+    Returns
+    -------
+    tags : dict[str, list[str]] or None
+        The tags keyed by upper case name, like ``taglib.File(path).tags``,
+        or None if the file is not a flac file or an mp3 with an id3v2.3 or
+        id3v2.4 tag that this can read.
+
+    Raises
+    ------
+    OSError
+        Raised when the file cannot be read.
+    """
+    try:
+        magic, read = _formats[os.path.splitext(path)[1].lower()]
+    except KeyError:
+        return None
+
+    with open(path, 'rb') as f:
+        reader = _Reader(f)
+        try:
+            if reader.read(0, len(magic)) != magic:
+                return None
+            return read(reader)
+        except (IndexError, UnicodeDecodeError, ValueError, struct.error):
+            # a tag this does not understand, taglib may do better
+            return None
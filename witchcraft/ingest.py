@@ -1,19 +1,15 @@
-from itertools import chain
 import os
 import re
 import shutil
 
 import click
-import dateutil.parser
-import taglib
+import sqlalchemy as sa
 
 from . import schema
-from .utils import (
-    normalize,
-    normalize_genre,
-    normalize_track_number,
-    normalize_artist,
-)
+from .metrics import registry
+from .tags import default_tag_reader, read_tags
+from .utils import normalize
+from .walk import audio_extensions, walk_audio_files
 
 
 def log_writing_file(verbose, path, track_id):
@@ -31,23 +27,94 @@ def log_skipping_write(verbose, path, track_id):
         )
 
 
-def _exactly_one_tag(tags, key, *, optional, normalize=normalize):
-    if optional:
-        values = tags.get(key)
-    else:
-        try:
-            values = tags[key]
-        except KeyError:
-            raise KeyError('file tags missing required key %r' % key)
+def log_skipping_resume(verbose, path):
+    if verbose:
+        click.echo(
+            'not reading %r because the last ingest committed it' % path,
+        )
+
+
+# the suffix of a copy which has not been renamed into place
+_partial_suffix = '.partial'
+
+
+def _copy_atomic(path, new_path):
+    """Copy a file so that ``new_path`` is either missing or complete, even
+    if the process dies partway through.
+    """
+    partial = new_path + _partial_suffix
+    shutil.copy(path, partial)
+    with open(partial, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(partial, new_path)
 
-    if values is None:
-        return None
 
-    if len(values) != 1:
+def _track_at(conn, track_db_path):
+    """The id of the track stored at a path relative to the music home, or
+    None if no track is stored there.
+    """
+    return conn.scalar(
+        sa.select((schema.tracks.c.id,)).where(
+            schema.tracks.c.path == track_db_path,
+        ).limit(1),
+    )
+
+
+def _check_destination(conn, music_home, path, track_db_path):
+    """Raise when a new track would be stored at the path of an existing
+    track, like ``01 foo`` and track 1 of ``foo`` on the same album. The copy
+    would replace the other track's file.
+    """
+    if not os.path.exists(os.path.join(music_home, track_db_path)):
+        # ``tracks.path`` is not indexed, so only look for the owner of a
+        # file which is already there
+        return
+
+    track_id = _track_at(conn, track_db_path)
+    if track_id is not None:
         raise ValueError(
-            'track may only have one %s, got: %r' % (key.lower(), values),
+            '%r would replace %r, the file of track %d' % (
+                path,
+                track_db_path,
+                track_id,
+            ),
         )
-    return normalize(values[0])
+
+
+def _remove_unreferenced_copy(conn, new_path, track_db_path):
+    """Remove a copy made for a track which turned out to be a duplicate,
+    unless it replaced the file of a track with the same path.
+    """
+    if (_track_at(conn, track_db_path) is None and
+            os.path.exists(new_path)):
+        os.remove(new_path)
+
+
+# an entry replaces the last one for the same source
+_journal_insert = schema.ingest_journal.insert().prefix_with('OR REPLACE')
+
+
+def _journal(conn, source, state, path, track_id=None):
+    conn.execute(
+        _journal_insert,
+        {
+            'source': source,
+            'state': state,
+            'path': path,
+            'track_id': track_id,
+        },
+    )
+
+
+def clear_journal(conn):
+    """Forget the progress of the last ingest.
+
+    Parameters
+    ----------
+    conn : sa.Connection
+        The connection to the metadata db.
+    """
+    conn.execute(schema.ingest_journal.delete())
 
 
 def _album_dir(music_home, album, artist):
@@ -102,23 +169,28 @@ def _get_group_or_override(match, name, override):
         return override
 
 
-def _inner_ingest_file(music_home,
-                       conn,
-                       path,
-                       album,
-                       artists,
-                       title,
-                       track_number,
-                       pattern,
-                       verbose):
-    """Helper for ``ignore_failures``.
+def tag_overrides(path, pattern, album, artists, title, track_number):
+    """Apply the groups of ``--pattern`` to the tags given on the command
+    line.
 
-    See Also
-    --------
-    ingest_file
-    """
-    tags = taglib.File(path).tags
+    Parameters
+    ----------
+    path : str
+        The path to the file.
+    pattern : str or None
+        The regular expression to match against the path.
+    album, title : str or None
+        The album and title given on the command line.
+    artists : list[str] or None
+        The artists given on the command line.
+    track_number : int or None
+        The track number given on the command line.
 
+    Returns
+    -------
+    overrides : dict[str, any]
+        The overrides to pass to :func:`witchcraft.tags.read_tags`.
+    """
     if pattern is not None:
         match = re.match(pattern, str(path))
         if match is not None:
@@ -137,63 +209,134 @@ def _inner_ingest_file(music_home,
                 except ValueError:
                     raise ValueError('track number must be an integer')
 
-    if album is None:
-        album = _exactly_one_tag(tags, 'ALBUM', optional=False)
-    if artists is None:
-        artists = list(chain.from_iterable(map(
-            normalize_artist,
-            tags['ARTIST'],
-        )))
-    if title is None:
-        title = _exactly_one_tag(tags, 'TITLE', optional=False)
-
-    if track_number is None:
-        track_number = _exactly_one_tag(
-            tags,
-            'TRACKNUMBER',
-            optional=True,
-            normalize=normalize_track_number,
-        )
+    return {
+        'album': album,
+        'artists': artists,
+        'title': title,
+        'track_number': track_number,
+    }
+
+
+def track_destination(music_home, path, tags):
+    """The path where a track will be stored.
+
+    Parameters
+    ----------
+    music_home : str
+        The root directory for witchcraft.
+    path : str
+        The path to the file being ingested.
+    tags : TrackTags
+        The file's decoded tags.
 
-    if track_number is not None:
-        file_name = '%.2d-%s' % (track_number, title)
+    Returns
+    -------
+    new_path : str
+        The path to store the track at.
+    """
+    if tags.track_number is not None:
+        file_name = '%.2d-%s' % (tags.track_number, tags.title)
     else:
-        file_name = title
+        file_name = tags.title
 
-    new_path = '%s%s' % (
+    return '%s%s' % (
         os.path.join(
-            ensure_album_dir(music_home, album, artists[0]),
+            _album_dir(music_home, tags.album, tags.artists[0]),
             file_name,
         ),
         os.path.splitext(path)[1],
     )
+
+
+def _inner_ingest_file(music_home,
+                       conn,
+                       path,
+                       album,
+                       artists,
+                       title,
+                       track_number,
+                       pattern,
+                       verbose,
+                       tag_reader,
+                       resume):
+    """Helper for ``ignore_failures``.
+
+    See Also
+    --------
+    ingest_file
+    """
+    source = os.path.abspath(path)
+    state = None
+    if resume:
+        state = conn.scalar(
+            sa.select((schema.ingest_journal.c.state,)).where(
+                schema.ingest_journal.c.source == source,
+            ),
+        )
+        if state == 'committed':
+            log_skipping_resume(verbose, path)
+            return
+
+    tags = read_tags(
+        path,
+        tag_reader,
+        **tag_overrides(path, pattern, album, artists, title, track_number)
+    )
+
+    ensure_album_dir(music_home, tags.album, tags.artists[0])
+    new_path = track_destination(music_home, path, tags)
     # store songs with a relative path; this makes a library relocatable
     # more easily
     track_db_path = os.path.relpath(new_path, music_home)
 
-    track_id, added_new_track = schema.ensure_track(
-        conn=conn,
-        path=track_db_path,
-        album=album,
-        artists=artists,
-        bpm=_exactly_one_tag(tags, 'BPM', optional=True, normalize=int),
-        date=_exactly_one_tag(
-            tags,
-            'DATE',
-            optional=True,
-            normalize=dateutil.parser.parse,
-        ),
-        filetype=_exactly_one_tag(tags, 'FILETYPE', optional=True),
-        genres=list(map(normalize_genre, tags.get('GENRES', []))),
-        isrc=_exactly_one_tag(tags, 'ISRC', optional=True),
-        label=_exactly_one_tag(tags, 'LABEL', optional=True),
-        title=title,
-        track_number=track_number,
-    )
+    # The copy is made before the track is added so that the database never
+    # points at a file which is not in the music home. A crash after the copy
+    # leaves an unreferenced file which a resumed ingest reuses.
+    with registry.timer('ingest.db'):
+        track_id = schema.find_track(
+            conn,
+            tags.title,
+            tags.album,
+            tags.artists,
+        )
+        if track_id is not None:
+            _journal(conn, source, 'committed', None, track_id)
+            log_skipping_write(verbose, path, track_id)
+            return
+
+        _check_destination(conn, music_home, path, track_db_path)
+        if state != 'copied':
+            _journal(conn, source, 'planned', track_db_path)
+
+    if state != 'copied' or not os.path.exists(new_path):
+        with registry.timer('ingest.copy'):
+            _copy_atomic(path, new_path)
+        _journal(conn, source, 'copied', track_db_path)
+
+    try:
+        with registry.timer('ingest.db'), conn.begin():
+            track_id, added_new_track = schema.ensure_track(
+                conn=conn,
+                path=track_db_path,
+                **tags._asdict()
+            )
+            if not added_new_track:
+                # another ingest added the track after it was looked up
+                _remove_unreferenced_copy(conn, new_path, track_db_path)
+            _journal(
+                conn,
+                source,
+                'committed',
+                track_db_path if added_new_track else None,
+                track_id,
+            )
+    except Exception:
+        # the journal still says copied; a resumed ingest copies it again
+        _remove_unreferenced_copy(conn, new_path, track_db_path)
+        raise
+
     if added_new_track:
         log_writing_file(verbose, new_path, track_id)
-        shutil.copy(path, new_path)
-
     else:
         log_skipping_write(verbose, path, track_id)
 
@@ -208,7 +351,9 @@ def ingest_file(music_home,
                 pattern=None,
                 *,
                 verbose,
-                ignore_failures):
+                ignore_failures,
+                tag_reader=default_tag_reader,
+                resume=False):
     """Ignest a file into the witchcraft database.
 
     Parameters
@@ -244,6 +389,17 @@ def ingest_file(music_home,
         Should extra information be printed
     ignore_failures : bool
         Should failures be ignored? If verbose, these will be logged.
+    tag_reader : str, optional
+        The name of the tag reader to use, see
+        :data:`witchcraft.tags.tag_readers`.
+    resume : bool, optional
+        Skip the file without reading it if the last ingest committed it,
+        and reuse its copy if the last ingest copied it.
+
+    Notes
+    -----
+    The progress through each file is recorded in the ingest journal. The
+    journal is only read when resuming, see :func:`clear_journal`.
     """
     try:
         _inner_ingest_file(
@@ -256,6 +412,8 @@ def ingest_file(music_home,
             track_number,
             pattern,
             verbose,
+            tag_reader,
+            resume,
         )
     except Exception as e:
         if not ignore_failures:
@@ -272,7 +430,11 @@ def ingest_recursive(music_home,
                      pattern=None,
                      *,
                      verbose,
-                     ignore_failures):
+                     ignore_failures,
+                     extensions=audio_extensions,
+                     deny=(),
+                     tag_reader=default_tag_reader,
+                     resume=False):
     """Recursivly travel a directory and ingest all taggable files.
 
     Parameters
@@ -302,31 +464,40 @@ def ingest_recursive(music_home,
         Should extra information be printed?
     ignore_failures : bool
         Should failures be ignored? If verbose, these will be logged.
+    extensions : iterable[str], optional
+        The file extensions to ingest. If None, every file which starts like
+        an audio file is ingested.
+    deny : iterable[str], optional
+        Glob patterns for the names of files and directories to skip.
+    tag_reader : str, optional
+        The name of the tag reader to use, see
+        :data:`witchcraft.tags.tag_readers`.
+    resume : bool, optional
+        Skip the files which the last ingest committed.
+
+    See Also
+    --------
+    witchcraft.walk.walk_audio_files
     """
-    for direntry in os.scandir(path):
-        if direntry.is_dir():
-            ingest_recursive(
-                music_home,
-                conn,
-                direntry.path,
-                album=album,
-                artists=artists,
-                pattern=pattern,
-                verbose=verbose,
-                ignore_failures=ignore_failures,
-            )
-        try:
-            taglib.File(direntry.path)
-        except OSError:
-            continue
+    def onerror(e):
+        if not ignore_failures:
+            raise e
+        if verbose:
+            click.echo('failed to read %r: %s, continuing' % (e.filename, e))
 
+    for audio_path in walk_audio_files(path,
+                                       extensions=extensions,
+                                       deny=deny,
+                                       onerror=onerror):
         ingest_file(
             music_home,
             conn,
-            direntry.path,
+            audio_path,
             album=album,
             artists=artists,
             pattern=pattern,
             verbose=verbose,
             ignore_failures=ignore_failures,
+            tag_reader=tag_reader,
+            resume=resume,
         )
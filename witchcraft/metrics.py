@@ -0,0 +1,223 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+from time import perf_counter
+
+
+# Histogram bucket upper bounds in seconds: 10us to about 10s, doubling.
+default_buckets = tuple(1e-5 * 2 ** n for n in range(21))
+
+
+def _format_labels(labels, **extra):
+    items = list(labels) + sorted(extra.items())
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % item for item in items)
+
+
+class Counter:
+    """A monotonically increasing count.
+    """
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name, labels):
+        yield name + _format_labels(labels), self.value
+
+
+class Gauge:
+    """A value which may go up or down.
+    """
+    kind = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        yield name + _format_labels(labels), self.value
+
+
+class Histogram:
+    """A distribution of observations in fixed buckets.
+
+    Parameters
+    ----------
+    buckets : tuple[float]
+        The sorted upper bounds of the buckets.
+    """
+    kind = 'histogram'
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        # the last count is for observations larger than every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket which holds
+        it.
+        """
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def samples(self, name, labels):
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            yield (
+                name + '_bucket' + _format_labels(labels, le='%g' % bound),
+                seen,
+            )
+        yield name + '_bucket' + _format_labels(labels, le='+Inf'), self.count
+        yield name + '_sum' + _format_labels(labels), self.sum
+        yield name + '_count' + _format_labels(labels), self.count
+
+
+class Registry:
+    """A collection of named metrics.
+
+    Metrics are identified by a name and a set of labels. Asking for the same
+    name and labels twice returns the same metric, so hot paths should look
+    their metrics up once and hold onto them.
+    """
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._help = {}
+
+    def _get(self, cls, name, help, labels):
+        key = name, tuple(sorted(labels.items()))
+        try:
+            return self._metrics[key]
+        except KeyError:
+            metric = self._metrics[key] = cls()
+            if help is not None:
+                self._help[name] = help
+            return metric
+
+    def counter(self, name, help=None, **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help=None, **labels):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help=None, **labels):
+        return self._get(Histogram, name, help, labels)
+
+    def phase(self, phase):
+        """Get the histogram for one phase of a command.
+
+        Parameters
+        ----------
+        phase : str
+            The name of the phase, like ``'query.compile'``.
+
+        Returns
+        -------
+        histogram : Histogram
+            The histogram of the time spent in the phase in seconds.
+        """
+        return self.histogram(
+            'witchcraft_phase_seconds',
+            'Time spent in each phase of a command.',
+            phase=phase,
+        )
+
+    @contextmanager
+    def timer(self, phase):
+        """Time a block and record it in the histogram for ``phase``.
+        """
+        histogram = self.phase(phase)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(perf_counter() - start)
+
+    def format_prometheus(self):
+        """Format the metrics in the prometheus text exposition format.
+
+        Returns
+        -------
+        text : str
+            The formatted metrics.
+        """
+        lines = []
+        typed = set()
+        for (name, labels), metric in self._metrics.items():
+            if name not in typed:
+                typed.add(name)
+                if name in self._help:
+                    lines.append('# HELP %s %s' % (name, self._help[name]))
+                lines.append('# TYPE %s %s' % (name, metric.kind))
+            for sample, value in metric.samples(name, labels):
+                lines.append('%s %s' % (sample, value))
+        return '\n'.join(lines) + '\n'
+
+    def format_summary(self):
+        """Format the metrics as a human readable table.
+
+        Returns
+        -------
+        text : str
+            The formatted metrics. Histograms show their count, mean, and
+            estimated median and 99th percentile in milliseconds.
+        """
+        lines = []
+        for (name, labels), metric in self._metrics.items():
+            label = name + _format_labels(labels)
+            if isinstance(metric, Histogram):
+                lines.append(
+                    '%-60s n=%-8d mean=%.3fms p50<=%.3fms p99<=%.3fms' % (
+                        label,
+                        metric.count,
+                        metric.sum / metric.count * 1e3
+                        if metric.count else 0.0,
+                        metric.quantile(0.5) * 1e3,
+                        metric.quantile(0.99) * 1e3,
+                    ),
+                )
+            else:
+                lines.append('%-60s %s' % (label, metric.value))
+        return '\n'.join(lines)
+
+    def write_prometheus(self, path):
+        """Atomically write the metrics to a file for the prometheus node
+        exporter's textfile collector.
+
+        Parameters
+        ----------
+        path : str
+            The path to write to.
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.format_prometheus())
+        os.replace(tmp, path)
+
+
+# The metrics for this process. These are only reported by
+# ``witchcraft serve``, but are always collected because it costs about a
+# microsecond per observation.
+registry = Registry()
@@ -0,0 +1,630 @@
+"""Plan an ingest without changing anything, then apply the plan.
+
+``ingest --plan`` reads the tags of every file in parallel and decides what
+ingest would do with each one: add it as a new track, skip it as a duplicate,
+or fail to read it. The decisions, destination paths, and sizes are written to
+a plan file which can be inspected before ``ingest --apply`` carries it out.
+Applying a plan copies each batch of files with a bounded number of threads
+and adds the batch's tracks in one transaction.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import datetime
+from functools import partial
+import json
+import os
+
+import click
+import sqlalchemy as sa
+
+from . import schema
+from .ingest import (
+    _check_destination,
+    _copy_atomic,
+    _journal_insert,
+    _remove_unreferenced_copy,
+    ensure_album_dir,
+    log_skipping_write,
+    log_writing_file,
+    tag_overrides,
+    track_destination,
+)
+from .tags import TrackTags, default_tag_reader, read_tags
+from .walk import audio_extensions, walk_audio_files
+
+# the version of the plan file format
+plan_version = 1
+
+# the number of tracks added in each transaction by ``apply_plan``
+default_batch_size = 256
+
+
+class Action:
+    """What ingest will do with one file.
+
+    Parameters
+    ----------
+    kind : {'add', 'skip', 'fail'}
+        Add the file as a new track, skip it because the track is already in
+        the database or earlier in the plan, or skip it because its tags could
+        not be read.
+    source : str
+        The absolute path to the file.
+    path : str or None
+        For ``add``, the path of the copy relative to the music home.
+    size : int or None
+        For ``add``, the number of bytes to copy.
+    detail : str or None
+        For ``skip``, what the file duplicates; for ``fail``, the error.
+    tags : TrackTags or None
+        For ``add``, the decoded tags.
+    """
+    columns = ('kind', 'source', 'path', 'size', 'detail', 'tags')
+
+    def __init__(self, kind, source, path=None, size=None, detail=None,
+                 tags=None):
+        self.kind = kind
+        self.source = source
+        self.path = path
+        self.size = size
+        self.detail = detail
+        self.tags = tags
+
+    def to_row(self):
+        tags = self.tags
+        if tags is not None:
+            tags = list(tags)
+            date = tags[TrackTags._fields.index('date')]
+            if date is not None:
+                tags[TrackTags._fields.index('date')] = date.isoformat()
+        return [
+            self.kind,
+            self.source,
+            self.path,
+            self.size,
+            self.detail,
+            tags,
+        ]
+
+    @classmethod
+    def from_row(cls, row):
+        kind, source, path, size, detail, tags = row
+        if tags is not None:
+            tags = TrackTags(*tags)
+            if tags.date is not None:
+                tags = tags._replace(
+                    date=datetime.datetime.fromisoformat(tags.date),
+                )
+        return cls(kind, source, path, size, detail, tags)
+
+
+class Plan:
+    """The actions an ingest will take.
+
+    Parameters
+    ----------
+    music_home : str
+        The music home the plan was made for.
+    actions : list[Action]
+        The action for each file, in the order they will be applied.
+    """
+    def __init__(self, music_home, actions):
+        self.music_home = music_home
+        self.actions = actions
+
+    def counts(self):
+        """The number of files for each kind of action.
+
+        Returns
+        -------
+        counts : dict[str, int]
+            The counts for ``add``, ``skip``, and ``fail``.
+        """
+        counts = dict.fromkeys(('add', 'skip', 'fail'), 0)
+        for action in self.actions:
+            counts[action.kind] += 1
+        return counts
+
+    @property
+    def nbytes(self):
+        """The number of bytes that will be copied.
+        """
+        return sum(
+            action.size for action in self.actions if action.kind == 'add'
+        )
+
+    def summary(self):
+        """Describe the plan for the command line.
+
+        Returns
+        -------
+        summary : str
+            The number of tracks to add, skip, and which failed, and the size
+            of the files to copy.
+        """
+        counts = self.counts()
+        return (
+            '%d new tracks, %d duplicates skipped, %d failures,'
+            ' %.1f MiB to copy' % (
+                counts['add'],
+                counts['skip'],
+                counts['fail'],
+                self.nbytes / 2 ** 20,
+            )
+        )
+
+    def write(self, path):
+        """Write the plan to a file.
+
+        Parameters
+        ----------
+        path : str
+            The path to write to.
+        """
+        with open(path, 'w') as f:
+            json.dump(
+                {
+                    'version': plan_version,
+                    'music_home': self.music_home,
+                    'columns': Action.columns,
+                    'actions': [action.to_row() for action in self.actions],
+                },
+                f,
+                separators=(',', ':'),
+            )
+
+    @classmethod
+    def read(cls, path):
+        """Read a plan written by :meth:`write`.
+
+        Parameters
+        ----------
+        path : str
+            The path to read.
+
+        Returns
+        -------
+        plan : Plan
+            The plan.
+
+        Raises
+        ------
+        ValueError
+            Raised when the file is not a plan this version can read.
+        """
+        with open(path) as f:
+            try:
+                data = json.load(f)
+            except ValueError:
+                raise ValueError('%s is not an ingest plan' % path)
+
+        if data.get('version') != plan_version:
+            raise ValueError(
+                'cannot read version %r ingest plans, expected version %d' % (
+                    data.get('version'),
+                    plan_version,
+                ),
+            )
+        return cls(
+            data['music_home'],
+            [Action.from_row(row) for row in data['actions']],
+        )
+
+
+def _sources(paths, extensions, deny, onerror):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from walk_audio_files(
+                path,
+                extensions=extensions,
+                deny=deny,
+                onerror=onerror,
+            )
+        else:
+            yield path
+
+
+def _read_tags(job):
+    # run in the worker processes; errors are returned so that one bad file
+    # does not stop the plan
+    path, tag_reader, overrides = job
+    try:
+        return read_tags(path, tag_reader, **overrides), None
+    except Exception as e:
+        return None, str(e)
+
+
+def plan_ingest(music_home,
+                conn,
+                paths,
+                album=None,
+                artists=None,
+                title=None,
+                track_number=None,
+                pattern=None,
+                *,
+                ignore_failures,
+                extensions=audio_extensions,
+                deny=(),
+                tag_reader=default_tag_reader,
+                jobs=None):
+    """Decide what ingesting some files would do without changing anything.
+
+    Parameters
+    ----------
+    music_home : str
+        The root directory for witchcraft music.
+    conn : sa.Connection
+        The connection to the metadata db. This is only read.
+    paths : iterable[str]
+        The files and directories to ingest.
+    album, artists, title, track_number, pattern
+        The overrides for the tags, see
+        :func:`witchcraft.ingest.ingest_file`.
+    ignore_failures : bool
+        Record files whose tags cannot be read as ``fail`` actions instead of
+        raising.
+    extensions, deny
+        How to filter the files in directories, see
+        :func:`witchcraft.walk.walk_audio_files`.
+    tag_reader : str, optional
+        The name of the tag reader to use.
+    jobs : int, optional
+        The number of processes which read tags. Defaults to the number of
+        cpus.
+
+    Returns
+    -------
+    plan : Plan
+        The plan.
+
+    Raises
+    ------
+    ValueError
+        Raised when a file's tags cannot be read, or it would be stored at
+        the path of another track, and ``ignore_failures`` is False.
+    """
+    actions = []
+
+    def onerror(e):
+        if not ignore_failures:
+            raise ValueError('failed to read %r: %s' % (e.filename, e))
+        actions.append(Action('fail', e.filename, detail=str(e)))
+
+    sources = [os.path.abspath(path) for path in _sources(
+        paths,
+        extensions,
+        deny,
+        onerror,
+    )]
+    jobs_args = [
+        (
+            source,
+            tag_reader,
+            tag_overrides(source, pattern, album, artists, title, track_number),
+        )
+        for source in sources
+    ]
+
+    if jobs == 1:
+        results = map(_read_tags, jobs_args)
+    else:
+        pool = ProcessPoolExecutor(jobs)
+        results = pool.map(
+            _read_tags,
+            jobs_args,
+            chunksize=max(len(jobs_args) // (4 * (jobs or os.cpu_count())), 1),
+        )
+
+    # (title, album, artist) -> the source which adds that track
+    planned = {}
+    # the path of a new track -> the source which adds it
+    destinations = {}
+    try:
+        for source, (tags, error) in zip(sources, results):
+            if error is not None:
+                if not ignore_failures:
+                    raise ValueError('failed to load %r: %s' % (source, error))
+                actions.append(Action('fail', source, detail=error))
+                continue
+
+            # a track is the same if it has the same title on the same album
+            # by any of the same artists, like ``schema.ensure_track``
+            keys = [
+                (tags.title, tags.album, artist) for artist in tags.artists
+            ]
+            duplicate = next(
+                (planned[key] for key in keys if key in planned),
+                None,
+            )
+            if duplicate is None:
+                track_id = schema.find_track(
+                    conn,
+                    tags.title,
+                    tags.album,
+                    tags.artists,
+                )
+                if track_id is not None:
+                    duplicate = 'track %d' % track_id
+            if duplicate is not None:
+                actions.append(Action('skip', source, detail=duplicate))
+                continue
+
+            path = os.path.relpath(
+                track_destination(music_home, source, tags),
+                music_home,
+            )
+            try:
+                if path in destinations:
+                    raise ValueError(
+                        '%r would replace %r, the file of %r' % (
+                            source,
+                            path,
+                            destinations[path],
+                        ),
+                    )
+                _check_destination(conn, music_home, source, path)
+            except ValueError as e:
+                if not ignore_failures:
+                    raise
+                actions.append(Action('fail', source, detail=str(e)))
+                continue
+
+            destinations[path] = source
+            for key in keys:
+                planned[key] = source
+            actions.append(Action(
+                'add',
+                source,
+                path=path,
+                size=os.stat(source).st_size,
+                tags=tags,
+            ))
+    finally:
+        if jobs != 1:
+            pool.shutdown(cancel_futures=True)
+
+    return Plan(music_home, actions)
+
+
+def _copy(music_home, action):
+    # errors are returned so that the other copies in the batch finish; any
+    # error only fails this action, like a plan entry with no artists
+    tags = action.tags
+    try:
+        ensure_album_dir(music_home, tags.album, tags.artists[0])
+        _copy_atomic(action.source, os.path.join(music_home, action.path))
+    except Exception as e:
+        return e
+    return None
+
+
+def _commit(conn, music_home, actions, verbose):
+    rows = []
+    with conn.begin():
+        for action in actions:
+            track_id, added_new_track = schema.ensure_track(
+                conn=conn,
+                path=action.path,
+                **action.tags._asdict()
+            )
+            rows.append({
+                'source': action.source,
+                'state': 'committed',
+                'path': action.path if added_new_track else None,
+                'track_id': track_id,
+            })
+        if rows:
+            conn.execute(_journal_insert, rows)
+
+    added = 0
+    for action, row in zip(actions, rows):
+        if row['path'] is None:
+            # the track was added after the plan was made; the copy is only
+            # removed once the transaction commits so that a batch which is
+            # rolled back and retried still has its files
+            _remove_unreferenced_copy(
+                conn,
+                os.path.join(music_home, action.path),
+                action.path,
+            )
+            log_skipping_write(verbose, action.source, row['track_id'])
+        else:
+            log_writing_file(
+                verbose,
+                os.path.join(music_home, action.path),
+                row['track_id'],
+            )
+            added += 1
+    return added
+
+
+def apply_plan(music_home,
+               conn,
+               plan,
+               *,
+               verbose,
+               ignore_failures,
+               jobs=4,
+               batch_size=default_batch_size,
+               resume=False):
+    """Carry out the ``add`` actions of a plan.
+
+    Parameters
+    ----------
+    music_home : str
+        The root directory for witchcraft music.
+    conn : sa.Connection
+        The connection to the metadata db.
+    plan : Plan
+        The plan to apply.
+    verbose : bool
+        Print each track that is added or skipped.
+    ignore_failures : bool
+        Skip the tracks which cannot be added instead of raising. If verbose,
+        these will be logged.
+    jobs : int, optional
+        The number of files copied at once.
+    batch_size : int, optional
+        The number of tracks added in each transaction.
+    resume : bool, optional
+        Skip the files which the ingest journal shows were committed.
+
+    Returns
+    -------
+    added : int
+        The number of tracks added.
+
+    Notes
+    -----
+    Each batch goes through the same ingest journal states as
+    :func:`witchcraft.ingest.ingest_file`: the batch is journaled as planned,
+    its files are copied to temporary names and renamed into place, and then
+    the tracks and their ``committed`` journal entries are written in one
+    transaction. When that transaction fails, the batch is added one track
+    at a time to find the tracks which failed. Tracks added to the database
+    since the plan was made are skipped.
+    """
+    journal = schema.ingest_journal
+    adds = [action for action in plan.actions if action.kind == 'add']
+
+    added = 0
+    with ThreadPoolExecutor(jobs) as pool:
+        for start in range(0, len(adds), batch_size):
+            batch = adds[start:start + batch_size]
+
+            states = {}
+            if resume:
+                states = dict(conn.execute(
+                    sa.select((journal.c.source, journal.c.state)).where(
+                        journal.c.source.in_(
+                            [action.source for action in batch],
+                        ),
+                    ),
+                ).fetchall())
+
+            to_copy = []
+            to_commit = []
+            skipped = []
+            for action in batch:
+                state = states.get(action.source)
+                if state == 'committed':
+                    continue
+
+                tags = action.tags
+                track_id = schema.find_track(
+                    conn,
+                    tags.title,
+                    tags.album,
+                    tags.artists,
+                )
+                if track_id is not None:
+                    skipped.append({
+                        'source': action.source,
+                        'state': 'committed',
+                        'path': None,
+                        'track_id': track_id,
+                    })
+                    if verbose:
+                        click.echo(
+                            'not copying %r because it was added as track'
+                            ' %.2d after the plan was made' % (
+                                action.source,
+                                track_id,
+                            ),
+                        )
+                    continue
+
+                try:
+                    # a track may have been added at this path since the
+                    # plan was made
+                    _check_destination(
+                        conn,
+                        music_home,
+                        action.source,
+                        action.path,
+                    )
+                except ValueError as e:
+                    if not ignore_failures:
+                        raise
+                    if verbose:
+                        click.echo('failed to load %r: %s, continuing' % (
+                            action.source,
+                            e,
+                        ))
+                    continue
+
+                to_commit.append(action)
+                if state != 'copied' or not os.path.exists(
+                        os.path.join(music_home, action.path)):
+                    to_copy.append(action)
+
+            with conn.begin():
+                if skipped:
+                    conn.execute(_journal_insert, skipped)
+                if to_copy:
+                    conn.execute(_journal_insert, [
+                        {
+                            'source': action.source,
+                            'state': 'planned',
+                            'path': action.path,
+                            'track_id': None,
+                        }
+                        for action in to_copy
+                    ])
+
+            # the copies are made before the tracks are added so that the
+            # database never points at a file which is not in the music home
+            failed = set()
+            for action, error in zip(
+                    to_copy,
+                    pool.map(partial(_copy, music_home), to_copy)):
+                if error is None:
+                    continue
+                if not ignore_failures:
+                    raise error
+                if verbose:
+                    click.echo('failed to copy %r: %s, continuing' % (
+                        action.source,
+                        error,
+                    ))
+                failed.add(action.source)
+
+            if failed:
+                to_copy = [a for a in to_copy if a.source not in failed]
+                to_commit = [a for a in to_commit if a.source not in failed]
+
+            if to_copy:
+                conn.execute(_journal_insert, [
+                    {
+                        'source': action.source,
+                        'state': 'copied',
+                        'path': action.path,
+                        'track_id': None,
+                    }
+                    for action in to_copy
+                ])
+
+            try:
+                added += _commit(conn, music_home, to_commit, verbose)
+            except Exception:
+                # find the tracks which failed by adding them one at a time
+                for action in to_commit:
+                    try:
+                        added += _commit(conn, music_home, [action], verbose)
+                    except Exception as e:
+                        # the journal still says copied; a resumed apply
+                        # copies it again
+                        _remove_unreferenced_copy(
+                            conn,
+                            os.path.join(music_home, action.path),
+                            action.path,
+                        )
+                        if not ignore_failures:
+                            raise
+                        if verbose:
+                            click.echo('failed to load %r: %s, continuing' % (
+                                action.source,
+                                e,
+                            ))
+
+    return added
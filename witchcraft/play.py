@@ -1,9 +1,15 @@
 import os
 
-from . import ql
+from .metrics import registry
+from .ql.cache import deterministic
+from .ql.columnar import supported
+from .ql.compiler import compile_query, compile_segments
+from .ql.cursor import Cursor
+from .ql.lexer import lex
+from .ql.parser import parse_lexemes
 
 
-def _select_with_args(music_home, conn, query):
+def _select_with_args(music_home, conn, query, catalog=None, cache=None):
     """Exectute a query and return the paths to the tracks to be played.
 
     Parameters
@@ -14,20 +20,61 @@ def _select_with_args(music_home, conn, query):
         The connection to the metadata database.
     query : string
         The witchcraft ql query to run against the database.
+    catalog : Catalog, optional
+        The in-memory catalog to evaluate the query with instead of sqlite,
+        when the catalog supports the query.
+    cache : ResultCache, optional
+        The cache to serve the results of queries which are not shuffled
+        from.
 
     Return
     ------
     paths : iterable[str]
         The paths to the tracks that match the query.
     """
-    return [
-        os.path.join(music_home, p[0])
-        for select in ql.compile(query)
-        for p in conn.execute(select).fetchall()
-    ]
+    with registry.timer('query.lex'):
+        lexemes = list(lex(query))
+    with registry.timer('query.parse'):
+        parsed = parse_lexemes(lexemes, query)
 
+    # queries which filter on metadata the catalog does not hold fall back to
+    # sqlite
+    if catalog is not None and supported(parsed):
+        with registry.timer('query.refresh'):
+            catalog.refresh()
+        with registry.timer('query.columnar'):
+            results = list(catalog.evaluate(parsed))
+        with registry.timer('query.format'):
+            return [
+                os.path.join(music_home, p)
+                for paths in results
+                for p in paths
+            ]
 
-def select(music_home, conn, query):
+    with registry.timer('query.compile'):
+        selects = list(compile_query(parsed))
+
+    if cache is not None and deterministic(parsed):
+        with registry.timer('query.cache'):
+            results = cache.fetch(conn, selects)
+        with registry.timer('query.format'):
+            return [
+                os.path.join(music_home, p)
+                for paths in results
+                for p in paths
+            ]
+
+    with registry.timer('query.sql'):
+        results = [conn.execute(select).fetchall() for select in selects]
+    with registry.timer('query.format'):
+        return [
+            os.path.join(music_home, p[0])
+            for rows in results
+            for p in rows
+        ]
+
+
+def select(music_home, conn, query, catalog=None, cache=None):
     """Exectute a query and return the paths to the tracks to be played.
 
     Parameters
@@ -38,13 +85,100 @@ def select(music_home, conn, query):
         The connection to the metadata database.
     query : string
         The witchcraft ql query to run against the database.
+    catalog : Catalog, optional
+        The in-memory catalog to evaluate the query with instead of sqlite.
+    cache : ResultCache, optional
+        The cache to serve the results of queries which are not shuffled
+        from.
 
     Return
     ------
     paths : iterable[str]
         The paths to the tracks that match the query.
     """
-    return _select_with_args(music_home, conn, query)
+    return _select_with_args(music_home, conn, query, catalog, cache)
+
+
+def select_page(music_home, conn, query, page_size, cursor=None):
+    """Execute a query and return one page of the paths to the tracks.
+
+    Parameters
+    ----------
+    music_home : str
+        The root directory for witchcraft music.
+    conn : sa.engine.Connection
+        The connection to the metadata database.
+    query : string
+        The witchcraft ql query to run against the database.
+    page_size : int
+        The maximum number of paths to return.
+    cursor : str, optional
+        The token returned with the previous page. If not given, the first
+        page is returned.
+
+    Returns
+    -------
+    paths : list[str]
+        The paths to the tracks in this page.
+    cursor : str or None
+        The token to pass to get the next page, or None if this is the last
+        page.
+
+    Raises
+    ------
+    ValueError
+        Raised when the query or cursor is invalid.
+
+    Notes
+    -----
+    Each page seeks past the sort keys of the last track in the previous
+    page instead of skipping rows with ``OFFSET``, so late pages are as cheap
+    as early ones. Shuffled queries are ordered by a seeded permutation which
+    is carried in the cursor so that every page sees the same order.
+    """
+    if page_size < 1:
+        raise ValueError('page size must be positive, got %d' % page_size)
+
+    if cursor is None:
+        position = Cursor.start(query)
+    else:
+        position = Cursor.decode(cursor, query)
+
+    with registry.timer('query.lex'):
+        lexemes = list(lex(query))
+    with registry.timer('query.parse'):
+        parsed = parse_lexemes(lexemes, query)
+    with registry.timer('query.compile'):
+        segments = list(compile_segments(parsed, position.seed))
+
+    paths = []
+    with registry.timer('query.sql'):
+        while len(paths) < page_size and position.segment < len(segments):
+            segment = segments[position.segment]
+            limit = page_size - len(paths)
+            if segment.take is not None:
+                limit = min(limit, segment.take - position.taken)
+
+            if limit > 0:
+                rows = conn.execute(
+                    segment.page(position.after, limit),
+                ).fetchall()
+            else:
+                rows = []
+            paths.extend(os.path.join(music_home, row[0]) for row in rows)
+
+            if len(rows) < limit or limit <= 0:
+                # this segment is exhausted, move onto the next
+                position.segment += 1
+                position.after = None
+                position.taken = 0
+            else:
+                position.after = list(rows[-1][1:])
+                position.taken += len(rows)
+
+    if position.segment == len(segments):
+        return paths, None
+    return paths, position.encode()
 
 
 def play(music_home, conn, query):
@@ -0,0 +1,34 @@
+"""The sqlite tuning profiles selected by ``--db-profile``.
+
+These are kept apart from :mod:`witchcraft.db` so that the command line can
+list them without importing sqlalchemy.
+"""
+from collections import OrderedDict
+
+# The pragmas applied to every connection for each profile. ``busy_timeout``
+# is set first so that switching the journal mode waits for other processes
+# instead of failing with "database is locked".
+profiles = {
+    # write ahead logging lets the daemon read while an ingest is writing
+    # without giving up any durability
+    'safe': OrderedDict([
+        ('busy_timeout', 5000),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'FULL'),
+    ]),
+    # with WAL, ``synchronous=NORMAL`` can lose the last commits on power
+    # loss but never corrupts the database
+    'fast': OrderedDict([
+        ('busy_timeout', 5000),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -64 * 1024),  # negative sizes are in KiB
+        ('mmap_size', 256 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+    ]),
+}
+# ``bulk-load`` connects like ``fast``; the durability is only relaxed inside
+# of ``bulk_load``
+profiles['bulk-load'] = profiles['fast']
+
+default_profile = 'safe'
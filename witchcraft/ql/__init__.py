@@ -1,5 +1,6 @@
 from .compiler import compile
 from .completion import completions
+from .explain import explain
 from .lexer import lex
 from .parser import parse
 
@@ -7,6 +8,7 @@ from .parser import parse
 __all__ = [
     'compile',
     'completions',
+    'explain',
     'lex',
     'parse',
 ]
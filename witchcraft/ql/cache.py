@@ -0,0 +1,157 @@
+"""A cache of query results for ``witchcraft serve``.
+
+Frontends run the same queries over and over while the library only changes a
+few times a day. The paths selected by each statement are kept in memory and
+served again until another connection writes to the database.
+"""
+from collections import OrderedDict
+import sys
+
+from ..metrics import registry
+
+# paths cannot contain a null byte
+_sep = '\0'
+
+_result_cache_hits = registry.counter(
+    'witchcraft_cache_hits_total',
+    'Lookups served from a cache.',
+    cache='result',
+)
+_result_cache_misses = registry.counter(
+    'witchcraft_cache_misses_total',
+    'Lookups which missed a cache.',
+    cache='result',
+)
+_result_cache_bytes = registry.gauge(
+    'witchcraft_result_cache_bytes',
+    'The size of the results held by the result cache.',
+)
+
+
+def deterministic(query):
+    """Check if a query selects the same tracks every time it is run.
+
+    Parameters
+    ----------
+    query : Query
+        The query to check.
+
+    Returns
+    -------
+    deterministic : bool
+        False if the query or any of its subqueries is shuffled.
+    """
+    while query is not None:
+        if query.shuffle:
+            return False
+        if query.except_ is not None and not deterministic(query.except_):
+            return False
+        query = query.then
+    return True
+
+
+class ResultCache:
+    """A least recently used cache from compiled sql to the paths it selects.
+
+    Parameters
+    ----------
+    conn : sa.engine.Connection or None
+        The connection used to notice when the database has been written to.
+        The cache holds onto this connection. If None, the cache is only
+        cleared by :meth:`clear`, which is how the server drops results read
+        from an old :class:`~witchcraft.db.Replica`.
+    maxbytes : int, optional
+        The maximum size of the cached results. The least recently used
+        results are evicted first.
+
+    Notes
+    -----
+    ``PRAGMA data_version`` changes when any other connection commits to the
+    database, including ``ingest`` in another process, so the whole cache is
+    cleared whenever :meth:`fetch` sees a new data version. The paths of each
+    result are stored in one delimited string.
+    """
+    def __init__(self, conn, maxbytes=2 ** 26):
+        self._conn = conn
+        self.maxbytes = maxbytes
+        self._results = OrderedDict()
+        self._nbytes = 0
+        self._data_version = None
+
+    def __len__(self):
+        return len(self._results)
+
+    @property
+    def nbytes(self):
+        """The size of the cached results.
+        """
+        return self._nbytes
+
+    def validate(self):
+        """Clear the cache if the database has been written to.
+        """
+        if self._conn is None:
+            return
+
+        data_version = self._conn.scalar('PRAGMA data_version')
+        if data_version != self._data_version:
+            self.clear()
+            self._data_version = data_version
+
+    def clear(self):
+        self._results.clear()
+        self._nbytes = 0
+        _result_cache_bytes.set(0)
+
+    def _put(self, key, blob):
+        size = sys.getsizeof(key[0]) + sys.getsizeof(blob)
+        if size > self.maxbytes:
+            # this would evict everything else and still not fit
+            return
+
+        results = self._results
+        results[key] = blob, size
+        self._nbytes += size
+        while self._nbytes > self.maxbytes:
+            _, (_, evicted_size) = results.popitem(last=False)
+            self._nbytes -= evicted_size
+        _result_cache_bytes.set(self._nbytes)
+
+    def _fetch_one(self, conn, select):
+        compiled = select.compile(dialect=conn.dialect)
+        key = compiled.string, tuple(sorted(compiled.params.items()))
+
+        results = self._results
+        try:
+            blob, _ = results[key]
+        except KeyError:
+            _result_cache_misses.inc()
+            blob = ''.join(
+                row[0] + _sep for row in conn.execute(compiled).fetchall()
+            )
+            self._put(key, blob)
+        else:
+            _result_cache_hits.inc()
+            results.move_to_end(key)
+
+        # the trailing separator leaves an empty string at the end
+        return blob.split(_sep)[:-1]
+
+    def fetch(self, conn, selects):
+        """Get the paths selected by each statement, running the statements
+        which are not cached.
+
+        Parameters
+        ----------
+        conn : sa.engine.Connection
+            The connection to run the statements with.
+        selects : iterable[sa.sql.Select]
+            The statements that a deterministic query compiles to.
+
+        Returns
+        -------
+        results : list[list[str]]
+            The paths selected by each statement.
+        """
+        self.validate()
+        return [self._fetch_one(conn, select) for select in selects]
@@ -0,0 +1,575 @@
+"""An in-memory evaluator for witchcraft ql queries.
+
+The catalog is loaded once into flat columns and queries are run against it
+without going through sqlite. The results are exactly the results of the sql
+produced by :func:`~witchcraft.ql.compiler.compile_query`, including the
+order, so the two can be swapped freely.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+import random
+import re
+
+import sqlalchemy as sa
+
+from .compiler import fuzzy
+from ..schema import album_contents, albums, artists, track_artists, tracks
+
+
+# Each string in a column is preceded by NUL and the column ends with NUL.
+# NUL cannot appear in a normalized name or a path so it is safe to use as a
+# row delimiter.
+_sep = '\0'
+
+# sorts before every track number like ``NULL`` does in sqlite
+_null_track_number = -2 ** 63
+
+_ascii_lower = str.maketrans(
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZ',
+    'abcdefghijklmnopqrstuvwxyz',
+)
+_ascii_upper = re.compile('[A-Z]')
+
+
+def like_regex(pattern, ignore_case=True):
+    """Translate a sql ``LIKE`` pattern into a regex which finds the matching
+    rows of a :class:`Strings` column.
+
+    Parameters
+    ----------
+    pattern : str
+        The ``LIKE`` pattern.
+    ignore_case : bool, optional
+        Whether the regex should ignore case. When the column has no
+        uppercase ascii characters it is faster to lowercase the pattern and
+        match case sensitively.
+
+    Returns
+    -------
+    regex : re.Pattern or None
+        The regex, or None if the pattern matches every string. The match of
+        the first group starts inside of the matching row.
+
+    Notes
+    -----
+    Like sqlite's ``LIKE``, the regex ignores case for ascii characters only.
+    Leading and trailing ``%`` are dropped instead of translated so that the
+    regex engine can scan for the literal parts of the pattern.
+    """
+    body = pattern.lstrip('%')
+    if not body and pattern:
+        return None
+
+    anchor_start = body is pattern
+    stripped = body.rstrip('%')
+    anchor_end = len(stripped) == len(body)
+
+    if not ignore_case:
+        stripped = stripped.translate(_ascii_lower)
+
+    parts = []
+    for c in stripped:
+        if c == '%':
+            parts.append('[^\0]*?')
+        elif c == '_':
+            parts.append('[^\0]')
+        else:
+            parts.append(re.escape(c))
+
+    return re.compile(
+        '%s(%s)%s' % (
+            _sep if anchor_start else '',
+            ''.join(parts),
+            '(?=\0)' if anchor_end else '',
+        ),
+        re.IGNORECASE | re.ASCII if ignore_case else 0,
+    )
+
+
+def _after(column, ids):
+    """The rows of ``column`` with ids after the ones already loaded.
+    """
+    return column > ids[-1] if ids else column.isnot(None)
+
+
+class Strings:
+    """A column of strings stored in one delimited string.
+
+    Matching a pattern runs the regex over the whole column at once instead
+    of once per row.
+    """
+    def __init__(self):
+        self._blob = _sep
+        self._starts = array('q')
+        self._has_upper = False
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __getitem__(self, row):
+        start = self._starts[row]
+        return self._blob[start:self._blob.find(_sep, start)]
+
+    def extend(self, values):
+        values = list(values)
+        if not values:
+            return
+
+        starts = self._starts
+        offset = len(self._blob)
+        for value in values:
+            starts.append(offset)
+            offset += len(value) + 1
+
+        new = _sep.join(values) + _sep
+        self._has_upper = (
+            self._has_upper or _ascii_upper.search(new) is not None
+        )
+        self._blob += new
+
+    def match(self, pattern):
+        """Find the rows that match a ``LIKE`` pattern.
+
+        Parameters
+        ----------
+        pattern : str
+            The ``LIKE`` pattern.
+
+        Returns
+        -------
+        rows : set[int] or None
+            The rows which match, or None if every row matches.
+        """
+        regex = like_regex(pattern, self._has_upper)
+        if regex is None:
+            return None
+
+        starts = self._starts
+        return {
+            bisect_right(starts, m.start(1)) - 1
+            for m in regex.finditer(self._blob)
+        }
+
+    def rank(self, patterns):
+        """Find the first ``LIKE`` pattern that matches each row.
+
+        Parameters
+        ----------
+        patterns : iterable[str]
+            The ``LIKE`` patterns in order.
+
+        Returns
+        -------
+        ranks : dict[int, int]
+            The index of the first pattern that matches each row which is
+            matched by any pattern.
+        default : int or None
+            The rank of rows which are not in ``ranks``, or None if those rows
+            do not match. This is set when a pattern matches everything.
+        """
+        ranks = {}
+        for n, pattern in enumerate(patterns):
+            rows = self.match(pattern)
+            if rows is None:
+                return ranks, n
+            for row in rows:
+                ranks.setdefault(row, n)
+        return ranks, None
+
+    def ranked(self, patterns):
+        """Iterate over the rows matched by any ``LIKE`` pattern with the
+        index of the first pattern that matched.
+        """
+        ranks, default = self.rank(patterns)
+        if default is None:
+            return ranks.items()
+        return ((row, ranks.get(row, default)) for row in range(len(self)))
+
+
+def unsupported_features(query):
+    """Find the parts of a query which a :class:`Catalog` cannot evaluate.
+
+    Parameters
+    ----------
+    query : Query
+        The query to check.
+
+    Returns
+    -------
+    features : list[str]
+        The clauses used by the query or any of its subqueries which filter on
+        metadata that is not held in memory, like ``'genre'`` or ``'bpm'``,
+        and ``'~name patterns'`` if it matches names against the word index.
+        These are in a fixed order without repeats.
+    """
+    found = set()
+    while query is not None:
+        for name, filter_ in (
+                ('genre', query.genres),
+                ('label', query.labels),
+                ('from', query.years),
+                ('bpm', query.bpms)):
+            if filter_ is not None:
+                found.add(name)
+        if any(
+            pattern[0] == '~'
+            for patterns in (query.titles, query.on, query.by)
+            if patterns is not None
+            for pattern in patterns
+        ):
+            found.add('~name patterns')
+        if query.except_ is not None:
+            found.update(unsupported_features(query.except_))
+        query = query.then
+
+    return [
+        name
+        for name in ('genre', 'label', 'from', 'bpm', '~name patterns')
+        if name in found
+    ]
+
+
+def supported(query):
+    """Check if a query can be evaluated by a :class:`Catalog`.
+
+    Parameters
+    ----------
+    query : Query
+        The query to check.
+
+    Returns
+    -------
+    supported : bool
+        False if the query has any :func:`unsupported_features`.
+    """
+    return not unsupported_features(query)
+
+
+class Catalog:
+    """The tracks, albums, and artists held in memory as columns.
+
+    Parameters
+    ----------
+    conn : sa.engine.Connection
+        The connection to load the catalog with. The catalog holds onto this
+        connection to notice when the database has been written to.
+
+    Notes
+    -----
+    Rows are identified by their position, and rows of ``tracks``, ``albums``
+    and ``artists`` are stored in id order. Writes are picked up by
+    :meth:`refresh` which only loads rows with ids larger than any seen so far.
+    If the row counts show that rows have been deleted, the catalog is
+    reloaded from scratch. Rows are never updated by witchcraft, so updates
+    made by other tools are not noticed.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+        self._data_version = None
+        self._clear()
+        self.refresh()
+
+    def _clear(self):
+        self._track_ids = array('q')
+        self._titles = Strings()
+        self._paths = Strings()
+
+        self._album_ids = array('q')
+        self._album_titles = Strings()
+        # album row -> indices into the album contents columns
+        self._album_postings = []
+
+        # one entry per ``album_contents`` row
+        self._contents_track = array('q')
+        self._contents_number = array('q')
+        self._contents_count = 0
+
+        self._artist_ids = array('q')
+        self._artist_names = Strings()
+        # artist row -> track rows
+        self._artist_postings = []
+        self._track_artists_count = 0
+
+    def __len__(self):
+        return len(self._track_ids)
+
+    def refresh(self):
+        """Load any rows written since the last refresh.
+
+        Returns
+        -------
+        changed : bool
+            Whether the database changed since the last refresh.
+        """
+        conn = self._conn
+        with conn.begin():
+            data_version = conn.scalar('PRAGMA data_version')
+            if data_version == self._data_version:
+                return False
+
+            if not self._load():
+                # rows were removed, start over
+                self._clear()
+                self._load()
+            self._data_version = data_version
+        return True
+
+    @staticmethod
+    def _row(ids, id_):
+        row = bisect_left(ids, id_)
+        if row == len(ids) or ids[row] != id_:
+            raise KeyError(id_)
+        return row
+
+    def _load(self):
+        conn = self._conn
+        track_ids = self._track_ids
+        album_ids = self._album_ids
+        artist_ids = self._artist_ids
+
+        old_track_count = len(track_ids)
+        old_album_count = len(album_ids)
+        old_artist_count = len(artist_ids)
+        old_contents_count = self._contents_count
+        old_track_artists_count = self._track_artists_count
+
+        counts = conn.execute(sa.select(tuple(
+            sa.select((sa.func.count(column),)).as_scalar()
+            for column in (
+                tracks.c.id,
+                albums.c.id,
+                artists.c.id,
+                album_contents.c.track_id,
+                track_artists.c.track_id,
+            )
+        ))).first()
+
+        new_tracks = conn.execute(
+            sa.select((
+                tracks.c.id,
+                tracks.c.title,
+                tracks.c.path,
+            )).where(
+                _after(tracks.c.id, track_ids),
+            ).order_by(tracks.c.id),
+        ).fetchall()
+        new_albums = conn.execute(
+            sa.select((albums.c.id, albums.c.title)).where(
+                _after(albums.c.id, album_ids),
+            ).order_by(albums.c.id),
+        ).fetchall()
+        new_artists = conn.execute(
+            sa.select((artists.c.id, artists.c.name)).where(
+                _after(artists.c.id, artist_ids),
+            ).order_by(artists.c.id),
+        ).fetchall()
+        new_contents = conn.execute(
+            sa.select((
+                album_contents.c.album_id,
+                album_contents.c.track_id,
+                album_contents.c.track_number,
+            )).where(
+                _after(album_contents.c.track_id, track_ids),
+            ),
+        ).fetchall()
+        new_track_artists = conn.execute(
+            sa.select((
+                track_artists.c.track_id,
+                track_artists.c.artist_id,
+            )).where(
+                _after(track_artists.c.track_id, track_ids),
+            ),
+        ).fetchall()
+
+        expected = (
+            old_track_count + len(new_tracks),
+            old_album_count + len(new_albums),
+            old_artist_count + len(new_artists),
+            old_contents_count + len(new_contents),
+            old_track_artists_count + len(new_track_artists),
+        )
+        if tuple(counts) != expected:
+            return False
+
+        track_ids.extend(row[0] for row in new_tracks)
+        self._titles.extend(row[1] for row in new_tracks)
+        self._paths.extend(row[2] for row in new_tracks)
+
+        album_ids.extend(row[0] for row in new_albums)
+        self._album_titles.extend(row[1] for row in new_albums)
+        self._album_postings.extend(array('q') for _ in new_albums)
+
+        artist_ids.extend(row[0] for row in new_artists)
+        self._artist_names.extend(row[1] or '' for row in new_artists)
+        self._artist_postings.extend(array('q') for _ in new_artists)
+
+        # rows with dangling ids are skipped, like the sql inner joins do
+        for album_id, track_id, track_number in new_contents:
+            try:
+                album_row = self._row(album_ids, album_id)
+                track_row = self._row(track_ids, track_id)
+            except KeyError:
+                continue
+            self._album_postings[album_row].append(len(self._contents_track))
+            self._contents_track.append(track_row)
+            self._contents_number.append(
+                _null_track_number if track_number is None else track_number,
+            )
+        self._contents_count += len(new_contents)
+
+        for track_id, artist_id in new_track_artists:
+            try:
+                artist_row = self._row(artist_ids, artist_id)
+                track_row = self._row(track_ids, track_id)
+            except KeyError:
+                continue
+            self._artist_postings[artist_row].append(track_row)
+        self._track_artists_count += len(new_track_artists)
+
+        return True
+
+    def _rows(self, query, ordered=True):
+        """Evaluate the first statement of a query.
+
+        Parameters
+        ----------
+        query : Query
+            The query to evaluate.
+        ordered : bool, optional
+            Whether to order the rows. Set to False when only the set of rows
+            is needed. The ``except`` query's other statements, and queries
+            with a ``take``, are always ordered.
+
+        Returns
+        -------
+        rows : list[int]
+            The track rows that match.
+        tail : list[list[int]]
+            The rows of the rest of the ``except`` query's statements.
+        """
+        titles = self._titles
+        paths = self._paths
+
+        # ``take`` needs the order to know which rows come first
+        ordered = (ordered or query.take is not None) and not query.shuffle
+        if ordered:
+            ranks, default = titles.rank(map(fuzzy, query.titles))
+
+        filters = [title for title in query.titles if title != '.']
+        if not filters:
+            title_rows = None
+        else:
+            if ordered and len(filters) == len(query.titles):
+                # the filter patterns are the same as the order patterns
+                matched, everything = ranks, default
+            else:
+                matched, everything = titles.rank(map(fuzzy, filters))
+            title_rows = None if everything is not None else matched.keys()
+
+        if query.except_:
+            except_rows, *tail = self._evaluate(query.except_, ordered=False)
+            excluded = {paths[row] for row in except_rows}
+        else:
+            excluded = ()
+            tail = []
+
+        def keep(row):
+            return (
+                (title_rows is None or row in title_rows) and
+                (not excluded or paths[row] not in excluded)
+            )
+
+        if query.on is not None and '.' not in query.on:
+            # keep the best matching album for each track
+            album_titles = self._album_titles
+            contents_track = self._contents_track
+            contents_number = self._contents_number
+            album_postings = self._album_postings
+            best = {}
+            for album, rank in album_titles.ranked(map(fuzzy, query.on)):
+                title = album_titles[album]
+                for contents in album_postings[album]:
+                    row = contents_track[contents]
+                    key = rank, title, contents_number[contents]
+                    if row not in best or key < best[row]:
+                        best[row] = key
+            rows = [(row, key) for row, key in best.items() if keep(row)]
+        elif title_rows is not None:
+            rows = [(row, ()) for row in sorted(title_rows) if keep(row)]
+        else:
+            rows = [(row, ()) for row in range(len(self)) if keep(row)]
+
+        if query.by is not None and '.' not in query.by:
+            # keep the best matching artist for each track
+            artist_names = self._artist_names
+            best = {}
+            for artist, rank in artist_names.ranked(map(fuzzy, query.by)):
+                key = rank, artist_names[artist]
+                for row in self._artist_postings[artist]:
+                    if row not in best or key < best[row]:
+                        best[row] = key
+
+            rows = [
+                (row, key + best[row])
+                for row, key in rows
+                if row in best
+            ]
+
+        if ordered:
+            rows.sort(key=lambda item: item[1] + (
+                ranks.get(item[0], default),
+                titles[item[0]],
+                item[0],
+            ))
+        rows = [row for row, _ in rows]
+        if query.shuffle:
+            if query.take is not None:
+                rows = random.sample(rows, min(query.take, len(rows)))
+            else:
+                random.shuffle(rows)
+        elif query.take is not None:
+            del rows[query.take:]
+
+        return rows, tail
+
+    def _evaluate(self, query, ordered=True):
+        rows, tail = self._rows(query, ordered)
+        yield rows
+        yield from tail
+
+        if query.then:
+            yield from self._evaluate(query.then)
+
+        yield from tail
+
+    def evaluate(self, query):
+        """Evaluate a parsed query.
+
+        Parameters
+        ----------
+        query : Query
+            The query to evaluate.
+
+        Yields
+        ------
+        paths : list[str]
+            The paths selected by each statement that
+            :func:`~witchcraft.ql.compiler.compile_query` would produce for
+            the query. These should be concatenated in order.
+
+        Raises
+        ------
+        ValueError
+            Raised when the query is not :func:`supported`.
+        """
+        features = unsupported_features(query)
+        if features:
+            raise ValueError(
+                'the columnar engine cannot evaluate queries with: %s' % (
+                    ', '.join(features),
+                ),
+            )
+
+        paths = self._paths
+        for rows in self._evaluate(query):
+            yield [paths[row] for row in rows]
@@ -1,13 +1,25 @@
+import datetime
+from functools import partial
+
 import sqlalchemy as sa
+from sqlalchemy.ext.compiler import compiles
 
 from .parser import parse
 from ..schema import (
     album_contents,
-    albums,
+    album_title_words,
+    artist_name_words,
     artists,
     track_artists,
+    track_genres,
+    track_labels,
+    track_search,
+    track_title_words,
     tracks,
+    word_trigrams,
+    words,
 )
+from ..utils import max_typos, normalize, split_words, trigrams
 
 
 def fuzzy(cs):
@@ -31,9 +43,116 @@ def fuzzy(cs):
     return pattern.format(cs.replace('.', '%'))
 
 
-def pattern_order(column, patterns):
-    """Create clauses suitable for use in an ``order by`` clause which will
-    sort results in the order they are matched by the patterns.
+def approximate_words(word):
+    """Select the ids of the words within a few typos of a word.
+
+    Parameters
+    ----------
+    word : str
+        The word to match.
+
+    Returns
+    -------
+    select : sa.sql.Select
+        The ids of the words within :func:`~witchcraft.utils.max_typos` edits
+        of ``word``.
+
+    Notes
+    -----
+    An edit changes at most three of a word's trigrams, so a word within
+    ``k`` edits shares all but ``3 * k`` of them. The shared trigram count is
+    read from the ``word_trigrams`` primary key, and only the few words which
+    pass that and the length check are compared with ``edit_distance``.
+    """
+    typos = max_typos(word)
+    grams = sorted(trigrams(word))
+    candidates = sa.select((word_trigrams.c.word_id,)).where(
+        word_trigrams.c.trigram.in_(grams),
+    ).group_by(
+        word_trigrams.c.word_id,
+    ).having(
+        sa.func.count() >= max(len(grams) - 3 * typos, 1),
+    )
+    length = sa.func.length(words.c.word)
+    return sa.select((words.c.id,)).where(sa.and_(
+        words.c.id.in_(candidates),
+        length.between(len(word) - typos, len(word) + typos),
+        sa.func.edit_distance(words.c.word, word) <= typos,
+    ))
+
+
+def approximate_match(id_column, link_entity_id, pattern):
+    """Create a filter for the entities with a word close to each word of an
+    approximate pattern.
+
+    Parameters
+    ----------
+    id_column : sa.sql.ColumnElement
+        The entity id to filter, like ``artists.c.id``.
+    link_entity_id : sa.Column
+        The entity id column of the table linking entities to their words,
+        like ``artist_name_words.c.artist_id``.
+    pattern : str
+        The pattern without the leading ``~``.
+
+    Returns
+    -------
+    where : sa.sql.ColumnElement
+        The filter on ``id_column``.
+    """
+    link = link_entity_id.table
+    return sa.and_(*(
+        id_column.in_(
+            sa.select((link_entity_id,)).where(
+                link.c.word_id.in_(approximate_words(word)),
+            ),
+        )
+        for word in split_words(pattern)
+    ))
+
+
+def _approximate_album(pattern):
+    return track_search.c.track_id.in_(
+        sa.select((album_contents.c.track_id,)).where(
+            approximate_match(
+                album_contents.c.album_id,
+                album_title_words.c.album_id,
+                pattern,
+            ),
+        ),
+    )
+
+
+def pattern_condition(column, pattern, approximate=None):
+    """Create a filter for the rows matched by one pattern.
+
+    Parameters
+    ----------
+    column : sa.sql.ColumnClause
+        The column being matched against.
+    pattern : str
+        The pattern to match.
+    approximate : callable[str, sa.sql.ColumnElement], optional
+        The function which creates the filter for a pattern that starts with
+        ``~``, given the rest of the pattern.
+
+    Returns
+    -------
+    where : sa.sql.ColumnElement
+        The filter for the rows matched by the pattern.
+    """
+    if pattern[0] == '~':
+        if approximate is None:
+            raise ValueError(
+                '%r cannot be matched approximately' % column.name,
+            )
+        return approximate(pattern[1:])
+    return column.like(fuzzy(pattern))
+
+
+def pattern_rank(column, patterns, approximate=None):
+    """Create an expression for the index of the first pattern which matches
+    a row.
 
     Parameters
     ----------
@@ -41,133 +160,580 @@ def pattern_order(column, patterns):
         The column being matched against.
     patterns : iterable[str]
         The patterns to search in order.
+    approximate : callable[str, sa.sql.ColumnElement], optional
+        The function which matches the patterns that start with ``~``.
 
     Returns
     -------
-    iterable[sa.sql.ColumnClause]
+    rank : sa.sql.ColumnElement
+        The index of the first matching pattern, or ``NULL`` when no pattern
+        matches.
+    """
+    return sa.case([
+        (pattern_condition(column, pattern, approximate), n)
+        for n, pattern in enumerate(patterns)
+    ])
+
+
+def pattern_match(column, patterns, approximate=None):
+    """Create a filter for the rows matched by any of the patterns and the
+    clauses to sort them in the order they are matched.
+
+    Parameters
+    ----------
+    column : sa.sql.ColumnClause
+        The column being matched against.
+    patterns : iterable[str]
+        The patterns to search in order.
+    approximate : callable[str, sa.sql.ColumnElement], optional
+        The function which matches the patterns that start with ``~``.
+
+    Returns
+    -------
+    where : sa.sql.ColumnElement
+        The filter for the rows matched by any pattern.
+    order_by : tuple[sa.sql.ColumnElement]
         The clauses used in an ``order by`` to enforce the given order.
+
+    Notes
+    -----
+    The filter and the sort key are the same :func:`pattern_rank`, not a
+    chain of ``OR`` next to a ``CASE``, so each row is matched against one
+    list of patterns which stops at the first match.
     """
-    return (
-        sa.case([
-            (column.like(fuzzy(pattern)), n)
-            for n, pattern in enumerate(patterns)
-        ]).asc(),
-        column,
+    if len(patterns) == 1:
+        # every row matched the only pattern so the case would be constant,
+        # leaving it out lets sqlite use an index on the column
+        return pattern_condition(column, patterns[0], approximate), (column,)
+
+    rank = pattern_rank(column, patterns, approximate)
+    return rank.isnot(None), (rank, column)
+
+
+class CrossJoin(sa.sql.expression.Join):
+    """An inner join which sqlite always evaluates with the left side as the
+    outer loop.
+    """
+    __visit_name__ = 'cross_join'
+
+
+@compiles(CrossJoin)
+def _compile_cross_join(join, compiler, **kwargs):
+    kwargs['asfrom'] = True
+    return '%s CROSS JOIN %s ON %s' % (
+        compiler.process(join.left, **kwargs),
+        compiler.process(join.right, **kwargs),
+        compiler.process(join.onclause, **kwargs),
     )
 
 
-def compile_query(query):
-    """"Compile a Query object into sql and flags to ``mpv``.
+def best_matches(link_entity_id, column, patterns, approximate=None):
+    """Create a subquery which selects the best matching entity for each
+    track, like the first artist matched by the ``by`` patterns.
+
+    Parameters
+    ----------
+    link_entity_id : sa.Column
+        The entity id column of the table linking tracks to the entity, like
+        ``track_artists.c.artist_id``.
+    column : sa.Column
+        The column of the entity to match the patterns against, like
+        ``artists.c.name``.
+    patterns : iterable[str]
+        The patterns to match.
+    approximate : callable[str, sa.sql.ColumnElement], optional
+        The function which matches the patterns that start with ``~``.
+
+    Returns
+    -------
+    matches : sa.sql.Alias
+        The subquery, with one row for each matching track. Joining against
+        this instead of the link table keeps a track that matches more than
+        one entity from being selected more than once.
+    keys : list[sa.sql.ColumnElement]
+        The columns of ``matches`` to sort the tracks by.
+
+    Notes
+    -----
+    The pattern rank is computed once for each matching entity, not for each
+    track.
+    """
+    entity = column.table
+    where, order_by = pattern_match(column, patterns, approximate)
+    entities = sa.select(
+        [entity.c.id] + [
+            key.label('key_%d' % n) for n, key in enumerate(order_by)
+        ],
+    ).where(
+        where,
+    ).alias()
+    entity_id, *keys = entities.c
+
+    link = link_entity_id.table
+    matches = sa.select(
+        [link.c.track_id] +
+        [key.label('key_%d' % n) for n, key in enumerate(keys)] +
+        [
+            sa.func.row_number().over(
+                partition_by=link.c.track_id,
+                order_by=keys + [entity_id],
+            ).label('n'),
+        ],
+    ).select_from(
+        # Without statistics sqlite prefers to scan the link table in track
+        # order for the window. Matching the entities first and looking up
+        # their tracks reads far fewer rows.
+        CrossJoin(entities, link, link_entity_id == entity_id),
+    ).alias()
+    return matches, [matches.c['key_%d' % n] for n in range(len(keys))]
+
+
+def entity_filter(entity_id, names):
+    """Create a filter for the tracks linked to any of the named entities,
+    like the tracks in some genres.
+
+    Parameters
+    ----------
+    entity_id : sa.Column
+        The entity id column of the table linking tracks to the entity, like
+        ``track_genres.c.genre_id``.
+    names : iterable[str]
+        The names of the entities. These are normalized like they are on
+        ingest and matched exactly so that the entity's unique index is used.
+
+    Returns
+    -------
+    where : sa.sql.ColumnElement
+        The filter on ``track_search``.
+    """
+    link = entity_id.table
+    (entity_column,) = entity_id.foreign_keys
+    entity = entity_column.column.table
+    id_, name = entity.c
+    return track_search.c.track_id.in_(
+        sa.select((link.c.track_id,)).select_from(
+            link.join(entity, entity_id == id_),
+        ).where(
+            name.in_(sorted({normalize(name) for name in names})),
+        ),
+    )
+
+
+def range_filter(column, low, high):
+    """Create a filter for the tracks with a value in an inclusive range.
+
+    Parameters
+    ----------
+    column : sa.Column
+        The column of ``tracks`` to filter on, like ``tracks.c.bpm``.
+    low, high : any or None
+        The inclusive bounds, or None for no bound.
+
+    Returns
+    -------
+    where : sa.sql.ColumnElement
+        The filter on ``track_search``.
+    """
+    conditions = [column.isnot(None)]
+    if low is not None:
+        conditions.append(column >= low)
+    if high is not None:
+        conditions.append(column <= high)
+    return track_search.c.track_id.in_(
+        sa.select((tracks.c.id,)).where(sa.and_(*conditions)),
+    )
+
+
+def year_filter(low, high):
+    """Create a filter for the tracks released in an inclusive range of
+    years.
+    """
+    return range_filter(
+        tracks.c.date,
+        datetime.datetime(max(low, datetime.MINYEAR), 1, 1)
+        if low is not None else
+        None,
+        # the dates are stored as text, the last instant of the year compares
+        # larger than any datetime in that year
+        datetime.datetime(min(high, datetime.MAXYEAR), 12, 31, 23, 59, 59,
+                          999999)
+        if high is not None else
+        None,
+    )
+
+
+# the number of random ids drawn for each track taken by ``shuffle take N``
+_samples_per_track = 4
+
+
+def sample_tracks(n):
+    """Select ``n`` random tracks without sorting the whole table.
+
+    Parameters
+    ----------
+    n : int
+        The number of tracks to select.
+
+    Returns
+    -------
+    select : sa.sql.Select
+        The select which returns the paths to the sampled tracks.
+
+    Notes
+    -----
+    ``ORDER BY random()`` has to read and sort every track. Instead, this
+    draws ``4 * n`` random points between the smallest and largest track id
+    and seeks to the first track at or after each point, which reads about
+    ``4 * n`` rows through the primary key. Witchcraft never deletes tracks,
+    so the ids are dense and the draws hit ``n`` distinct tracks. When the id
+    range is too small for that, the whole table is shuffled instead, which
+    is cheap because the table is small.
+    """
+    samples_per_track = _samples_per_track * n
+
+    # separate subqueries so that sqlite answers each from the primary key
+    # instead of scanning the table for both
+    bounds = sa.select((
+        sa.select((sa.func.min(tracks.c.id),)).as_scalar().label('low'),
+        sa.select((sa.func.max(tracks.c.id),)).as_scalar().label('high'),
+    )).cte('bounds')
+    id_range = sa.select((bounds.c.high - bounds.c.low + 1,)).as_scalar()
+    small = id_range < samples_per_track
+
+    points = sa.select((
+        sa.literal(0).label('n'),
+        sa.null().label('point'),
+    )).cte('points', recursive=True)
+    points = points.union_all(
+        sa.select((
+            points.c.n + 1,
+            bounds.c.low + sa.func.abs(sa.func.random()) % (
+                bounds.c.high - bounds.c.low + 1
+            ),
+        )).where(
+            points.c.n < samples_per_track,
+        ),
+    )
+
+    # the seek is correlated with ``points`` so that it runs once per point
+    seek = tracks.alias('seek')
+    sampled_ids = sa.select((
+        sa.select((seek.c.id,)).where(
+            seek.c.id >= points.c.point,
+        ).order_by(seek.c.id).limit(1).as_scalar(),
+    )).where(points.c.point.isnot(None))
+
+    sampled = sa.select((tracks.c.path,)).where(
+        sa.and_(~small, tracks.c.id.in_(sampled_ids)),
+    ).order_by(sa.func.random()).limit(n)
+
+    # sqlite does not skip a scan when a subquery makes the where clause
+    # false, so bound the scan by the id range as well
+    low = sa.select((bounds.c.low,)).as_scalar()
+    shuffled = sa.select((tracks.c.path,)).where(
+        sa.and_(small, tracks.c.id < low + samples_per_track),
+    ).order_by(sa.func.random()).limit(n)
+
+    return sa.select((sa.literal_column('path'),)).select_from(
+        sa.union_all(
+            sa.select(('*',)).select_from(sampled.alias()),
+            sa.select(('*',)).select_from(shuffled.alias()),
+        ).alias(),
+    )
+
+
+# ``shuffle_key`` works modulo 2 ** 31 so that its products fit in sqlite's
+# 64 bit integers
+_shuffle_modulus = 2 ** 31
+
+
+def _xor(a, b):
+    # sqlite has no xor operator
+    return a.op('|')(b) - a.op('&')(b)
+
+
+def shuffle_key(seed, column):
+    """A pseudo random permutation of an integer column.
+
+    Parameters
+    ----------
+    seed : int
+        The seed which picks the permutation.
+    column : sa.sql.ColumnElement
+        The integer column to permute.
+
+    Returns
+    -------
+    key : sa.sql.ColumnElement
+        The permuted value. Ordering by this shuffles the rows, but unlike
+        ``random()`` the order is the same every time for the same seed.
+    """
+    x = (column + seed) % _shuffle_modulus
+    x = (x * 1103515245 + 12345) % _shuffle_modulus
+    x = _xor(x, x.op('>>')(13))
+    x = (x * 1597334677) % _shuffle_modulus
+    return _xor(x, x.op('>>')(16))
+
+
+def _reseed(seed, n):
+    """Derive the seed for a subquery.
+    """
+    if seed is None:
+        return None
+    return (seed * 69069 + n) % _shuffle_modulus
+
+
+class Segment:
+    """One of the statements that a query compiles to.
+
+    Parameters
+    ----------
+    from_obj : sa.sql.FromClause
+        The ``track_search`` table, possibly joined with the best matching
+        artist for each track.
+    where : sa.sql.ColumnElement
+        The filter for the tracks.
+    order_by : list[sa.sql.ColumnElement]
+        The keys to sort the tracks by, all ascending. Unless the segment is
+        shuffled with ``random()``, the keys are unique for each track.
+    take : int or None
+        The maximum number of tracks to select.
+    sample : bool, optional
+        Select a random sample of the whole library with
+        :func:`sample_tracks`.
+    """
+    def __init__(self, from_obj, where, order_by, take, sample=False):
+        self.from_obj = from_obj
+        self.where = where
+        self.order_by = order_by
+        self.take = take
+        self.sample = sample
+
+    def select(self):
+        """The select for all of the paths in this segment.
+        """
+        if self.sample:
+            return sample_tracks(self.take)
+
+        return sa.select((
+            track_search.c.path,
+        )).select_from(
+            self.from_obj,
+        ).where(
+            self.where,
+        ).order_by(
+            *self.order_by
+        ).limit(
+            self.take,
+        )
+
+    def page(self, after, limit):
+        """The select for one page of this segment.
+
+        Parameters
+        ----------
+        after : list or None
+            The sort keys of the last row of the previous page, or None to
+            start at the beginning.
+        limit : int
+            The number of rows in the page.
+
+        Returns
+        -------
+        select : sa.sql.Select
+            The select which returns the path followed by the sort keys for
+            each row of the page. This seeks past ``after`` instead of
+            counting rows with ``OFFSET``.
+        """
+        where = self.where
+        if after is not None:
+            where = sa.and_(
+                where,
+                sa.tuple_(*self.order_by) > sa.tuple_(*map(sa.literal, after)),
+            )
+
+        return sa.select(
+            [track_search.c.path] + [
+                key.label('key_%d' % n) for n, key in enumerate(self.order_by)
+            ],
+        ).select_from(
+            self.from_obj,
+        ).where(
+            where,
+        ).order_by(
+            *self.order_by
+        ).limit(
+            limit,
+        )
+
+
+def compile_segments(query, seed=None):
+    """Compile a Query object into segments.
 
     Parameters
     ----------
     query : Query
         The query to compile.
+    seed : int, optional
+        The seed for ``shuffle``. When given, shuffled segments are ordered
+        by :func:`shuffle_key` instead of ``random()`` so that they can be
+        paged through.
 
     Yields
-    -------
-    selects : sa.sql.Select
-        The select to execute which will return the paths to the tracks
-        selected by the query. These should be concatenated in order.
+    ------
+    segment : Segment
+        The segments whose tracks should be concatenated in order.
     """
-    from_obj = tracks
+    # ``track_search`` holds the title, album, and path of each track so most
+    # queries only read one table
+    from_obj = track_search
     where = True
 
     # play tracks in the order they are matched by the title patterns
     order_by = []
 
     if query.on is not None and '.' not in query.on:
-        # ``on`` clauses turn into a join against the ``albums`` table
-        # through the ``album_contents`` table.
-        from_obj = from_obj.join(
-            album_contents,
-            album_contents.c.track_id == tracks.c.id,
-        ).join(
-            albums,
-            album_contents.c.album_id == albums.c.id,
-
+        # ``on`` clauses filter on the track's album. Order the tracks by the
+        # album pattern that matched them, if the pattern matches multiple
+        # albums, sort the albums inside the match; ``NULL`` sorts first, but
+        # is not comparable in a page's seek
+        album_filter, album_order = pattern_match(
+            track_search.c.album_title,
+            query.on,
+            _approximate_album,
         )
-        where = sa.and_(
-            where,
-            sa.or_(*(
-                albums.c.title.like(fuzzy(album)) for album in query.on
-            )),
-        )
-
-        # order the tracks by the album pattern that matched them, if the
-        # pattern matches multiple albums, sort the albums inside the match
-        order_by.extend(pattern_order(albums.c.title, query.on))
-        order_by.append(album_contents.c.track_number)
+        where = sa.and_(where, album_filter)
+        order_by.extend(album_order)
+        order_by.append(sa.func.coalesce(
+            track_search.c.track_number,
+            -2 ** 63,
+        ))
 
     if query.by is not None and '.' not in query.by:
-        # ``by`` clauses turn into a join against the ``artists`` table
-        # through the ``track_artists`` table. An on clause will match
-        # tracks even if the author is not the sole author.
-        from_obj = from_obj.join(
-            track_artists,
-            track_artists.c.track_id == tracks.c.id,
-        ).join(
-            artists,
-            track_artists.c.artist_id == artists.c.id,
+        # ``by`` clauses turn into a join against the best matching artist
+        # for each track through the ``track_artists`` table. A ``by`` clause
+        # will match tracks even if the artist is not the sole artist, and a
+        # collaboration between matching artists is only selected once.
+        matches, keys = best_matches(
+            track_artists.c.artist_id,
+            artists.c.name,
+            query.by,
+            partial(
+                approximate_match,
+                artists.c.id,
+                artist_name_words.c.artist_id,
+            ),
         )
-        where = sa.and_(
-            where,
-            sa.or_(*(
-                artists.c.name.like(fuzzy(artist)) for artist in query.by
-            )),
+        from_obj = from_obj.join(
+            matches,
+            sa.and_(
+                matches.c.track_id == track_search.c.track_id,
+                matches.c.n == 1,
+            ),
         )
-
-        # order the tracks by the artist pattern that matched them
-        order_by.extend(pattern_order(artists.c.name, query.by))
+        order_by.extend(keys)
 
     # The title names get converted into filters against the title of the
     # track. The special title '.' means match all tracks.
-    where = sa.and_(
-        where,
-        sa.or_(*(
-            tracks.c.title.like(fuzzy(title))
+    approximate_title = partial(
+        approximate_match,
+        track_search.c.track_id,
+        track_title_words.c.track_id,
+    )
+    title_filter, title_order = pattern_match(
+        track_search.c.title,
+        query.titles,
+        approximate_title,
+    )
+    if '.' in query.titles:
+        title_filter = sa.or_(*(
+            pattern_condition(track_search.c.title, title, approximate_title)
             for title in query.titles
             if title != '.'
-        )),
-    )
-
-    order_by.extend(pattern_order(tracks.c.title, query.titles))
-
+        ))
+    where = sa.and_(where, title_filter)
+
+    # the metadata filters are semi-joins so they do not change the rows
+    metadata_filters = []
+    if query.genres is not None:
+        metadata_filters.append(entity_filter(
+            track_genres.c.genre_id,
+            query.genres,
+        ))
+    if query.labels is not None:
+        metadata_filters.append(entity_filter(
+            track_labels.c.label_id,
+            query.labels,
+        ))
+    if query.years is not None:
+        metadata_filters.append(year_filter(*query.years))
+    if query.bpms is not None:
+        metadata_filters.append(range_filter(tracks.c.bpm, *query.bpms))
+    where = sa.and_(where, *metadata_filters)
+
+    order_by.extend(title_order)
+    # break ties between tracks with the same title so the order does not
+    # depend on the query plan
+    order_by.append(track_search.c.track_id)
+
+    sample = False
     if query.shuffle:
         # if we are shuffling this group, throw away the old order by and
         # just randomly shuffle it
-        order_by = [sa.func.random()]
+        if seed is not None:
+            order_by = [
+                shuffle_key(seed, track_search.c.track_id),
+                track_search.c.track_id,
+            ]
+        else:
+            order_by = [sa.func.random()]
+            # a random sample of the whole library does not need to look at
+            # every track
+            sample = (
+                query.take is not None and
+                from_obj is track_search and
+                not metadata_filters and
+                all(title == '.' for title in query.titles) and
+                not query.except_
+            )
 
     if query.except_:
-        except_, *tail = compile_query(query.except_)
+        except_, *tail = compile_segments(query.except_, _reseed(seed, 1))
         where = sa.and_(
             where,
-            ~tracks.c.path.in_(except_),
+            ~track_search.c.path.in_(except_.select()),
         )
     else:
         tail = ()
 
-    select = sa.select((
-        tracks.c.path,
-    )).select_from(
-        from_obj,
-    ).where(
-        where,
-    ).order_by(
-        *order_by
-    )
-
-
-    yield select
+    yield Segment(from_obj, where, order_by, query.take, sample)
     yield from tail
 
     if query.then:
         # emit the queries for the union(s)
-        yield from compile_query(query.then)
+        yield from compile_segments(query.then, _reseed(seed, 2))
 
     yield from tail
 
 
+def compile_query(query):
+    """"Compile a Query object into sql and flags to ``mpv``.
+
+    Parameters
+    ----------
+    query : Query
+        The query to compile.
+
+    Yields
+    -------
+    selects : sa.sql.Select
+        The select to execute which will return the paths to the tracks
+        selected by the query. These should be concatenated in order.
+    """
+    for segment in compile_segments(query):
+        yield segment.select()
+
+
 def compile(source):
     """Compile a witchcraft ql query into sql and flags to ``mpv``.
 
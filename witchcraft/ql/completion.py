@@ -1,10 +1,16 @@
 import sqlalchemy as sa
 
+from .columnar import Strings
+from .compiler import fuzzy, pattern_match
 from .lexer import Keyword, Name
-from .parser import CompletionClass, completion_class
+from .parser import CompletionClass, completion_context
 from ..schema import (
+    album_contents,
     albums,
     artists,
+    genres,
+    labels,
+    track_artists,
     tracks,
 )
 
@@ -19,8 +25,178 @@ def register_completer(cls):
     return dec
 
 
+def _narrowing(filters, clause):
+    """Get the patterns of a clause which narrows the completions, or None.
+    """
+    patterns = filters.get(clause)
+    if patterns is None or '.' in patterns:
+        # ``.`` matches everything
+        return None
+    if any(pattern[0] == '~' for pattern in patterns):
+        # approximate patterns are too slow to match on each key press
+        return None
+    return patterns
+
+
+# the albums and artists which appear on the same track
+_album_artists = album_contents.join(
+    track_artists,
+    album_contents.c.track_id == track_artists.c.track_id,
+)
+
+
+class CompletionIndex:
+    """The album titles, artist names, and which artists appear on which
+    albums, held in memory for completion.
+
+    Parameters
+    ----------
+    conn : sa.engine.Connection
+        The connection to load the index with. The index holds onto this
+        connection to notice when the database has been written to.
+
+    Notes
+    -----
+    Narrowing the albums to the ones by the artists in a ``by`` clause, or
+    the artists to the ones on the albums in an ``on`` clause, is a lookup in
+    the adjacency sets instead of a join for each key press. The index is
+    reloaded from scratch when the database changes, which only happens when
+    music is ingested.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+        self._data_version = None
+        self.refresh()
+
+    def refresh(self):
+        """Reload the index if the database has been written to.
+
+        Returns
+        -------
+        changed : bool
+            Whether the database changed since the last refresh.
+        """
+        conn = self._conn
+        with conn.begin():
+            data_version = conn.scalar('PRAGMA data_version')
+            if data_version == self._data_version:
+                return False
+
+            self._load()
+            self._data_version = data_version
+        return True
+
+    def _names(self, id_column, name_column):
+        rows = self._conn.execute(
+            sa.select((id_column, name_column)).order_by(id_column),
+        ).fetchall()
+        names = Strings()
+        names.extend(name for _, name in rows)
+        return {id_: row for row, (id_, _) in enumerate(rows)}, names
+
+    def _load(self):
+        album_rows, self._album_titles = self._names(
+            albums.c.id,
+            albums.c.title,
+        )
+        artist_rows, self._artist_names = self._names(
+            artists.c.id,
+            artists.c.name,
+        )
+
+        # album row -> artist rows, and artist row -> album rows
+        self._album_artists = album_artists = [set() for _ in album_rows]
+        self._artist_albums = artist_albums = [set() for _ in artist_rows]
+        pairs = self._conn.execute(
+            sa.select((
+                album_contents.c.album_id,
+                track_artists.c.artist_id,
+            )).select_from(_album_artists).distinct(),
+        )
+        for album_id, artist_id in pairs:
+            album_row = album_rows[album_id]
+            artist_row = artist_rows[artist_id]
+            album_artists[album_row].add(artist_row)
+            artist_albums[artist_row].add(album_row)
+
+    @staticmethod
+    def _complete(names, lexeme, linked_names, links, patterns):
+        if isinstance(lexeme, Name):
+            rows = names.match('%s%%' % lexeme.string)
+        else:
+            rows = None
+
+        if patterns is not None:
+            narrowed = set()
+            for pattern in patterns:
+                matched = linked_names.match(fuzzy(pattern))
+                if matched is None:
+                    # the pattern matches everything
+                    narrowed = None
+                    break
+                for row in matched:
+                    narrowed |= links[row]
+
+            if narrowed is not None:
+                rows = narrowed if rows is None else rows & narrowed
+
+        if rows is None:
+            rows = range(len(names))
+        else:
+            rows = sorted(rows)
+        return [names[row] for row in rows]
+
+    def complete_album(self, lexeme, by):
+        """Complete an album title.
+
+        Parameters
+        ----------
+        lexeme : Lexeme or None
+            The last lexeme that was parsed.
+        by : list[str] or None
+            The artist patterns to narrow the albums to.
+
+        Returns
+        -------
+        titles : list[str]
+            The album titles which start with the lexeme and have a track by
+            an artist which matches ``by``.
+        """
+        return self._complete(
+            self._album_titles,
+            lexeme,
+            self._artist_names,
+            self._artist_albums,
+            by,
+        )
+
+    def complete_artist(self, lexeme, on):
+        """Complete an artist name.
+
+        Parameters
+        ----------
+        lexeme : Lexeme or None
+            The last lexeme that was parsed.
+        on : list[str] or None
+            The album patterns to narrow the artists to.
+
+        Returns
+        -------
+        names : list[str]
+            The artist names which start with the lexeme and appear on an
+            album which matches ``on``.
+        """
+        return self._complete(
+            self._artist_names,
+            lexeme,
+            self._album_titles,
+            self._album_artists,
+            on,
+        )
+
+
 @register_completer(CompletionClass.keyword)
-def complete_keyword(engine, lexeme):
+def complete_keyword(engine, lexeme, filters, index):
     if lexeme is None:
         prefix = ''
     else:
@@ -29,30 +205,78 @@ def complete_keyword(engine, lexeme):
     return [kw for kw in Keyword.keywords if kw.startswith(prefix)]
 
 
-def _complete_sql(column, engine, lexeme):
+def _complete_sql(column, engine, lexeme, where=None):
     sel = sa.select([column])
     if isinstance(lexeme, Name):
         sel = sel.where(column.like('%s%%' % lexeme.string))
+    if where is not None:
+        sel = sel.where(where)
 
     return [c for c, in engine.execute(sel).fetchall()]
 
 
 @register_completer(CompletionClass.title)
-def complete_title(engine, lexeme):
+def complete_title(engine, lexeme, filters, index):
     return _complete_sql(tracks.c.title, engine, lexeme)
 
 
 @register_completer(CompletionClass.artist)
-def complete_artist(engine, lexeme):
-    return _complete_sql(artists.c.name, engine, lexeme)
+def complete_artist(engine, lexeme, filters, index):
+    on = _narrowing(filters, 'on')
+    if index is not None:
+        index.refresh()
+        return index.complete_artist(lexeme, on)
+
+    where = None
+    if on is not None:
+        where = artists.c.id.in_(
+            sa.select((track_artists.c.artist_id,)).select_from(
+                _album_artists.join(
+                    albums,
+                    albums.c.id == album_contents.c.album_id,
+                ),
+            ).where(pattern_match(albums.c.title, on)[0]),
+        )
+    return _complete_sql(artists.c.name, engine, lexeme, where)
 
 
 @register_completer(CompletionClass.album)
-def complete_album(engine, lexeme):
-    return _complete_sql(albums.c.title, engine, lexeme)
+def complete_album(engine, lexeme, filters, index):
+    by = _narrowing(filters, 'by')
+    if index is not None:
+        index.refresh()
+        return index.complete_album(lexeme, by)
+
+    where = None
+    if by is not None:
+        where = albums.c.id.in_(
+            sa.select((album_contents.c.album_id,)).select_from(
+                _album_artists.join(
+                    artists,
+                    artists.c.id == track_artists.c.artist_id,
+                ),
+            ).where(pattern_match(artists.c.name, by)[0]),
+        )
+    return _complete_sql(albums.c.title, engine, lexeme, where)
+
+
+@register_completer(CompletionClass.genre)
+def complete_genre(engine, lexeme, filters, index):
+    return _complete_sql(genres.c.genre, engine, lexeme)
+
 
+@register_completer(CompletionClass.label)
+def complete_label(engine, lexeme, filters, index):
+    return _complete_sql(labels.c.label, engine, lexeme)
 
-def completions(engine, source):
+
+@register_completer(CompletionClass.number)
+def complete_number(engine, lexeme, filters, index):
+    # any number is valid, there is nothing to suggest
+    return []
+
+
+def completions(engine, source, index=None):
     """Generate a list of completions for the given partial query.
 
     Parameters
@@ -60,14 +284,23 @@ def completions(engine, source):
     engine : sa.engine.Engine
     source : str
         The query to complete
+    index : CompletionIndex, optional
+        The in-memory index to complete albums and artists with instead of
+        sqlite.
 
     Returns
     -------
     completions : list[str]
         The potential completions.
+
+    Notes
+    -----
+    Albums are narrowed to the ones with a track by an artist in the ``by``
+    clause, and artists to the ones on an album in the ``on`` clause, when
+    that clause has already been typed.
     """
-    cls, lexeme = completion_class(source)
-    completion = _completers[cls](engine, lexeme)
+    cls, lexeme, filters = completion_context(source)
+    completion = _completers[cls](engine, lexeme, filters, index)
     last_word = source.rsplit(' ', 1)[-1]
     if ',' in last_word:
         last_word_prefix = last_word.split(',')[:-1]
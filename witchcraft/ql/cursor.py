@@ -0,0 +1,116 @@
+import base64
+import binascii
+import hashlib
+import json
+import random
+
+from .compiler import _shuffle_modulus
+
+
+def query_checksum(source):
+    """Identify a query so that a cursor is not used with another query.
+
+    Parameters
+    ----------
+    source : str
+        The query source.
+
+    Returns
+    -------
+    checksum : str
+        The checksum of the source, ignoring differences in whitespace.
+    """
+    normalized = ' '.join(source.split()).encode('utf-8')
+    return hashlib.sha1(normalized).hexdigest()[:16]
+
+
+class Cursor:
+    """A position in the results of a query.
+
+    Parameters
+    ----------
+    checksum : str
+        The :func:`query_checksum` of the query.
+    seed : int
+        The seed for the query's shuffled segments. This is fixed when the
+        first page is selected so that every page sees the same order.
+    segment : int, optional
+        The index of the segment to resume in.
+    after : list or None, optional
+        The sort keys of the last row returned from the segment, or None to
+        start at the beginning of the segment.
+    taken : int, optional
+        The number of rows already returned from the segment. This is needed
+        to respect the segment's ``take``.
+    """
+    version = 1
+
+    def __init__(self, checksum, seed, segment=0, after=None, taken=0):
+        self.checksum = checksum
+        self.seed = seed
+        self.segment = segment
+        self.after = after
+        self.taken = taken
+
+    @classmethod
+    def start(cls, source):
+        """A cursor at the beginning of a query's results.
+        """
+        return cls(query_checksum(source), random.randrange(_shuffle_modulus))
+
+    def encode(self):
+        """Encode the cursor as an opaque token.
+
+        Returns
+        -------
+        token : str
+            The url safe token.
+        """
+        data = json.dumps(
+            [
+                self.version,
+                self.checksum,
+                self.seed,
+                self.segment,
+                self.after,
+                self.taken,
+            ],
+            separators=(',', ':'),
+        ).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+    @classmethod
+    def decode(cls, token, source):
+        """Decode a token from :meth:`encode`.
+
+        Parameters
+        ----------
+        token : str
+            The token.
+        source : str
+            The query the token is being used with.
+
+        Returns
+        -------
+        cursor : Cursor
+            The decoded cursor.
+
+        Raises
+        ------
+        ValueError
+            Raised when the token is malformed or was made for a different
+            query.
+        """
+        try:
+            data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+            version, checksum, seed, segment, after, taken = json.loads(
+                data.decode('utf-8'),
+            )
+        except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+            raise ValueError('invalid cursor: %r' % token)
+
+        if version != cls.version:
+            raise ValueError('unsupported cursor version: %r' % version)
+        if checksum != query_checksum(source):
+            raise ValueError('cursor was not created by this query')
+        return cls(checksum, seed, segment, after, taken)
@@ -0,0 +1,191 @@
+from textwrap import indent
+import time
+
+from .compiler import compile_query
+from .lexer import lex
+from .parser import parse_lexemes
+from ..utils import literal_sql_compile
+
+
+class Segment:
+    """The profile of one of the statements that a query compiles to.
+
+    Parameters
+    ----------
+    sql : str
+        The compiled sql with the parameters inlined.
+    plan : list[tuple[int, int, str]]
+        The ``(id, parent, detail)`` rows of ``EXPLAIN QUERY PLAN``.
+    execute_time : float
+        The time to execute the statement and fetch all of the rows, in
+        seconds.
+    rows : int
+        The number of rows returned.
+    """
+    def __init__(self, sql, plan, execute_time, rows):
+        self.sql = sql
+        self.plan = plan
+        self.execute_time = execute_time
+        self.rows = rows
+
+
+class Explanation:
+    """The profile of a query.
+
+    Parameters
+    ----------
+    source : str
+        The query source.
+    query : Query
+        The parsed query.
+    segments : list[Segment]
+        The profile of each compiled statement, in the order they are played.
+    timings : dict[str, float]
+        The time spent lexing, parsing, compiling, and executing the query, in
+        seconds.
+    """
+    def __init__(self, source, query, segments, timings):
+        self.source = source
+        self.query = query
+        self.segments = segments
+        self.timings = timings
+
+    def __str__(self):
+        return format_explanation(self)
+
+
+def explain(conn, source):
+    """Compile and run a query, recording the sql, query plan, and time spent
+    in each phase.
+
+    Parameters
+    ----------
+    conn : sa.engine.Connection
+        The connection to the metadata database.
+    source : str
+        The witchcraft ql query to explain.
+
+    Returns
+    -------
+    explanation : Explanation
+        The profile of the query.
+
+    Raises
+    ------
+    ValueError
+        Raised when the source is not a valid query.
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    lexemes = list(lex(source))
+    timings['lex'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    query = parse_lexemes(lexemes, source)
+    timings['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    selects = list(compile_query(query))
+    timings['compile'] = time.perf_counter() - start
+
+    segments = []
+    for select in selects:
+        sql = literal_sql_compile(select)
+        plan = [
+            (row[0], row[1], row[-1])
+            for row in conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+        ]
+
+        start = time.perf_counter()
+        rows = len(conn.execute(select).fetchall())
+        execute_time = time.perf_counter() - start
+
+        segments.append(Segment(sql, plan, execute_time, rows))
+
+    timings['execute'] = sum(segment.execute_time for segment in segments)
+    return Explanation(source, query, segments, timings)
+
+
+def format_query(query):
+    """Format a query as an indented tree.
+
+    Parameters
+    ----------
+    query : Query
+        The query to format.
+
+    Returns
+    -------
+    formatted : str
+        The formatted query.
+    """
+    lines = ['Query']
+    for name in ('titles', 'on', 'by', 'shuffle', 'take'):
+        lines.append('  %s: %r' % (name, getattr(query, name)))
+    for name in ('genres', 'labels', 'years', 'bpms'):
+        value = getattr(query, name)
+        if value is None:
+            # most queries do not filter on metadata
+            continue
+        lines.append('  %s: %r' % (name, value))
+
+    for name, subquery in (('except', query.except_), ('then', query.then)):
+        if subquery is not None:
+            lines.append('  %s:' % name)
+            lines.append(indent(format_query(subquery), '    '))
+
+    return '\n'.join(lines)
+
+
+def _format_plan(plan):
+    depths = {0: -1}
+    lines = []
+    for id_, parent, detail in plan:
+        depth = depths[id_] = depths.get(parent, -1) + 1
+        lines.append('%s%s' % ('  ' * depth, detail))
+    return '\n'.join(lines)
+
+
+def format_explanation(explanation):
+    """Format an explanation for the command line.
+
+    Parameters
+    ----------
+    explanation : Explanation
+        The explanation to format.
+
+    Returns
+    -------
+    formatted : str
+        The formatted explanation.
+    """
+    lines = [
+        'source: %s' % explanation.source,
+        '',
+        format_query(explanation.query),
+    ]
+    for n, segment in enumerate(explanation.segments):
+        lines.extend([
+            '',
+            'segment %d: %d rows in %.3f ms' % (
+                n,
+                segment.rows,
+                segment.execute_time * 1e3,
+            ),
+            '  sql:',
+            indent(segment.sql, '    '),
+            '  plan:',
+            indent(_format_plan(segment.plan), '    '),
+        ])
+
+    lines.extend(['', 'timings:'])
+    for phase in ('lex', 'parse', 'compile', 'execute'):
+        lines.append(
+            '  %-8s %10.3f ms' % (phase, explanation.timings[phase] * 1e3),
+        )
+    lines.append('  %-8s %10.3f ms' % (
+        'total',
+        sum(explanation.timings.values()) * 1e3,
+    ))
+    return '\n'.join(lines)
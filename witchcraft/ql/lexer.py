@@ -37,10 +37,14 @@ class Lexeme(metaclass=LexemeMeta):
     string : str
         The string matching this lexeme's pattern.
     """
+    # where a name is expected, like the start of a query or after a keyword
+    # or comma
     default_startcode = 'default_startcode'
+    # after a name, where a clause may start
+    clause_startcode = 'clause_startcode'
 
     pattern = None
-    startcodes = default_startcode,
+    startcodes = default_startcode, clause_startcode
     begins = default_startcode
 
     def __init__(self, string, col_offset):
@@ -65,13 +69,32 @@ class Keyword(Lexeme):
         super().__init__(string.strip(), col_offset)
 
     @classmethod
-    def from_keyword(cls, keyword):
+    def from_keyword(cls, keyword, *, contextual=False, begins=None):
+        """Create a keyword lexeme type.
+
+        Parameters
+        ----------
+        keyword : str
+            The keyword.
+        contextual : bool, optional
+            Only read the keyword where a clause may start. Where a name is
+            expected, the keyword is read as a ``Name``.
+        begins : any, optional
+            The startcode to enter after the keyword. Defaults to the startcode
+            where a name is expected.
+
+        Returns
+        -------
+        keyword_type : type
+            The new subclass of ``Keyword``.
+        """
         cls.keywords.add(keyword)
-        return type(
-            capwords(keyword),
-            (cls,),
-            {'pattern': re.compile(keyword + r'(\s|$)')},
-        )
+        dict_ = {'pattern': re.compile(keyword + r'(\s|$)')}
+        if contextual:
+            dict_['startcodes'] = cls.clause_startcode,
+        if begins is not None:
+            dict_['begins'] = begins
+        return type(capwords(keyword), (cls,), dict_)
 
     def unexpected(self):
         return 'unexpected %r' % type(self).__name__.lower()
@@ -81,7 +104,15 @@ Except = Keyword.from_keyword('except')
 Then = Keyword.from_keyword('then')
 On = Keyword.from_keyword('on')
 By = Keyword.from_keyword('by')
-Shuffle = Keyword.from_keyword('shuffle')
+# ``take`` may follow ``shuffle``
+Shuffle = Keyword.from_keyword('shuffle', begins=Lexeme.clause_startcode)
+# these were added after queries were written with them as names, so they are
+# only keywords where a clause may start
+Take = Keyword.from_keyword('take', contextual=True)
+Genre = Keyword.from_keyword('genre', contextual=True)
+Label = Keyword.from_keyword('label', contextual=True)
+From = Keyword.from_keyword('from', contextual=True)
+Bpm = Keyword.from_keyword('bpm', contextual=True)
 
 
 class Punctuation(Lexeme):
@@ -110,12 +141,16 @@ class Name(Lexeme):
     Notes
     -----
     Keywords are checked first, if you want to use a keyword as a name it can
-    be escaped with a colon like ``:on``.
+    be escaped with a colon like ``:on``. ``take``, ``genre``, ``label``,
+    ``from``, and ``bpm`` are only keywords after a name, so they do not need
+    to be escaped where a name is expected.
 
     A name may begin with ``^`` or end with ``$`` which will force it to match
-    that anchor like a regex.
+    that anchor like a regex. A name which begins with ``~`` matches names
+    with each of its words spelled within a few typos.
     """
-    pattern = re.compile(r'(:\^)?[\.a-zA-Z0-9\-]+\$?')
+    pattern = re.compile(r'(:\^|~)?[\.a-zA-Z0-9\-]+\$?')
+    begins = Lexeme.clause_startcode
 
     def __init__(self, string, col_offset):
         super().__init__(
@@ -148,13 +183,15 @@ class Ignore(Lexeme):
         raise AssertionError('we should never get an Ignore lexeme')
 
 
-def lex(source):
+def lex(source, pos=0):
     """Turn the source of a query into a stream of Lexemes
 
     Parameters
     ----------
     src : str
         The input string.
+    pos : int, optional
+        The column to start lexing from.
 
     Yields
     ------
@@ -162,35 +199,32 @@ def lex(source):
         Lexemes from the source input.
     """
     startcode = Lexeme.default_startcode
-    col_offset = 0
+    end = len(source)
 
     lexeme_types = LexemeMeta.lexeme_types
-    while source:
+    while pos < end:
         for lexeme_type in lexeme_types:
             if startcode not in lexeme_type.startcodes:
                 continue
 
-            match = lexeme_type.pattern.match(source)
+            # match in place instead of slicing off the consumed source so
+            # that long queries are not copied once per lexeme
+            match = lexeme_type.pattern.match(source, pos)
             if match is None:
                 # check the next lexeme type's pattern
                 continue
 
-            lexeme = lexeme_type(
-                match.string[slice(*match.span())],
-                col_offset,
-            )
+            lexeme = lexeme_type(match.group(), pos)
             if lexeme_type is not Ignore:
-                # don't yield the Ignore lexeme
+                # don't yield the Ignore lexeme, and stay in the same
+                # startcode across whitespace
                 yield lexeme
+                startcode = lexeme.begins
 
-            to_consume = match.end()
-            col_offset += to_consume
-            startcode = lexeme.begins
+            # advance the pointer into the source
+            pos = match.end()
             break
         else:
             raise ValueError(
-                'invalid lexer state, no lexeme matched: %s' % source,
+                'invalid lexer state, no lexeme matched: %s' % source[pos:],
             )
-
-        # advance the pointer into the source
-        source = source[to_consume:]
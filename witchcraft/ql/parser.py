@@ -1,19 +1,36 @@
+from collections import OrderedDict
 import enum
 from itertools import chain
+import re
 
 from .iterator import PeekableIterator
 from .lexer import (
+    Bpm,
     By,
     Comma,
     Except,
+    From,
+    Genre,
+    Label,
     Name,
     On,
     Shuffle,
+    Take,
     Then,
     lex,
 )
 
 
+# a number, or a range of numbers with optional ends like ``2015..2018``
+_range_pattern = re.compile(r'(\d*)(\.\.)?(\d*)$')
+
+# the ends of the ``except`` and ``then`` keywords which a subquery could
+# start after
+_subquery_keyword_pattern = re.compile(
+    r'(?:^|(?<=[\s,]))(?:except|then)(?=\s)',
+)
+
+
 class BadParse(Exception):
     """Signals that the lexeme stream did not match the grammar.
 
@@ -37,6 +54,9 @@ class CompletionClass(enum.Enum):
     title = enum.auto()
     artist = enum.auto()
     album = enum.auto()
+    genre = enum.auto()
+    label = enum.auto()
+    number = enum.auto()
 
 
 class _QueryParser:
@@ -47,12 +67,20 @@ class _QueryParser:
     ----------
     stream : PeekableIterator[Lexeme]
         The stream of lexemes to parse.
+    subqueries : list[(Lexeme, _QueryParser)], optional
+        The list to record the ``except`` or ``then`` lexeme and the parser
+        for each subquery in. This is shared with the parsers for the
+        subqueries so that it holds every subquery in the order they were
+        started.
     """
-    def __init__(self, stream):
+    def __init__(self, stream, subqueries=None):
         self.stream = stream
         self.skipped_lexeme_types = set()
         self.completion_class = CompletionClass.title
         self.last_lexeme = None
+        self.subqueries = [] if subqueries is None else subqueries
+        # the name clauses which have been parsed so far, for completion
+        self.filters = {}
 
     @property
     def have_more(self):
@@ -138,13 +166,16 @@ class _QueryParser:
             self.last_lexeme = next(stream)
             f()
 
-    def parse_names(self, completion_class):
+    def parse_names(self, completion_class, approximate=True):
         """Parse a comma delimited list of names.
 
         Parameters
         ----------
         completion_class : CompletionClass
             The completion class to set for the current name.
+        approximate : bool, optional
+            Whether the names may start with ``~``. Names which are matched
+            exactly, like genres, cannot be approximate.
 
         Returns
         -------
@@ -152,48 +183,137 @@ class _QueryParser:
             The comma delimited list of names or None if '.' is in the list.
         """
         self.completion_class = completion_class
-        names = [self.expect(Name).string]
+
+        def parse_name():
+            lexeme = self.expect(Name)
+            if not approximate and lexeme.string[0] == '~':
+                raise BadParse(
+                    lexeme,
+                    '%s: %s names cannot be matched approximately' % (
+                        lexeme.unexpected(),
+                        completion_class.name,
+                    ),
+                )
+            return lexeme.string
+
+        names = [parse_name()]
 
         def parse_more_names():
             """Append the new names and check for more comma delimited names
             """
-            names.append(self.expect(Name).string)
+            names.append(parse_name())
             self.accept({Comma: parse_more_names}, completion_class)
 
         # parse any extra names
         self.accept({Comma: parse_more_names}, completion_class)
         return names
 
+    def parse_range(self):
+        """Parse a number or an inclusive range of numbers like ``170..175``.
+        Either end of the range may be left off.
+
+        Returns
+        -------
+        low, high : int or None
+            The bounds of the range, or None for an open end.
+        """
+        self.completion_class = CompletionClass.number
+        lexeme = self.expect(Name)
+        match = _range_pattern.match(lexeme.string)
+        if match is None or match.group(0) == '..':
+            raise BadParse(
+                lexeme,
+                '%s: expected a number or a range like 170..175' % (
+                    lexeme.unexpected(),
+                ),
+            )
+
+        low, dots, high = match.groups()
+        if not dots:
+            return int(low), int(low)
+        return (
+            int(low) if low else None,
+            int(high) if high else None,
+        )
+
     def parse(self):
         titles = self.parse_names(CompletionClass.title)
         on = None
         by = None
+        genres = None
+        labels = None
+        years = None
+        bpms = None
         shuffle = False
+        take = None
         except_ = None
         then = None
 
+        # the filter clauses which have not been used yet
+        clauses = {}
+
+        def clause(lexeme_type):
+            """Register the parser for a filter clause. After the clause is
+            parsed, check for any of the remaining clauses.
+            """
+            def dec(f):
+                def parse_clause():
+                    del clauses[lexeme_type]
+                    f()
+                    self.accept(clauses, CompletionClass.keyword)
+
+                clauses[lexeme_type] = parse_clause
+                return f
+            return dec
+
+        @clause(On)
         def parse_on():
-            """Parse an ``on`` clause. If we haven't already added a ``by``,
-            check for a ``by`` clause.
+            """Parse an ``on`` clause.
             """
             nonlocal on
-
             on = self.parse_names(CompletionClass.album)
-            if by is None:
-                self.accept({By: parse_by}, CompletionClass.keyword)
+            self.filters['on'] = on
 
+        @clause(By)
         def parse_by():
-            """Parse a ``by`` clause. If we haven't already added an ``on``,
-            check for a ``on`` clause.
+            """Parse a ``by`` clause.
             """
             nonlocal by
-
             by = self.parse_names(CompletionClass.artist)
-            if on is None:
-                self.accept({On: parse_on}, CompletionClass.keyword)
+            self.filters['by'] = by
 
-        # parse the ``on`` and ``by`` in any order
-        self.accept({On: parse_on, By: parse_by}, CompletionClass.keyword)
+        @clause(Genre)
+        def parse_genre():
+            """Parse a ``genre`` clause.
+            """
+            nonlocal genres
+            genres = self.parse_names(CompletionClass.genre, approximate=False)
+            self.filters['genre'] = genres
+
+        @clause(Label)
+        def parse_label():
+            """Parse a ``label`` clause.
+            """
+            nonlocal labels
+            labels = self.parse_names(CompletionClass.label, approximate=False)
+            self.filters['label'] = labels
+
+        @clause(From)
+        def parse_from():
+            """Parse a ``from`` clause.
+            """
+            nonlocal years
+            years = self.parse_range()
+
+        @clause(Bpm)
+        def parse_bpm():
+            """Parse a ``bpm`` clause.
+            """
+            nonlocal bpms
+            bpms = self.parse_range()
+
+        # parse the filter clauses in any order
+        self.accept(clauses, CompletionClass.keyword)
 
         def parse_shuffle():
             """Parse the ``shuffle`` modifier.
@@ -203,11 +323,27 @@ class _QueryParser:
 
         self.accept({Shuffle: parse_shuffle}, CompletionClass.keyword)
 
+        def parse_take():
+            """Parse a ``take`` clause.
+            """
+            nonlocal take
+            self.completion_class = CompletionClass.number
+            lexeme = self.expect(Name)
+            if not lexeme.string.isdigit():
+                raise BadParse(
+                    lexeme,
+                    '%s: expected a number' % lexeme.unexpected(),
+                )
+            take = int(lexeme.string)
+
+        self.accept({Take: parse_take}, CompletionClass.keyword)
+
         def parse_except():
             """Parse an ``except`` clause.
             """
             nonlocal except_
-            p = _QueryParser(self.stream)
+            p = _QueryParser(self.stream, self.subqueries)
+            self.subqueries.append((self.last_lexeme, p))
             except_ = p.parse()
             self.skipped_lexeme_types = p.skipped_lexeme_types
             self.completion_class = p.completion_class
@@ -216,7 +352,8 @@ class _QueryParser:
             """Parse a ``then`` clause.
             """
             nonlocal then
-            p = _QueryParser(self.stream)
+            p = _QueryParser(self.stream, self.subqueries)
+            self.subqueries.append((self.last_lexeme, p))
             then = p.parse()
             self.skipped_lexeme_types = p.skipped_lexeme_types
             self.completion_class = p.completion_class
@@ -226,7 +363,19 @@ class _QueryParser:
             {Except: parse_except, Then: parse_then},
             CompletionClass.keyword)
 
-        return Query(titles, on, by, shuffle, except_, then)
+        return Query(
+            titles,
+            on,
+            by,
+            shuffle,
+            except_,
+            then,
+            take,
+            genres,
+            labels,
+            years,
+            bpms,
+        )
 
 
 class Query:
@@ -246,14 +395,40 @@ class Query:
         The query to intersect with.
     then : Query or None
         The query to union with.
+    take : int or None, optional
+        The maximum number of tracks to select.
+    genres : iterable[str] or None, optional
+        The genres to select from.
+    labels : iterable[str] or None, optional
+        The labels to select from.
+    years : tuple[int or None, int or None] or None, optional
+        The inclusive range of release years to select from.
+    bpms : tuple[int or None, int or None] or None, optional
+        The inclusive range of bpms to select from.
     """
-    def __init__(self, titles, on, by, shuffle, except_, then):
+    def __init__(self,
+                 titles,
+                 on,
+                 by,
+                 shuffle,
+                 except_,
+                 then,
+                 take=None,
+                 genres=None,
+                 labels=None,
+                 years=None,
+                 bpms=None):
         self.titles = titles
         self.on = on
         self.by = by
         self.shuffle = shuffle
         self.except_ = except_
         self.then = then
+        self.take = take
+        self.genres = genres
+        self.labels = labels
+        self.years = years
+        self.bpms = bpms
 
     @classmethod
     def parse(cls, stream):
@@ -284,7 +459,12 @@ class Query:
            Name {, Name}
            [on Name] {, Name}
            [by Name] {, Name}
+           [genre Name] {, Name}
+           [label Name] {, Name}
+           [from Range]
+           [bpm Range]
            [shuffle]
+           [take Number]
            [and Query]
            [or Query]
 
@@ -303,6 +483,51 @@ class Query:
         return query
 
 
+def _parse_error(e, source):
+    """Turn a ``BadParse`` into a ``ValueError`` that points at the bad
+    lexeme in the source.
+    """
+    indicator = '>>> '
+    return ValueError(
+        'parse error%s: %s\n%s%s' % (
+            (' at column %d' % e.lexeme.col_offset)
+            if e.lexeme is not None else
+            '',
+            e.msg,
+            ('\n%s%s' % (indicator, source)) if source else '',
+            '\n%s^' % (' ' * (e.lexeme.col_offset + len(indicator)))
+            if e.lexeme is not None else
+            '',
+        ),
+    )
+
+
+def parse_lexemes(lexemes, source):
+    """Parse an already lexed witchcraft ql query into a Query object.
+
+    Parameters
+    ----------
+    lexemes : iterable[Lexeme]
+        The lexemes of the query.
+    source : str
+        The source the lexemes were read from. This is used to format errors.
+
+    Returns
+    -------
+    query : Query
+        The parsed query.
+
+    Raises
+    ------
+    ValueError
+        Raised when the source is not a valid query.
+    """
+    try:
+        return Query.parse(PeekableIterator(lexemes))
+    except BadParse as e:
+        raise _parse_error(e, source)
+
+
 def parse(source):
     """Parse a witchcraft ql query string into a Query object.
 
@@ -321,24 +546,123 @@ def parse(source):
     ValueError
         Raised when the source is not a valid query.
     """
-    try:
-        query = Query.parse(PeekableIterator(lex(source)))
-    except BadParse as e:
-        indicator = '>>> '
-        raise ValueError(
-            'parse error%s: %s\n%s%s' % (
-                (' at column %d' % e.lexeme.col_offset)
-                if e.lexeme is not None else
-                '',
-                e.msg,
-                ('\n%s%s' % (indicator, source)) if source else '',
-                '\n%s^' % (' ' * (e.lexeme.col_offset + len(indicator)))
-                if e.lexeme is not None else
-                '',
-            ),
-        )
+    return parse_lexemes(lex(source), source)
+
+
+class CompletionParser:
+    """Find the completion class of partial queries, reusing the work done
+    for earlier queries that share a prefix.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of prefixes to remember. The least recently used
+        prefixes are forgotten first.
+
+    Notes
+    -----
+    Everything after an ``except`` or ``then`` is parsed by a new
+    ``_QueryParser`` which only sees the rest of the lexemes, so the
+    completion class only depends on the source after the last one. When a
+    parse reaches one of these keywords, the source up to the keyword is
+    remembered. A later query which starts with the same prefix is only lexed
+    and parsed from the keyword on, so while a long chain of ``then`` clauses
+    is typed, each completion only processes the clause being typed.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        # source prefix -> the ``except`` or ``then`` lexeme that ends it
+        self._prefixes = OrderedDict()
+
+    def _resume(self, source):
+        prefixes = self._prefixes
+        for match in reversed(list(
+                _subquery_keyword_pattern.finditer(source))):
+            prefix = source[:match.end()]
+            try:
+                lexeme = prefixes[prefix]
+            except KeyError:
+                continue
+            prefixes.move_to_end(prefix)
+            return match.end(), lexeme
+        return 0, None
+
+    def _remember(self, source, lexeme):
+        end = lexeme.col_offset + len(lexeme.string)
+        if end == len(source):
+            # the keyword could still become part of a longer name
+            return
+
+        prefixes = self._prefixes
+        prefixes[source[:end]] = lexeme
+        prefixes.move_to_end(source[:end])
+        if len(prefixes) > self.maxsize:
+            prefixes.popitem(last=False)
+
+    def completion_context(self, source):
+        """Get the completion class for the given partial query and the
+        clauses which have already been typed.
+
+        Parameters
+        ----------
+        source : str
+             The source for the partial query.
+
+        Returns
+        -------
+        cls : CompletionClass
+            The completion class for the source.
+        lexeme : Lexeme or None
+            The last lexeme that was parsed.
+        filters : dict[str, list[str]]
+            The ``on``, ``by``, ``genre``, and ``label`` clauses of the
+            subquery being typed which have been completely parsed, like
+            ``{'by': ['prime']}``.
+        """
+        start, subquery_lexeme = self._resume(source)
+        stream = PeekableIterator(lex(source, start))
+        parser = _QueryParser(stream)
+        try:
+            parser.parse()
+        except BadParse:
+            pass
+
+        for keyword, _ in parser.subqueries:
+            self._remember(source, keyword)
+        if parser.subqueries:
+            # the last subquery started is the one being typed
+            subquery_lexeme, parser = parser.subqueries[-1]
+
+        try:
+            lexeme = next(stream)
+        except StopIteration:
+            lexeme = parser.last_lexeme
+            if lexeme is None:
+                # nothing has been typed after the ``except`` or ``then``
+                lexeme = subquery_lexeme
+
+        return parser.completion_class, lexeme, parser.filters
 
-    return query
+    def completion_class(self, source):
+        """Get the completion class for the given partial query.
+
+        Parameters
+        ----------
+        source : str
+             The source for the partial query.
+
+        Returns
+        -------
+        cls : CompletionClass
+            The completion class for the source.
+        lexeme : Lexeme or None
+            The last lexeme that was parsed.
+        """
+        cls, lexeme, _ = self.completion_context(source)
+        return cls, lexeme
+
+
+_completion_parser = CompletionParser()
 
 
 def completion_class(source):
@@ -356,15 +680,26 @@ def completion_class(source):
     lexeme : Lexeme or None
         The last lexeme that was parsed.
     """
-    parser = _QueryParser(PeekableIterator(lex(source)))
-    try:
-        parser.parse()
-    except BadParse:
-        pass
+    return _completion_parser.completion_class(source)
 
-    try:
-        lexeme = next(parser.stream)
-    except StopIteration:
-        lexeme = parser.last_lexeme
 
-    return parser.completion_class, lexeme
+def completion_context(source):
+    """Get the completion class for the given partial query and the clauses
+    which have already been typed.
+
+    Parameters
+    ----------
+    source : str
+         The source for the partial query.
+
+    Returns
+    -------
+    cls : CompletionClass
+        The completion class for the source.
+    lexeme : Lexeme or None
+        The last lexeme that was parsed.
+    filters : dict[str, list[str]]
+        The ``on``, ``by``, ``genre``, and ``label`` clauses of the subquery
+        being typed which have been completely parsed.
+    """
+    return _completion_parser.completion_context(source)
@@ -1,8 +1,12 @@
+from collections import OrderedDict
 from functools import partial
 
 import sqlalchemy as sa
 
-db_version = 0
+from .metrics import registry
+from .utils import split_words, trigrams
+
+db_version = 6
 
 
 metadata = sa.MetaData()
@@ -37,7 +41,20 @@ tracks = sa.Table(
     sa.Column('id', sa.Integer, primary_key=True),
     sa.Column('title', sa.String, nullable=False),
     sa.Column('path', sa.String, nullable=False),
+    # the metadata which has at most one value for a track; this used to be
+    # held in side tables, see ``_compatibility_views``
+    # International Standard Recording Code
+    sa.Column('isrc', sa.String),
+    sa.Column('filetype', sa.String),
+    sa.Column('bpm', sa.SmallInteger),
+    sa.Column('date', sa.DateTime),
 )
+# results are ordered by title, this lets a page of results seek to the last
+# title seen instead of sorting every track
+sa.Index('tracks_title', tracks.c.title)
+sa.Index('tracks_isrc', tracks.c.isrc, unique=True)
+sa.Index('tracks_bpm', tracks.c.bpm)
+sa.Index('tracks_date', tracks.c.date)
 
 albums = sa.Table(
     'albums',
@@ -74,6 +91,13 @@ album_contents = sa.Table(
     sa.Column('track_id', sa.ForeignKey(tracks.c.id)),
     sa.Column('track_number', sa.SmallInteger),
 )
+# ``on`` and ``by`` find the matching albums and artists first and then look up
+# their tracks
+sa.Index(
+    'album_contents_album',
+    album_contents.c.album_id,
+    album_contents.c.track_id,
+)
 
 track_genres = sa.Table(
     'track_genres',
@@ -82,6 +106,12 @@ track_genres = sa.Table(
     sa.Column('genre_id', sa.ForeignKey(genres.c.id)),
     sa.UniqueConstraint('track_id', 'genre_id'),
 )
+# the unique constraints lead with the track, queries filter by the entity
+sa.Index(
+    'track_genres_genre',
+    track_genres.c.genre_id,
+    track_genres.c.track_id,
+)
 
 track_artists = sa.Table(
     'track_artists',
@@ -90,6 +120,11 @@ track_artists = sa.Table(
     sa.Column('artist_id', sa.ForeignKey(artists.c.id)),
     sa.UniqueConstraint('track_id', 'artist_id'),
 )
+sa.Index(
+    'track_artists_artist',
+    track_artists.c.artist_id,
+    track_artists.c.track_id,
+)
 
 track_labels = sa.Table(
     'track_labels',
@@ -98,37 +133,116 @@ track_labels = sa.Table(
     sa.Column('label_id', sa.ForeignKey(labels.c.id)),
     sa.UniqueConstraint('track_id', 'label_id'),
 )
+sa.Index(
+    'track_labels_label',
+    track_labels.c.label_id,
+    track_labels.c.track_id,
+)
 
-# International Standard Recording Code
-track_isrcs = sa.Table(
-    'track_isrc',
+# The words of the track titles, album titles, and artist names, and the
+# trigrams of each word. ``~name`` patterns find the words within a few typos
+# of the pattern through the trigrams and then look up the names with those
+# words.
+words = sa.Table(
+    'words',
     metadata,
-    sa.Column('track_id', sa.ForeignKey(tracks.c.id)),
-    sa.Column('isrc', sa.String, unique=True),
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('word', sa.String, unique=True, nullable=False),
 )
 
-track_bpms = sa.Table(
-    'track_bpm',
+word_trigrams = sa.Table(
+    'word_trigrams',
     metadata,
+    sa.Column('trigram', sa.String, primary_key=True),
+    sa.Column('word_id', sa.ForeignKey(words.c.id), primary_key=True),
+)
+
+
+def _word_links(name, entity_id):
+    table = sa.Table(
+        name,
+        metadata,
+        entity_id,
+        sa.Column('word_id', sa.ForeignKey(words.c.id)),
+        sa.UniqueConstraint(entity_id.name, 'word_id'),
+    )
+    sa.Index(
+        '%s_word' % name,
+        table.c.word_id,
+        table.c[entity_id.name],
+    )
+    return table
+
+
+track_title_words = _word_links(
+    'track_title_words',
     sa.Column('track_id', sa.ForeignKey(tracks.c.id)),
-    sa.Column('bpm', sa.SmallInteger),
-    sa.UniqueConstraint('track_id', 'bpm'),
+)
+album_title_words = _word_links(
+    'album_title_words',
+    sa.Column('album_id', sa.ForeignKey(albums.c.id)),
+)
+artist_name_words = _word_links(
+    'artist_name_words',
+    sa.Column('artist_id', sa.ForeignKey(artists.c.id)),
 )
 
-track_dates = sa.Table(
-    'track_dates',
+# The progress of the last ``ingest`` through each source file, so that an
+# interrupted ingest can be resumed. ``state`` moves from ``'planned'``, when
+# the file's tags have been read, to ``'copied'``, when the file is in the
+# music home, to ``'committed'``, when the track is in the database.
+ingest_journal = sa.Table(
+    'ingest_journal',
     metadata,
+    sa.Column('source', sa.String, primary_key=True),
+    sa.Column('state', sa.String, nullable=False),
+    # the path of the copy relative to the music home, or NULL when the
+    # track was already in the database
+    sa.Column('path', sa.String),
     sa.Column('track_id', sa.ForeignKey(tracks.c.id)),
-    sa.Column('date', sa.DateTime),
-    sa.UniqueConstraint('track_id', 'date'),
 )
 
-track_filetypes = sa.Table(
-    'track_filetypes',
+# The side tables which were folded into ``tracks`` in version 4, by the
+# ``tracks`` column they became. These are recreated as views so that scripts
+# which read the old tables keep working.
+_compatibility_views = OrderedDict([
+    ('track_isrc', tracks.c.isrc),
+    ('track_filetypes', tracks.c.filetype),
+    ('track_bpm', tracks.c.bpm),
+    ('track_dates', tracks.c.date),
+])
+
+
+def _create_compatibility_views(conn):
+    for name, column in _compatibility_views.items():
+        conn.execute(
+            'CREATE VIEW IF NOT EXISTS {name} AS'
+            ' SELECT id AS track_id, {column} FROM tracks'
+            ' WHERE {column} IS NOT NULL'.format(
+                name=name,
+                column=column.name,
+            ),
+        )
+
+
+# One row per track with the album and artists already joined in. Queries
+# filter and sort on this instead of joining the normalized tables. This is
+# written by ``ensure_track`` and can be rebuilt from the other tables with
+# ``rebuild_track_search``.
+track_search = sa.Table(
+    'track_search',
     metadata,
-    sa.Column('track_id', sa.ForeignKey(tracks.c.id), unique=True),
-    sa.Column('filetype', sa.String),
+    sa.Column('track_id', sa.ForeignKey(tracks.c.id), primary_key=True),
+    sa.Column('title', sa.String, nullable=False),
+    sa.Column('path', sa.String, nullable=False),
+    sa.Column('album_title', sa.String),
+    sa.Column('track_number', sa.SmallInteger),
+    # the artist names joined with ``_artist_separator``
+    sa.Column('artists', sa.String),
 )
+sa.Index('track_search_title', track_search.c.title)
+
+_artist_separator = ', '
 
 
 def _new_id(conn, table):
@@ -137,7 +251,120 @@ def _new_id(conn, table):
     ))
 
 
-def _ensure(name_column, table, conn, name):
+class EntityCache:
+    """A write-through cache from entity name to id for the artists, albums,
+    genres, and labels tables.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of names to hold. The least recently used names are
+        evicted first.
+
+    Notes
+    -----
+    The cache is owned by a single connection. ``PRAGMA data_version`` only
+    changes when another connection commits to the database, so the cache is
+    cleared whenever :meth:`validate` sees a new data version.
+    """
+    def __init__(self, maxsize=2 ** 16):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+        self._data_version = None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def validate(self, conn):
+        """Clear the cache if another process has written to the database.
+
+        Parameters
+        ----------
+        conn : sa.Connection
+            The connection which owns this cache.
+        """
+        data_version = conn.scalar('PRAGMA data_version')
+        if data_version != self._data_version:
+            self.clear()
+            self._data_version = data_version
+
+    def clear(self):
+        self._ids.clear()
+
+    def get(self, table, name):
+        """Look up the id for a name.
+
+        Raises
+        ------
+        KeyError
+            Raised when the name is not cached.
+        """
+        key = table.name, name
+        id_ = self._ids[key]
+        self._ids.move_to_end(key)
+        return id_
+
+    def put(self, table, name, id_):
+        ids = self._ids
+        ids[table.name, name] = id_
+        if len(ids) > self.maxsize:
+            ids.popitem(last=False)
+
+
+_entity_cache_key = 'witchcraft.entity_cache'
+_entity_cache_hits = registry.counter(
+    'witchcraft_cache_hits_total',
+    'Lookups served from a cache.',
+    cache='entity',
+)
+_entity_cache_misses = registry.counter(
+    'witchcraft_cache_misses_total',
+    'Lookups which missed a cache.',
+    cache='entity',
+)
+
+
+def entity_cache(conn):
+    """Get the entity cache for a connection.
+
+    Parameters
+    ----------
+    conn : sa.Connection
+        The connection to get the cache for.
+
+    Returns
+    -------
+    cache : EntityCache
+        The cache shared by everything using this connection.
+    """
+    try:
+        return conn.info[_entity_cache_key]
+    except KeyError:
+        cache = conn.info[_entity_cache_key] = EntityCache()
+        return cache
+
+
+@sa.event.listens_for(sa.engine.Engine, 'rollback')
+def _clear_entity_cache(conn):
+    # ids written through to the cache may have been rolled back
+    cache = conn.info.get(_entity_cache_key)
+    if cache is not None:
+        cache.clear()
+
+
+def _ensure(name_column, table, conn, name, *, validate=True):
+    cache = entity_cache(conn)
+    if validate:
+        cache.validate(conn)
+
+    try:
+        id_ = cache.get(table, name)
+    except KeyError:
+        _entity_cache_misses.inc()
+    else:
+        _entity_cache_hits.inc()
+        return id_
+
     ids = conn.execute(
         sa.select(
             (table.c.id,),
@@ -152,16 +379,134 @@ def _ensure(name_column, table, conn, name):
                 name_column: name,
             }]),
         )
+        on_insert = _entity_on_insert.get(table)
+        if on_insert is not None:
+            on_insert(conn, new_id, name)
     else:
         new_id = ids[0][0]
 
+    cache.put(table, name, new_id)
     return new_id
 
 
-ensure_artist = partial(_ensure, 'name', artists)
-ensure_album = partial(_ensure, 'title', albums)
-ensure_genre = partial(_ensure, 'genre', genres)
-ensure_label = partial(_ensure, 'label', labels)
+_entity_name_columns = OrderedDict()
+# table -> function called with ``(conn, id, name)`` when a new entity is
+# inserted
+_entity_on_insert = {}
+
+
+def _register_entity(name_column, table, on_insert=None):
+    _entity_name_columns[table] = name_column
+    if on_insert is not None:
+        _entity_on_insert[table] = on_insert
+    return partial(_ensure, name_column, table)
+
+
+def _insert_trigrams(conn, word_id, word):
+    conn.execute(word_trigrams.insert([
+        {'trigram': trigram, 'word_id': word_id}
+        for trigram in sorted(trigrams(word))
+    ]))
+
+
+def _insert_words(link, conn, entity_id, name):
+    word_ids = sorted({
+        ensure_word(conn, word, validate=False) for word in split_words(name)
+    })
+    # inserting an empty list would insert a row of ``NULL``
+    if word_ids:
+        entity_column, _ = link.c.keys()
+        conn.execute(link.insert([
+            {entity_column: entity_id, 'word_id': word_id}
+            for word_id in word_ids
+        ]))
+
+
+ensure_word = _register_entity('word', words, _insert_trigrams)
+ensure_artist = _register_entity(
+    'name',
+    artists,
+    partial(_insert_words, artist_name_words),
+)
+ensure_album = _register_entity(
+    'title',
+    albums,
+    partial(_insert_words, album_title_words),
+)
+ensure_genre = _register_entity('genre', genres)
+ensure_label = _register_entity('label', labels)
+
+
+def preload_entity_cache(conn):
+    """Load every artist, album, genre, and label into the connection's entity
+    cache. This should be called before ingesting many tracks.
+
+    Parameters
+    ----------
+    conn : sa.Connection
+        The connection to preload.
+
+    Notes
+    -----
+    When there are more entities than fit in the cache, the ones read last are
+    kept.
+    """
+    cache = entity_cache(conn)
+    cache.validate(conn)
+    for table, name_column in _entity_name_columns.items():
+        for id_, name in conn.execute(
+                sa.select((table.c.id, table.c[name_column]))):
+            cache.put(table, name, id_)
+
+
+def find_track(conn, title, album, artists):
+    """Look up the track which :func:`ensure_track` would match without
+    adding anything to the db.
+
+    Parameters
+    ----------
+    conn : sa.Connection
+        The connection to the metadata db.
+    title : str
+        The track's title.
+    album : str
+        The album's title.
+    artists : list[str]
+        The track's artists.
+
+    Returns
+    -------
+    track_id : int or None
+        The id of the track with the same title on the same album by any of
+        the artists, or None if ``ensure_track`` would add a new track.
+    """
+    # the ``artists`` argument shadows the table
+    artists_table = metadata.tables['artists']
+    ids = conn.execute(
+        sa.select(
+            (tracks.c.id,),
+        ).select_from(
+            tracks.join(
+                album_contents,
+                album_contents.c.track_id == tracks.c.id,
+            ).join(
+                albums,
+                albums.c.id == album_contents.c.album_id,
+            ).join(
+                track_artists,
+                track_artists.c.track_id == tracks.c.id,
+            ).join(
+                artists_table,
+                artists_table.c.id == track_artists.c.artist_id,
+            ),
+        ).where(
+            (tracks.c.title == title) &
+            (albums.c.title == album) &
+            artists_table.c.name.in_(artists)
+        ).distinct()
+    ).fetchall()
+    assert len(ids) <= 1, 'too many matching tracks'
+    return ids[0][0] if ids else None
 
 
 def ensure_track(conn,
@@ -178,6 +523,9 @@ def ensure_track(conn,
                  track_number):
     """Add a new track to the db if it is not already added.
 
+    A track is already added if a track with the same title is on the same
+    album by any of the same artists, see :func:`find_track`.
+
     Returns
     -------
     track_id : int
@@ -185,35 +533,26 @@ def ensure_track(conn,
     added_new_track : bool
         Was this track just added to the database.
     """
-    artist_ids = [ensure_artist(conn, artist) for artist in artists]
-    album_id = ensure_album(conn, album)
-    # try to see if we think this is in the db already.
-    ids = conn.execute(
-        sa.select(
-            (tracks.c.id,),
-        ).select_from(
-            tracks.join(
-                album_contents,
-                album_contents.c.track_id == tracks.c.id,
-            ).join(
-                track_artists,
-                track_artists.c.track_id == tracks.c.id,
-            ),
-        ).where(
-            (tracks.c.title == title) &
-            (albums.c.id == album_id) &
-            track_artists.c.artist_id.in_(artist_ids)
-        ).distinct()
-    ).fetchall()
-    assert len(ids) <= 1, 'too many matching tracks'
-    added_new_track = not ids
+    # try to see if we think this is in the db already; ingest checks for
+    # duplicates with the same lookup before copying files
+    existing_id = find_track(conn, title, album, artists)
+    added_new_track = existing_id is None
     if added_new_track:
+        entity_cache(conn).validate(conn)
+        artist_ids = [
+            ensure_artist(conn, artist, validate=False) for artist in artists
+        ]
+        album_id = ensure_album(conn, album, validate=False)
         new_id = _new_id(conn, tracks)
         conn.execute(
             tracks.insert([{
                 'id': new_id,
                 'title': title,
                 'path': path,
+                'isrc': isrc,
+                'filetype': filetype,
+                'bpm': bpm,
+                'date': date,
             }]),
         )
         conn.execute(
@@ -223,55 +562,44 @@ def ensure_track(conn,
                 'track_number': track_number,
             }]),
         )
+        _insert_words(track_title_words, conn, new_id, title)
         conn.execute(
-            track_genres.insert([
-                {'track_id': new_id, 'genre_id': ensure_genre(conn, genre)}
-                for genre in genres
-            ]),
-        )
-        conn.execute(
-            track_artists.insert([
-                {'track_id': new_id, 'artist_id': artist_id}
-                for artist_id in artist_ids
-            ]),
+            track_search.insert([{
+                'track_id': new_id,
+                'title': title,
+                'path': path,
+                'album_title': album,
+                'track_number': track_number,
+                'artists': _artist_separator.join(artists),
+            }]),
         )
-        if label is not None:
+        # inserting an empty list would insert a row of ``NULL``
+        if genres:
             conn.execute(
-                track_labels.insert([{
-                    'track_id': new_id,
-                    'label_id': ensure_label(conn, label),
-                }]),
-            )
-        if isrc is not None:
-            conn.execute(
-                track_isrcs.insert([{
-                    'track_id': new_id,
-                    'isrc': isrc,
-                }]),
+                track_genres.insert([
+                    {
+                        'track_id': new_id,
+                        'genre_id': ensure_genre(conn, genre, validate=False),
+                    }
+                    for genre in genres
+                ]),
             )
-        if bpm is not None:
+        if artist_ids:
             conn.execute(
-                track_bpms.insert([{
-                    'track_id': new_id,
-                    'bpm': bpm,
-                }]),
-            )
-        if date is not None:
-            conn.execute(
-                track_dates.insert([{
-                    'track_id': new_id,
-                    'date': date,
-                }]),
+                track_artists.insert([
+                    {'track_id': new_id, 'artist_id': artist_id}
+                    for artist_id in artist_ids
+                ]),
             )
-        if filetype is not None:
+        if label is not None:
             conn.execute(
-                track_filetypes.insert([{
+                track_labels.insert([{
                     'track_id': new_id,
-                    'filetype': filetype,
+                    'label_id': ensure_label(conn, label, validate=False),
                 }]),
             )
     else:
-        new_id = ids[0][0]
+        new_id = existing_id
 
     return new_id, added_new_track
 
@@ -285,4 +613,312 @@ def create_schema(conn):
         The connection to create the schema in.
     """
     metadata.create_all(conn)
+    _create_compatibility_views(conn)
     conn.execute(version.insert({'version': db_version}))
+
+
+def rebuild_track_search(conn):
+    """Rebuild the ``track_search`` table from the normalized tables.
+
+    Parameters
+    ----------
+    conn : sa.Connection
+        The connection to rebuild the table with.
+
+    Returns
+    -------
+    rows : int
+        The number of tracks in the rebuilt table.
+    """
+    artist_names = sa.select((
+        track_artists.c.track_id,
+        sa.func.group_concat(artists.c.name, _artist_separator).label(
+            'artists',
+        ),
+    )).select_from(
+        track_artists.join(artists, track_artists.c.artist_id == artists.c.id),
+    ).group_by(
+        track_artists.c.track_id,
+    ).alias('artist_names')
+
+    # witchcraft puts each track on exactly one album; if another tool has
+    # added more, keep the album with the smallest id
+    first_album = sa.select((
+        album_contents.c.track_id,
+        sa.func.min(album_contents.c.album_id).label('album_id'),
+    )).group_by(
+        album_contents.c.track_id,
+    ).alias('first_album')
+
+    with conn.begin():
+        conn.execute(track_search.delete())
+        conn.execute(track_search.insert().from_select(
+            [
+                'track_id',
+                'title',
+                'path',
+                'album_title',
+                'track_number',
+                'artists',
+            ],
+            sa.select((
+                tracks.c.id,
+                tracks.c.title,
+                tracks.c.path,
+                albums.c.title,
+                album_contents.c.track_number,
+                artist_names.c.artists,
+            )).select_from(
+                tracks.outerjoin(
+                    first_album,
+                    first_album.c.track_id == tracks.c.id,
+                ).outerjoin(
+                    album_contents,
+                    (album_contents.c.track_id == tracks.c.id) &
+                    (album_contents.c.album_id == first_album.c.album_id),
+                ).outerjoin(
+                    albums,
+                    albums.c.id == first_album.c.album_id,
+                ).outerjoin(
+                    artist_names,
+                    artist_names.c.track_id == tracks.c.id,
+                ),
+            ),
+        ))
+        return conn.scalar(
+            sa.select((sa.func.count(track_search.c.track_id),)),
+        )
+
+
+# the tables which hold the words of each name, and the name they index
+_word_link_names = OrderedDict([
+    (track_title_words, tracks.c.title),
+    (album_title_words, albums.c.title),
+    (artist_name_words, artists.c.name),
+])
+
+
+def rebuild_word_index(conn):
+    """Rebuild the words and trigrams used by ``~name`` patterns from the
+    track titles, album titles, and artist names.
+
+    Parameters
+    ----------
+    conn : sa.Connection
+        The connection to rebuild the index with.
+
+    Returns
+    -------
+    words : int
+        The number of distinct words.
+    """
+    word_ids = {}
+
+    def word_id(word):
+        try:
+            return word_ids[word]
+        except KeyError:
+            id_ = word_ids[word] = len(word_ids)
+            return id_
+
+    with conn.begin():
+        for table in list(_word_link_names) + [word_trigrams, words]:
+            conn.execute(table.delete())
+
+        for link, name_column in _word_link_names.items():
+            entity_column, _ = link.c.keys()
+            rows = [
+                {entity_column: entity_id, 'word_id': word_id(word)}
+                for entity_id, name in conn.execute(
+                    sa.select((name_column.table.c.id, name_column)),
+                )
+                for word in sorted(set(split_words(name)))
+            ]
+            if rows:
+                conn.execute(link.insert(), rows)
+
+        if word_ids:
+            conn.execute(words.insert(), [
+                {'id': id_, 'word': word} for word, id_ in word_ids.items()
+            ])
+            conn.execute(word_trigrams.insert(), [
+                {'trigram': trigram, 'word_id': id_}
+                for word, id_ in word_ids.items()
+                for trigram in trigrams(word)
+            ])
+
+    # the cached word ids were deleted
+    entity_cache(conn).clear()
+    return len(word_ids)
+
+
+def _create_indexes(conn, names):
+    """Create the named indexes if they do not exist yet. Indexes which are no
+    longer in the schema are skipped.
+    """
+    indexes = {
+        index.name: index
+        for table in metadata.tables.values()
+        for index in table.indexes
+    }
+    existing = {
+        row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'",
+        )
+    }
+    for name in names:
+        if name in indexes and name not in existing:
+            indexes[name].create(conn)
+
+
+def _normalize_labels(conn):
+    from .utils import normalize
+
+    ids = {
+        label: id_
+        for label, id_ in conn.execute(
+            sa.select((labels.c.label, labels.c.id)),
+        )
+    }
+    for label, id_ in sorted(ids.items()):
+        normalized = normalize(label)
+        if normalized == label:
+            continue
+
+        existing = ids.get(normalized)
+        if existing is None:
+            conn.execute(
+                labels.update().where(labels.c.id == id_).values(
+                    label=normalized,
+                ),
+            )
+            ids[normalized] = id_
+            continue
+
+        # fold this label into the one which already has the normalized name
+        conn.execute(
+            track_labels.update().prefix_with('OR IGNORE').where(
+                track_labels.c.label_id == id_,
+            ).values(label_id=existing),
+        )
+        conn.execute(track_labels.delete().where(
+            track_labels.c.label_id == id_,
+        ))
+        conn.execute(labels.delete().where(labels.c.id == id_))
+
+
+def _migrate_0_to_1(conn):
+    """Index the columns which queries filter on and normalize labels so that
+    they may be written in a query.
+    """
+    _create_indexes(conn, (
+        'tracks_title',
+        'track_genres_genre',
+        'track_labels_label',
+        # ``track_bpm_bpm`` and ``track_dates_date`` were dropped with their
+        # tables in version 4
+    ))
+    _normalize_labels(conn)
+
+
+def _migrate_1_to_2(conn):
+    """Index the album and artist links by album and artist.
+    """
+    _create_indexes(conn, ('album_contents_album', 'track_artists_artist'))
+
+
+def _migrate_2_to_3(conn):
+    """Add the denormalized ``track_search`` table.
+    """
+    track_search.create(conn)
+    rebuild_track_search(conn)
+
+
+def _migrate_3_to_4(conn):
+    """Fold the side tables which hold at most one value for a track into
+    ``tracks`` and replace them with views.
+    """
+    for name, column in _compatibility_views.items():
+        conn.execute('ALTER TABLE tracks ADD COLUMN %s' % (
+            sa.schema.CreateColumn(column).compile(conn),
+        ))
+        # ``track_isrc`` was never indexed by track, without an index the
+        # update below scans the whole table for every track; the index is
+        # dropped with the table
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS {name}_track_id'
+            ' ON {name} (track_id)'.format(name=name),
+        )
+        # the old tables allowed more than one bpm or date for a track, keep
+        # the smallest
+        conn.execute(
+            'UPDATE tracks SET {column} = ('
+            ' SELECT min({column}) FROM {name} WHERE track_id = tracks.id'
+            ')'.format(name=name, column=column.name),
+        )
+        conn.execute('DROP TABLE %s' % name)
+
+    _create_indexes(conn, ('tracks_isrc', 'tracks_bpm', 'tracks_date'))
+    _create_compatibility_views(conn)
+
+
+def _migrate_4_to_5(conn):
+    """Add the words and trigrams used by ``~name`` patterns.
+    """
+    metadata.create_all(
+        conn,
+        tables=[words, word_trigrams] + list(_word_link_names),
+    )
+    rebuild_word_index(conn)
+
+
+def _migrate_5_to_6(conn):
+    """Add the ingest journal.
+    """
+    metadata.create_all(conn, tables=[ingest_journal])
+
+
+# map from version to the function which migrates a database from the
+# previous version
+_migrations = {
+    1: _migrate_0_to_1,
+    2: _migrate_1_to_2,
+    3: _migrate_2_to_3,
+    4: _migrate_3_to_4,
+    5: _migrate_4_to_5,
+    6: _migrate_5_to_6,
+}
+
+
+def migrate(conn):
+    """Migrate a database to the current schema version.
+
+    Parameters
+    ----------
+    conn : sa.Connection
+        The connection to migrate.
+
+    Returns
+    -------
+    old_version : int
+        The version of the database before migrating.
+
+    Raises
+    ------
+    ValueError
+        Raised when the database was created by a newer version of witchcraft.
+    """
+    old_version = conn.scalar(sa.select((version.c.version,)))
+    if old_version > db_version:
+        raise ValueError(
+            'the database version (%d) is newer than witchcraft (%d)' % (
+                old_version,
+                db_version,
+            ),
+        )
+
+    with conn.begin():
+        for n in range(old_version + 1, db_version + 1):
+            _migrations[n](conn)
+        conn.execute(version.update().values(version=db_version))
+    return old_version
@@ -0,0 +1,268 @@
+"""Read the tags of an audio file and decode them into the values stored by
+``ingest``.
+
+Each file is opened once by a tag reader, and the raw tags are decoded into a
+:class:`TrackTags`. Readers are registered with :func:`register_tag_reader`;
+``taglib`` reads every format, and ``header`` reads flac and mp3 tags in pure
+Python and falls back to taglib for anything else.
+"""
+from collections import OrderedDict, namedtuple
+import datetime
+from functools import lru_cache
+from itertools import chain
+import re
+
+import dateutil.parser
+import taglib
+
+from .header_tags import read_header_tags
+from .metrics import registry
+from .utils import (
+    normalize,
+    normalize_artists,
+    normalize_genres,
+    normalize_track_number,
+)
+
+
+class TrackTags(namedtuple('TrackTags', [
+        'album',
+        'artists',
+        'bpm',
+        'date',
+        'filetype',
+        'genres',
+        'isrc',
+        'label',
+        'title',
+        'track_number'])):
+    """The decoded tags of a track. The fields are the keyword arguments of
+    :func:`witchcraft.schema.ensure_track`, except for the path.
+    """
+    __slots__ = ()
+
+
+def _exactly_one_tag(tags, key, *, optional, normalize=normalize):
+    if optional:
+        values = tags.get(key)
+    else:
+        try:
+            values = tags[key]
+        except KeyError:
+            raise KeyError('file tags missing required key %r' % key)
+
+    if values is None:
+        return None
+
+    if len(values) != 1:
+        raise ValueError(
+            'track may only have one %s, got: %r' % (key.lower(), values),
+        )
+    return normalize(values[0])
+
+
+_year = re.compile(r'(\d{4})(?:-(\d{2}))?')
+
+
+@lru_cache(maxsize=2 ** 12)
+def parse_date(value):
+    """Parse a ``DATE`` tag.
+
+    Parameters
+    ----------
+    value : str
+        The tag value.
+
+    Returns
+    -------
+    date : datetime.datetime
+        The parsed date.
+
+    Raises
+    ------
+    ValueError
+        Raised when the date cannot be parsed.
+
+    Notes
+    -----
+    ``YYYY``, ``YYYY-MM``, and iso 8601 dates and timestamps are parsed
+    directly; anything else falls back to ``dateutil``. A year or month
+    without a day is the first day of that year or month. Results are
+    memoized because every track on an album has the same date.
+    """
+    value = value.strip()
+    match = _year.fullmatch(value)
+    if match is not None:
+        year, month = match.groups()
+        return datetime.datetime(int(year), int(month or 1), 1)
+
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        pass
+
+    return dateutil.parser.parse(value)
+
+
+def parse_bpm(value):
+    """Parse a ``BPM`` tag.
+
+    Parameters
+    ----------
+    value : str
+        The tag value, like ``'174'`` or ``'174.00'``.
+
+    Returns
+    -------
+    bpm : int
+        The bpm, rounded to the nearest integer.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return round(float(value))
+
+
+def decode_tags(tags,
+                *,
+                album=None,
+                artists=None,
+                title=None,
+                track_number=None):
+    """Decode the raw tags of a file.
+
+    Parameters
+    ----------
+    tags : dict[str, list[str]]
+        The raw tags, keyed by upper case name.
+    album, title : str, optional
+        Overrides for the album and title tags.
+    artists : list[str], optional
+        An override for the artist tags.
+    track_number : int, optional
+        An override for the track number tag.
+
+    Returns
+    -------
+    decoded : TrackTags
+        The decoded tags. Overridden tags are not read.
+
+    Raises
+    ------
+    KeyError
+        Raised when the album, artist, or title is neither overridden nor
+        tagged.
+    ValueError
+        Raised when a tag which may only have one value has more than one, or
+        a value cannot be parsed.
+    """
+    if album is None:
+        album = _exactly_one_tag(tags, 'ALBUM', optional=False)
+    if artists is None:
+        try:
+            raw_artists = tags['ARTIST']
+        except KeyError:
+            raise KeyError('file tags missing required key %r' % 'ARTIST')
+        artists = list(chain.from_iterable(normalize_artists(raw_artists)))
+    if title is None:
+        title = _exactly_one_tag(tags, 'TITLE', optional=False)
+    if track_number is None:
+        track_number = _exactly_one_tag(
+            tags,
+            'TRACKNUMBER',
+            optional=True,
+            normalize=normalize_track_number,
+        )
+
+    return TrackTags(
+        album=album,
+        artists=artists,
+        bpm=_exactly_one_tag(tags, 'BPM', optional=True, normalize=parse_bpm),
+        date=_exactly_one_tag(
+            tags,
+            'DATE',
+            optional=True,
+            normalize=parse_date,
+        ),
+        filetype=_exactly_one_tag(tags, 'FILETYPE', optional=True),
+        genres=normalize_genres(tags.get('GENRE', [])),
+        isrc=_exactly_one_tag(tags, 'ISRC', optional=True),
+        label=_exactly_one_tag(tags, 'LABEL', optional=True),
+        title=title,
+        track_number=track_number,
+    )
+
+
+# name -> function from a path to the raw tags of the file
+tag_readers = OrderedDict()
+
+default_tag_reader = 'taglib'
+
+
+def register_tag_reader(name):
+    """Register a function which reads the raw tags of a file.
+
+    Parameters
+    ----------
+    name : str
+        The name used to select the reader.
+
+    Notes
+    -----
+    A reader is called with the path to a file and returns a dict from upper
+    case tag name to a list of values, like ``taglib.File(path).tags``. It
+    raises ``OSError`` when the file cannot be read as audio.
+    """
+    def dec(f):
+        tag_readers[name] = f
+        return f
+    return dec
+
+
+@register_tag_reader('taglib')
+def read_taglib_tags(path):
+    return taglib.File(path).tags
+
+
+_header_fallbacks = registry.counter(
+    'witchcraft_tag_reader_fallbacks_total',
+    'Files the header tag reader handed to taglib.',
+)
+
+
+@register_tag_reader('header')
+def read_header_or_taglib_tags(path):
+    tags = read_header_tags(path)
+    if tags is None:
+        _header_fallbacks.inc()
+        return read_taglib_tags(path)
+    return tags
+
+
+def read_tags(path, reader=default_tag_reader, **overrides):
+    """Open a file once and decode its tags.
+
+    Parameters
+    ----------
+    path : str
+        The path to the audio file.
+    reader : str, optional
+        The name of the tag reader to use.
+    **overrides
+        The tags to use instead of the file's, see :func:`decode_tags`.
+
+    Returns
+    -------
+    decoded : TrackTags
+        The decoded tags.
+
+    Raises
+    ------
+    OSError
+        Raised when the file cannot be read as audio.
+    """
+    with registry.timer('ingest.tag_read'):
+        tags = tag_readers[reader](path)
+
+    with registry.timer('ingest.tag_decode'):
+        return decode_tags(tags, **overrides)
@@ -1,5 +1,7 @@
+from functools import lru_cache
 import re
 import string
+import unicodedata
 
 # The set of characters I can tolerate having in a file on my file system.
 allowed_charset = (
@@ -8,7 +10,65 @@ allowed_charset = (
     {'-'}
 )
 
+# Latin letters which do not decompose into a base letter and combining marks
+# under NFKD.
+_transliterations = str.maketrans({
+    '\N{LATIN SMALL LETTER SHARP S}': 'ss',
+    '\N{LATIN SMALL LETTER AE}': 'ae',
+    '\N{LATIN CAPITAL LETTER AE}': 'AE',
+    '\N{LATIN SMALL LIGATURE OE}': 'oe',
+    '\N{LATIN CAPITAL LIGATURE OE}': 'OE',
+    '\N{LATIN SMALL LETTER O WITH STROKE}': 'o',
+    '\N{LATIN CAPITAL LETTER O WITH STROKE}': 'O',
+    '\N{LATIN SMALL LETTER D WITH STROKE}': 'd',
+    '\N{LATIN CAPITAL LETTER D WITH STROKE}': 'D',
+    '\N{LATIN SMALL LETTER ETH}': 'd',
+    '\N{LATIN CAPITAL LETTER ETH}': 'D',
+    '\N{LATIN SMALL LETTER L WITH STROKE}': 'l',
+    '\N{LATIN CAPITAL LETTER L WITH STROKE}': 'L',
+    '\N{LATIN SMALL LETTER THORN}': 'th',
+    '\N{LATIN CAPITAL LETTER THORN}': 'TH',
+    '\N{LATIN SMALL LETTER DOTLESS I}': 'i',
+})
+
+
+class _NormalizeTable(dict):
+    """A ``str.translate`` table which lowercases ascii letters, turns
+    whitespace and underscores into hyphens, and drops every other character
+    that is not in ``allowed_charset``.
+
+    The ascii range is precomputed; other code points are classified the first
+    time they are seen.
+    """
+    def __init__(self):
+        super().__init__()
+        for c in map(chr, range(128)):
+            if c in allowed_charset:
+                self[ord(c)] = c
+            elif c in string.ascii_uppercase:
+                self[ord(c)] = c.lower()
+            elif c.isspace() or c == '_':
+                self[ord(c)] = '-'
+            else:
+                self[ord(c)] = None
+
+    def __missing__(self, key):
+        value = self[key] = '-' if chr(key).isspace() else None
+        return value
+
+
+_normalize_table = _NormalizeTable()
+_hyphens = re.compile('-{2,}')
+
+
+def _transliterate(name):
+    """Fold accented latin letters down to their ascii base letter followed by
+    combining marks. The marks are dropped by ``_normalize_table``.
+    """
+    return unicodedata.normalize('NFKD', name.translate(_transliterations))
+
 
+@lru_cache(maxsize=2 ** 16)
 def normalize(name):
     """Normalize an artist or track name.
 
@@ -21,18 +81,21 @@ def normalize(name):
     -------
     normalized : str
         The normalized name.
+
+    Notes
+    -----
+    Accented latin letters are transliterated to their ascii base letter, for
+    example: 'é' becomes 'e'. Results are memoized because the same artist and
+    album names are normalized for every track on an album.
     """
-    # drop leading and trailing whitespace
-    name = name.strip()
-    # normalize case
-    name = name.lower()
-    # normalize whitespace to hyphens
-    name = re.sub(r'[\s_]', '-', name)
-    # drop invalid characters
-    for char in set(name) - allowed_charset:
-        name = name.replace(char, '')
-    # fold hyphens down into a single hyphen
-    name = re.sub(r'-+', '-', name)
+    if not name.isascii():
+        name = _transliterate(name)
+    # drop leading and trailing whitespace, normalize case, normalize
+    # whitespace to hyphens, and drop invalid characters in a single pass
+    name = name.strip().translate(_normalize_table)
+    if '--' in name:
+        # fold hyphens down into a single hyphen
+        name = _hyphens.sub('-', name)
     return name
 
 
@@ -136,6 +199,118 @@ def normalize_artist(artist):
     return map(normalize, artist.split(','))
 
 
+def _unique(values):
+    """Dedupe a batch of raw values.
+
+    Parameters
+    ----------
+    values : iterable[str] or np.ndarray[str]
+        The raw values. NumPy string arrays are accepted without importing
+        NumPy here.
+
+    Returns
+    -------
+    uniques : list[str]
+        The distinct values in the order they first appear.
+    inverse : list[int]
+        The index into ``uniques`` for each element of ``values``.
+    """
+    if hasattr(values, 'tolist'):
+        # turn numpy scalars into python strings so that they hash and
+        # normalize like the values read out of the tags
+        values = values.tolist()
+
+    index = {}
+    inverse = [index.setdefault(value, len(index)) for value in values]
+    return list(index), inverse
+
+
+def _normalize_batch(f, values):
+    uniques, inverse = _unique(values)
+    normalized = [f(value) for value in uniques]
+    return [normalized[ix] for ix in inverse]
+
+
+def normalize_many(names):
+    """Normalize a batch of artist, album, or track names.
+
+    Parameters
+    ----------
+    names : iterable[str] or np.ndarray[str]
+        The raw names.
+
+    Returns
+    -------
+    normalized : list[str]
+        The normalized names, aligned with ``names``.
+
+    Notes
+    -----
+    Each distinct name is only normalized once.
+    """
+    return _normalize_batch(normalize, names)
+
+
+def normalize_genres(names):
+    """Normalize a batch of genre names.
+
+    Parameters
+    ----------
+    names : iterable[str] or np.ndarray[str]
+        The raw genre names.
+
+    Returns
+    -------
+    normalized : list[str]
+        The normalized genre names, aligned with ``names``.
+
+    See Also
+    --------
+    normalize_genre
+    """
+    return _normalize_batch(normalize_genre, names)
+
+
+def normalize_artists(artists):
+    """Normalize a batch of artist tags.
+
+    Parameters
+    ----------
+    artists : iterable[str] or np.ndarray[str]
+        The raw artist tags. Each tag may hold comma delimited artists.
+
+    Returns
+    -------
+    normalized : list[list[str]]
+        The artist names parsed out of each tag, aligned with ``artists``.
+
+    Notes
+    -----
+    Both the raw tags and the comma delimited names inside of them are
+    deduped, so an artist which appears alone and in collaborations is only
+    normalized once.
+
+    See Also
+    --------
+    normalize_artist
+    """
+    tags, inverse = _unique(artists)
+    split = [tag.split(',') for tag in tags]
+    names, name_inverse = _unique(name for names in split for name in names)
+    normalized_names = [normalize(name) for name in names]
+
+    normalized_tags = []
+    ix = 0
+    for names in split:
+        end = ix + len(names)
+        normalized_tags.append([
+            normalized_names[name_ix] for name_ix in name_inverse[ix:end]
+        ])
+        ix = end
+
+    return [list(normalized_tags[tag_ix]) for tag_ix in inverse]
+
+
 def literal_sql_compile(s):
     """Compile a sql expression with bind params inlined as literals.
 
@@ -150,3 +325,91 @@ def literal_sql_compile(s):
         An equivalent sql string.
     """
     return str(s.compile(compile_kwargs={'literal_binds': True}))
+
+
+_word_pattern = re.compile('[a-z0-9]+')
+
+
+def split_words(name):
+    """Split a name into the words that approximate matches compare.
+
+    Parameters
+    ----------
+    name : str
+        The name, like ``'storm-over-the-river'``.
+
+    Returns
+    -------
+    words : list[str]
+        The lowercase runs of letters and digits in the name.
+    """
+    return _word_pattern.findall(name.lower())
+
+
+def trigrams(word):
+    """The three character substrings of a word padded with two ``-`` on
+    each side.
+
+    Parameters
+    ----------
+    word : str
+        The word.
+
+    Returns
+    -------
+    trigrams : set[str]
+        The distinct trigrams of the padded word.
+    """
+    padded = '--%s--' % word
+    return {padded[n:n + 3] for n in range(len(padded) - 2)}
+
+
+def max_typos(word):
+    """The edit distance allowed when approximately matching a word.
+
+    Parameters
+    ----------
+    word : str
+        The word being matched.
+
+    Returns
+    -------
+    typos : int
+        0 for words of 2 characters or less, 1 up to 6 characters, and 2 for
+        longer words.
+    """
+    if len(word) <= 2:
+        return 0
+    if len(word) <= 6:
+        return 1
+    return 2
+
+
+def edit_distance(a, b):
+    """The Levenshtein distance between two strings.
+
+    Parameters
+    ----------
+    a, b : str
+        The strings to compare.
+
+    Returns
+    -------
+    distance : int
+        The number of single character insertions, deletions, or
+        substitutions needed to turn ``a`` into ``b``.
+    """
+    if len(a) < len(b):
+        a, b = b, a
+
+    previous = list(range(len(b) + 1))
+    for n, ca in enumerate(a, 1):
+        current = [n]
+        for m, cb in enumerate(b, 1):
+            current.append(min(
+                previous[m] + 1,
+                current[m - 1] + 1,
+                previous[m - 1] + (ca != cb),
+            ))
+        previous = current
+    return previous[-1]
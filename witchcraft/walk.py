@@ -0,0 +1,196 @@
+"""Find the audio files under a directory without recursion.
+
+``ingest`` used to call itself for each directory and open every entry with
+taglib to find out whether it was audio. :func:`walk_audio_files` keeps an
+explicit stack of directories, skips entries by name and extension without
+opening them, and checks the first bytes of the remaining files before they
+are handed to a tag reader.
+"""
+from fnmatch import fnmatchcase
+import os
+
+from .metrics import registry
+
+# the extensions of the formats that taglib reads
+audio_extensions = frozenset({
+    '.aac',
+    '.aif',
+    '.aiff',
+    '.ape',
+    '.flac',
+    '.m4a',
+    '.mp3',
+    '.mp4',
+    '.mpc',
+    '.oga',
+    '.ogg',
+    '.opus',
+    '.wav',
+    '.wma',
+    '.wv',
+})
+
+# the number of bytes read from the start of each file by ``sniff``
+_sniff_size = 12
+
+# (offset, prefix) pairs that start an audio file
+_magic = (
+    (0, b'fLaC'),
+    # an id3v2 tag in front of mp3, aac, or flac data
+    (0, b'ID3'),
+    (0, b'OggS'),
+    (0, b'RIFF'),
+    (0, b'FORM'),
+    (0, b'MAC '),
+    (0, b'MPCK'),
+    (0, b'MP+'),
+    (0, b'wvpk'),
+    # the asf header object guid
+    (0, b'\x30\x26\xb2\x75\x8e\x66\xcf\x11'),
+    # the mp4 file type box
+    (4, b'ftyp'),
+)
+
+_walk_skipped = registry.counter(
+    'witchcraft_walk_skipped_total',
+    'Directory entries which were not handed to a tag reader.',
+)
+
+
+def sniff(path):
+    """Check whether a file starts like an audio file.
+
+    Parameters
+    ----------
+    path : str
+        The path to the file.
+
+    Returns
+    -------
+    is_audio : bool
+        Whether the first bytes of the file match a known audio container or
+        an mpeg audio frame.
+
+    Raises
+    ------
+    OSError
+        Raised when the file cannot be read.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(_sniff_size)
+
+    if any(head.startswith(prefix, offset) for offset, prefix in _magic):
+        return True
+
+    # a bare mpeg audio frame starts with 11 set sync bits
+    return len(head) >= 2 and head[0] == 0xff and head[1] & 0xe0 == 0xe0
+
+
+def _denied(name, deny):
+    return any(fnmatchcase(name, pattern) for pattern in deny)
+
+
+def walk_audio_files(path,
+                     *,
+                     extensions=audio_extensions,
+                     deny=(),
+                     sniff_magic=True,
+                     follow_symlinks=True,
+                     onerror=None):
+    """Lazily find the audio files under a directory.
+
+    Parameters
+    ----------
+    path : str
+        The directory to walk.
+    extensions : iterable[str], optional
+        The file extensions to consider, with the leading dot. These are
+        compared case insensitively. If None, every extension is considered.
+    deny : iterable[str], optional
+        Glob patterns for the names of files and directories to skip, like
+        ``'.*'`` or ``'*.cue'``.
+    sniff_magic : bool, optional
+        Read the first bytes of each candidate and skip the files which do
+        not start like audio.
+    follow_symlinks : bool, optional
+        Walk into symlinked directories. Each directory is only walked once,
+        so a symlink loop does not hang the walk.
+    onerror : callable[OSError, None], optional
+        Called with the error when a directory cannot be listed or a file
+        cannot be read, like ``os.walk``. If None, these entries are skipped.
+
+    Yields
+    ------
+    path : str
+        The path to each audio file. The files in a directory are yielded in
+        name order before any of its subdirectories are walked.
+    """
+    if extensions is not None:
+        extensions = frozenset(extension.lower() for extension in extensions)
+    deny = tuple(deny)
+
+    try:
+        root = os.stat(path)
+    except OSError as e:
+        if onerror is not None:
+            onerror(e)
+        return
+
+    # the (device, inode) of every directory that has been walked
+    seen = {(root.st_dev, root.st_ino)}
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
+            continue
+
+        subdirectories = []
+        for entry in entries:
+            if deny and _denied(entry.name, deny):
+                _walk_skipped.inc()
+                continue
+
+            try:
+                if entry.is_dir(follow_symlinks=follow_symlinks):
+                    stat = entry.stat(follow_symlinks=follow_symlinks)
+                    key = stat.st_dev, stat.st_ino
+                    if key not in seen:
+                        seen.add(key)
+                        subdirectories.append(entry.path)
+                    continue
+
+                if not entry.is_file():
+                    _walk_skipped.inc()
+                    continue
+            except OSError as e:
+                # a dangling symlink or an entry removed during the walk
+                if onerror is not None:
+                    onerror(e)
+                continue
+
+            if extensions is not None:
+                extension = os.path.splitext(entry.name)[1].lower()
+                if extension not in extensions:
+                    _walk_skipped.inc()
+                    continue
+
+            if sniff_magic:
+                try:
+                    is_audio = sniff(entry.path)
+                except OSError as e:
+                    if onerror is not None:
+                        onerror(e)
+                    continue
+                if not is_audio:
+                    _walk_skipped.inc()
+                    continue
+
+            yield entry.path
+
+        # walk the subdirectories in name order
+        stack.extend(reversed(subdirectories))